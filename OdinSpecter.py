@@ -1,83 +1,110 @@
-from time import sleep
-from PIL import Image
-import sys
 import os
 import argparse
 import subprocess
-
-from driver.Whisplay import WhisPlayBoard
-from utils import ColorUtils, ImageUtils, TextUtils
-from gemini import upload_and_generate
+import threading
+import time
+import wave
+from contextlib import nullcontext
+from urllib.parse import urlparse
+
+from driver.Whisplay import WhisPlayBoard, LedEffect
+from quota import BACKGROUND, INTERACTIVE
+from camera import CameraPipeline, open_source
+from job_queue import JobQueue, is_online, DONE
+from remote_display import DisplayServer
+from metrics import MetricsServer, counter, gauge
+from profiling import profiler, freeze_after_boot
+from ui import Compositor
+from power import PowerGovernor
+from framebuffer import SharedFramebuffer, FramePresenter
+from worker import AIWorker, LocalAI, WorkerError
+from capture import PrerollCapture
+from kws import KeywordSpotter, load_templates, TEMPLATES_FILE
+from mixer import Mixer, BACKGROUND as ECHO, SPEECH
 
 # Initialize hardware
 board = WhisPlayBoard()
 board.set_backlight(50)
+# The compositor and remote display draw into shared memory; the presenter thread owns the SPI transfers
+framebuffer = SharedFramebuffer(board.LCD_WIDTH, board.LCD_HEIGHT)
+presenter = FramePresenter(framebuffer, board).start()
+ui = Compositor(framebuffer)
+
+SUBPROCESS_SPAWNS = counter("odin_subprocess_spawns_total", "External tools started", ("command",))
+
+# Display state, rendered by the compositor
+current_status = ""
+current_emoji = ""
+current_text = ""
+current_battery_level = None
+current_battery_color = None
+current_scroll_top = 0
+current_scroll_speed = 6  # pixels per SCROLL_INTERVAL
+current_scroll_limit = 0  # how far the current text can scroll
+current_image_path = ""
+scroll_started_at = 0.0
+display_lock = threading.RLock()
+scroll_stop = threading.Event()
+SCROLL_INTERVAL = 0.25
+SCROLL_HOLD = 2.0  # seconds new text stays put before it starts scrolling
 
 # Global variables
-img1_data = None  # Recording stage (test1.jpg)
-img2_data = None  # Playback stage (test2.jpg)
 REC_FILE = "data/recorded_voice.wav"
+QUERY_IMAGE = "data/query_image.jpg"
+INTERACTIVE_AGE = 60  # seconds a queued question still counts as someone waiting for it
 recording_process = None
+camera = None  # CameraPipeline when started with --camera
+ai = None  # AIWorker, or LocalAI with --no_worker
+capture = None  # always-on PrerollCapture, unless --preroll 0
+spotter = None  # KeywordSpotter with --hands_free
+mixer = None  # one output stream for every sound, unless --no_mixer
 to_record = True
+transition_lock = threading.Lock()  # serializes on_button_pressed: button edge vs. keyword
 
 def update_display_data(status=None, emoji=None, text=None, 
                   scroll_speed=None, battery_level=None, battery_color=None, image_path=None):
     global current_status, current_emoji, current_text, current_battery_level
     global current_battery_color, current_scroll_top, current_scroll_speed, current_image_path
-
-    # If text is not continuation of previous, reset scroll position
-    if text is not None and not text.startswith(current_text):
-        current_scroll_top = 0
-        TextUtils.clean_line_image_cache()
-    if scroll_speed is not None:
-        current_scroll_speed = scroll_speed
-    current_status = status if status is not None else current_status
-    current_emoji = emoji if emoji is not None else current_emoji
-    current_text = text if text is not None else current_text
-    current_battery_level = battery_level if battery_level is not None else current_battery_level
-    current_battery_color = battery_color if battery_color is not None else current_battery_color
-    current_image_path = image_path if image_path is not None else current_image_path
-
-def load_jpg_as_rgb565(filepath, screen_width, screen_height):
-    """Convert image to RGB565 format supported by the screen"""
-    if not os.path.exists(filepath):
-        print(f"Warning: File not found: {filepath}")
-        return None
-
-    img = Image.open(filepath).convert('RGB')
-    original_width, original_height = img.size
-    aspect_ratio = original_width / original_height
-    screen_aspect_ratio = screen_width / screen_height
-
-    if aspect_ratio > screen_aspect_ratio:
-        new_height = screen_height
-        new_width = int(new_height * aspect_ratio)
-        resized_img = img.resize((new_width, new_height))
-        offset_x = (new_width - screen_width) // 2
-        cropped_img = resized_img.crop(
-            (offset_x, 0, offset_x + screen_width, screen_height))
-    else:
-        new_width = screen_width
-        new_height = int(new_width / aspect_ratio)
-        resized_img = img.resize((new_width, new_height))
-        offset_y = (new_height - screen_height) // 2
-        cropped_img = resized_img.crop(
-            (0, offset_y, screen_width, offset_y + screen_height))
-
-    pixel_data = []
-    for y in range(screen_height):
-        for x in range(screen_width):
-            r, g, b = cropped_img.getpixel((x, y))
-            rgb565 = ((r & 0xF8) << 8) | ((g & 0xFC) << 3) | (b >> 3)
-            pixel_data.extend([(rgb565 >> 8) & 0xFF, rgb565 & 0xFF])
-    return pixel_data
-
+    global current_scroll_limit, scroll_started_at
+
+    with display_lock:
+        if text is not None and text != current_text:
+            # If text is not continuation of previous, reset scroll position
+            if not current_text or not text.startswith(current_text):
+                current_scroll_top = 0
+                scroll_started_at = time.monotonic() + SCROLL_HOLD
+            current_scroll_limit = ui.text_overflow(text)
+        if scroll_speed is not None:
+            current_scroll_speed = scroll_speed
+        current_status = status if status is not None else current_status
+        current_emoji = emoji if emoji is not None else current_emoji
+        current_text = text if text is not None else current_text
+        current_battery_level = battery_level if battery_level is not None else current_battery_level
+        current_battery_color = battery_color if battery_color is not None else current_battery_color
+        current_image_path = image_path if image_path is not None else current_image_path
+
+        ui.update(status=current_status, emoji=current_emoji, text=current_text,
+                  scroll_top=current_scroll_top, battery_level=current_battery_level,
+                  battery_color=current_battery_color, image_path=current_image_path)
+        ui.render()
+
+
+def scroll_text():
+    """Thread: move text that doesn't fit up by current_scroll_speed every SCROLL_INTERVAL."""
+    global current_scroll_top
+    while not scroll_stop.wait(SCROLL_INTERVAL):
+        with display_lock:
+            if current_scroll_top >= current_scroll_limit or time.monotonic() < scroll_started_at:
+                continue
+            current_scroll_top = min(current_scroll_limit, current_scroll_top + current_scroll_speed)
+            update_display_data()
 
 def set_wm8960_volume_stable(volume_level: str):
     """Set wm8960 sound card volume"""
     CARD_NAME = 'wm8960soundcard'
     DEVICE_ARG = f'hw:{CARD_NAME}'
     try:
+        SUBPROCESS_SPAWNS.labels(command="amixer").inc(2)
         subprocess.run(['amixer', '-D', DEVICE_ARG, 'sset', 'Speaker',
                        volume_level], check=False, capture_output=True)
         subprocess.run(['amixer', '-D', DEVICE_ARG, 'sset',
@@ -85,150 +112,291 @@ def set_wm8960_volume_stable(volume_level: str):
     except Exception as e:
         print(f"ERROR: Failed to set volume: {e}")
 
-def load_jpg_as_rgb565(filepath, screen_width, screen_height):
-    """Convert image to RGB565 format supported by the screen"""
-    if not os.path.exists(filepath):
-        print(f"Warning: File not found: {filepath}")
-        return None
-
-    img = Image.open(filepath).convert('RGB')
-    original_width, original_height = img.size
-    aspect_ratio = original_width / original_height
-    screen_aspect_ratio = screen_width / screen_height
-
-    if aspect_ratio > screen_aspect_ratio:
-        new_height = screen_height
-        new_width = int(new_height * aspect_ratio)
-        resized_img = img.resize((new_width, new_height))
-        offset_x = (new_width - screen_width) // 2
-        cropped_img = resized_img.crop(
-            (offset_x, 0, offset_x + screen_width, screen_height))
-    else:
-        new_width = screen_width
-        new_height = int(new_width / aspect_ratio)
-        resized_img = img.resize((new_width, new_height))
-        offset_y = (new_height - screen_height) // 2
-        cropped_img = resized_img.crop(
-            (0, offset_y, screen_width, offset_y + screen_height))
-
-    pixel_data = []
-    for y in range(screen_height):
-        for x in range(screen_width):
-            r, g, b = cropped_img.getpixel((x, y))
-            rgb565 = ((r & 0xF8) << 8) | ((g & 0xFC) << 3) | (b >> 3)
-            pixel_data.extend([(rgb565 >> 8) & 0xFF, rgb565 & 0xFF])
-    return pixel_data
-
 
-def set_wm8960_volume_stable(volume_level: str):
-    """Set wm8960 sound card volume"""
-    CARD_NAME = 'wm8960soundcard'
-    DEVICE_ARG = f'hw:{CARD_NAME}'
+def play_sound(path, priority=SPEECH):
+    """Play a WAV to the end: through the mixer, or a blocking aplay with --no_mixer."""
+    if mixer is None:
+        SUBPROCESS_SPAWNS.labels(command="aplay").inc()
+        subprocess.run(['aplay', '-D', 'plughw:wm8960soundcard', path])
+        return
     try:
-        subprocess.run(['amixer', '-D', DEVICE_ARG, 'sset', 'Speaker',
-                       volume_level], check=False, capture_output=True)
-        subprocess.run(['amixer', '-D', DEVICE_ARG, 'sset',
-                       'Capture', '100'], check=False, capture_output=True)
-    except Exception as e:
-        print(f"ERROR: Failed to set volume: {e}")
+        mixer.play(path, priority=priority).wait()
+    except (OSError, EOFError, ValueError, wave.Error) as e:
+        print(f"Can't play {path}: {e}")
+
+
+def earcon(name):
+    if mixer:
+        mixer.earcon(name)
 
 
-def start_recording():
-    """Enter recording stage: display test1.jpg and start arecord"""
-    global recording_process, img1_data
+def mic_muted():
+    """Keep the keyword spotter from hearing our own speaker."""
+    return spotter.muted() if spotter else nullcontext()
+
+
+def start_recording(preroll=None):
+    """Enter recording stage: display test1.jpg and start recording"""
+    global recording_process
+    # Keep the panel fully on from the question until its playback has finished
+    governor.hold()
     print(">>> Status: Entering recording stage (displaying test1)...")
     print(">>> Press the button to stop recording and playback...")
 
-    if img1_data:
-        board.draw_image(0, 0, board.LCD_WIDTH, board.LCD_HEIGHT, img1_data)
+    if capture:
+        # Cut before drawing anything: the clip reaches back the pre-roll from here,
+        # so nobody has to wait for the screen before speaking
+        included = capture.start_clip(REC_FILE, preroll)
+        print(f">>> Recording with {included:.2f}s pre-roll")
+
+    if camera:
+        # Live preview while the question is asked, so the device can be aimed
+        camera.start()
+    else:
+        # The previous answer goes away with the new question
+        update_display_data(text="", image_path=args.img1)
+
+    if capture:
+        return
 
     # Start recording asynchronously
     command = ['arecord', '-D', 'hw:wm8960soundcard',
                '-f', 'S16_LE', '-r', '16000', '-c', '2', REC_FILE]
+    SUBPROCESS_SPAWNS.labels(command="arecord").inc()
     recording_process = subprocess.Popen(command)
 
 
-def on_button_pressed():
-    """Button callback: stop recording -> color change -> display test2 -> play recording (blocking) -> return to recording"""
-    global recording_process, img1_data, img2_data, to_record
+def on_button_pressed(preroll=None, end=None):
+    """Button callback: stop recording -> color change -> display test2 -> queue the question -> play recording back -> return to recording"""
+    global to_record
+    # Wake the panel before anything else, so the wake latency is measured from the edge
+    governor.activity()
     print(">>> Button pressed!")
 
-    if to_record:
-        start_recording()
-    
-    if not to_record:
-        # 1. Stop recording
-        if recording_process and recording_process.poll() is None:
-            recording_process.terminate()
-            recording_process.wait()
-
-        # 2. Visual feedback: LED color sequence
-        color_sequence = [(255, 0, 0, 0xF800),
-                        (0, 255, 0, 0x07E0), (0, 0, 255, 0x001F)]
-        for r, g, b, hex_code in color_sequence:
-            board.fill_screen(hex_code)
-            board.set_rgb(r, g, b)
-            sleep(0.4)
-        board.set_rgb(0, 0, 0)
-
-        # 3. Playback feedback: display test2.jpg and play recorded audio
-        if img2_data:
-            board.draw_image(0, 0, board.LCD_WIDTH, board.LCD_HEIGHT, img2_data)
-
+    # The GPIO thread and the keyword spotter can both get here; one transition at a time
+    job = None
+    with transition_lock:
+        if to_record:
+            start_recording(preroll)
+        else:
+            # 1. Stop recording (at `end`, where a stop keyword began, if given)
+            if capture:
+                capture.stop_clip(end)
+            elif recording_process and recording_process.poll() is None:
+                recording_process.terminate()
+                recording_process.wait()
+
+            image_path = None
+            if camera:
+                try:
+                    image = camera.snapshot()
+                    image.thumbnail((1024, 1024))
+                    image.save(QUERY_IMAGE, quality=90)
+                    image_path = QUERY_IMAGE
+                except (TimeoutError, RuntimeError, OSError) as e:
+                    print(f"Camera snapshot failed, asking without image: {e}")
+                camera.stop()
+                ui.invalidate()
+
+            # 2. Visual feedback: LED color sequence, runs alongside playback and upload
+            board.led_effects.play(LedEffect.sequence([
+                (255, 0, 0, 400, False), (0, 255, 0, 400, False),
+                (0, 0, 255, 400, False), (0, 0, 0, 0, False)]))
+
+            # 3. Playback feedback: display test2.jpg and play recorded audio
+            update_display_data(image_path=args.img2)
+
+            print(">>>>>>>>>>>>>>>>>>GEMINI>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>")
+            # Queued durably: if the network is down the recording is kept and retried.
+            # Queued before the playback below, so the upload doesn't wait for it
+            job = job_queue.enqueue(REC_FILE, image_path=image_path)
+            print(f">>> Queued utterance {job['id']} ({job_queue.pending()} pending)")
+            earcon("processing")
+        to_record = not to_record
+
+    if job:
+        # Outside the lock: the next press can start a new question during the echo
         print(">>> Playing back recording (displaying test2)...")
-        subprocess.run(['aplay', '-D', 'plughw:wm8960soundcard', REC_FILE])
-        print(">>>>>>>>>>>>>>>>>>GEMINI>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>")
-        try:
-            upload_and_generate()
-            print(">>> Playing Gemini Response")
-            subprocess.run(['aplay', '-D', 'plughw:wm8960soundcard', "data/answer.wav"])
-        except Exception as e:
-            print("Something went wrong....")
-            pass
-    to_record = not to_record
-
-
-# Register callback
-board.on_button_press(on_button_pressed)
+        with mic_muted():
+            # Lowest priority: an answer that is already back plays over it
+            play_sound(job["audio"], priority=ECHO)
+        governor.release()
+
+
+def process_job(job):
+    """Queue worker: run the Gemini pipeline for one stored recording in the AI worker."""
+    answer_path = job["audio"][:-len(".wav")] + ".answer.wav"
+    # Someone is waiting on a fresh question; retries and an offline backlog can yield to it
+    fresh = job["attempts"] <= 1 and time.time() - job["created_at"] < INTERACTIVE_AGE
+    # Kept on the job (and in the queue log) so delivery can show it while it is spoken
+    job["answer"] = ai.request("answer", audio_path=job["audio"], output_filename=answer_path,
+                               image_path=job.get("image"), priority=INTERACTIVE if fresh else BACKGROUND)
+    return answer_path
+
+
+def prewarm():
+    try:
+        ai.request("prewarm")
+    except WorkerError as e:
+        print(f"Prewarm failed: {e}")
+
+
+def deliver_job(job):
+    """Called in capture order once a queued utterance has an answer (or gave up)."""
+    if job["state"] != DONE:
+        print(f"Something went wrong.... ({job['error']})")
+        board.led_effects.play(LedEffect.blink(255, 0, 0, repeat=3))
+        earcon("error")
+        return
+    with governor.awake():
+        # Long answers scroll (scroll_text) while they are spoken
+        update_display_data(text=job.get("answer") or "", image_path=args.img2)
+        print(">>> Playing Gemini Response")
+        with mic_muted():
+            play_sound(job["result"])
+
+
+def on_keyword(start):
+    """Keyword spotter callback: the same transition as a button press, off the spotter's thread."""
+    # A start keyword is already over, so the question begins right after it;
+    # a stop keyword is cut from the end of the recording, from `start` on
+    threading.Thread(target=on_button_pressed, kwargs={"preroll": 0, "end": start},
+                     name="keyword", daemon=True).start()
+
+
+def on_remote_update(**fields):
+    governor.activity()
+    update_display_data(**fields)
+
+
+def on_remote_frame():
+    governor.activity()
+    ui.invalidate()
+
+
+def api_reachable():
+    api = urlparse(ai.api_base)
+    return is_online(api.hostname, api.port or (443 if api.scheme == "https" else 80))
+
+
+job_queue = JobQueue(process_job, deliver_job, probe=api_reachable)
+
 
 # --- Main program ---
 parser = argparse.ArgumentParser()
 parser.add_argument("--img1", default="data/OdinSpecter_4.png", help="Image for recording stage")
 parser.add_argument("--img2", default="data/OdinSpecter_2.png", help="Image for playback stage")
 parser.add_argument("--test_wav", default="data/test.wav")
+parser.add_argument("--camera", default=None, help="Camera for capture-and-ask: picamera, opencv[:INDEX] or synthetic")
+parser.add_argument("--metrics_port", type=int, default=None, help="Serve Prometheus metrics on this port")
+parser.add_argument("--profile", action="store_true", help="Profile allocations and GC pauses per stage from startup")
+parser.add_argument("--dim_after", type=float, default=30, help="Seconds idle before dimming the backlight (0 = never)")
+parser.add_argument("--idle_after", type=float, default=120, help="Seconds idle before panel idle mode (0 = never)")
+parser.add_argument("--sleep_after", type=float, default=600, help="Seconds idle before panel sleep (0 = never)")
+parser.add_argument("--remote_port", type=int, default=None, help="Accept remote display updates and frames on this port")
+parser.add_argument("--preroll", type=float, default=1.0,
+                    help="Seconds of audio kept from before the press (0 = start arecord on the press instead)")
+parser.add_argument("--hands_free", action="store_true",
+                    help="Start and stop recording on a spoken keyword as well as the button (needs --preroll)")
+parser.add_argument("--kws_templates", default=TEMPLATES_FILE, help="Keyword templates from `kws.py enroll`")
+parser.add_argument("--kws_threshold", type=float, default=None, help="Keyword match score needed to trigger")
+parser.add_argument("--no_mixer", action="store_true", help="Play each sound with its own blocking aplay")
+parser.add_argument("--no_worker", action="store_true", help="Run Gemini requests in this process instead of a worker")
 args = parser.parse_args()
 
+governor = PowerGovernor(board, brightness=50, dim_after=args.dim_after, idle_after=args.idle_after,
+                         sleep_after=args.sleep_after)
+# Register callback: only now, since on_button_pressed needs the governor and args
+board.on_button_press(on_button_pressed)
+remote_display = None
+metrics_server = None
+gauge("odin_queue_pending", "Utterances waiting for an answer or delivery").set_function(job_queue.pending)
+if args.camera:
+    camera = CameraPipeline(open_source(args.camera), board)
+# kill -USR1 toggles profiling; the report goes to data/profile.json
+profiler.install_signal()
+if args.profile:
+    profiler.enable()
+# The worker serves its own metrics on the next port up
+ai = LocalAI() if args.no_worker else AIWorker(
+    metrics_port=args.metrics_port + 1 if args.metrics_port else None, profile=args.profile)
+
 try:
     # 1. Load all image data first
     print("Initializing images...")
-    img1_data = load_jpg_as_rgb565(
-        args.img1, board.LCD_WIDTH, board.LCD_HEIGHT)
-    img2_data = load_jpg_as_rgb565(
-        args.img2, board.LCD_WIDTH, board.LCD_HEIGHT)
+    ui.preload_image(args.img1)
+    ui.preload_image(args.img2)
 
     # 2. Set volume
     set_wm8960_volume_stable("121")
+    if not args.no_mixer:
+        mixer = Mixer().start()
 
     # 3. Play startup audio at launch (displaying test2.jpg)
     if os.path.exists(args.test_wav):
-        if img2_data:
-            board.draw_image(0, 0, board.LCD_WIDTH,
-                             board.LCD_HEIGHT, img2_data)
+        update_display_data(image_path=args.img2)
         print(f">>> Playing startup audio: {args.test_wav} (displaying test2)")
-        subprocess.run(
-            ['aplay', '-D', 'plughw:wm8960soundcard', args.test_wav])
+        play_sound(args.test_wav)
 
     # 4. After audio finishes, enter recording loop
     # start_recording()
     # Start Recording Flag on next button press
     to_record = True
-
-    while True:
-        sleep(0.1)
+    if args.preroll:
+        capture = PrerollCapture(args.preroll)
+        if args.hands_free:
+            try:
+                templates, length = load_templates(args.kws_templates)
+                threshold = {"threshold": args.kws_threshold} if args.kws_threshold else {}
+                spotter = KeywordSpotter(templates, length, on_keyword, **threshold).start()
+                capture.add_listener(spotter.feed)
+            except (OSError, KeyError, ValueError) as e:
+                print(f"Hands-free disabled, no keyword templates: {e}")
+        capture.start()
+        SUBPROCESS_SPAWNS.labels(command="arecord").inc()
+    elif args.hands_free:
+        print("Hands-free needs the always-on capture; ignoring --hands_free with --preroll 0")
+    ai.start()
+    job_queue.start()
+    threading.Thread(target=prewarm, name="prewarm", daemon=True).start()
+    threading.Thread(target=scroll_text, name="scroll", daemon=True).start()
+    if args.metrics_port:
+        metrics_server = MetricsServer(args.metrics_port).start()
+    if args.remote_port:
+        remote_display = DisplayServer(framebuffer, on_update=on_remote_update, on_frame=on_remote_frame,
+                                       flush=presenter.flush, port=args.remote_port).start()
+
+    # Fonts, backgrounds and modules live for the whole session: keep the collector off them
+    print(f"Froze {freeze_after_boot()} long-lived objects")
+
+    # Blocks until Ctrl+C; wakes only to step the panel down after inactivity
+    governor.run()
 
 except KeyboardInterrupt:
     print("\nProgram exited")
 finally:
+    scroll_stop.set()
     if recording_process:
         recording_process.terminate()
+    if capture:
+        capture.stop()
+    if mixer:
+        mixer.stop()
+    if spotter:
+        spotter.stop()
+        print(f"Keyword spotter: {spotter.stats()}")
+    job_queue.stop()
+    ai.stop()
+    if remote_display:
+        remote_display.stop()
+    if metrics_server:
+        metrics_server.stop()
+    if profiler.enabled:
+        profiler.dump()
+    if camera:
+        camera.stop()
+        camera.source.close()
+    print(f"Power: {governor.stats()}")
+    presenter.stop()
+    framebuffer.close()
     board.cleanup()
@@ -0,0 +1,373 @@
+"""
+Camera preview: capture -> resize -> RGB565 -> panel.
+
+Capture and display run on their own threads and meet at a single-slot
+"latest frame" buffer: if the display is still busy when a new frame arrives,
+the older unseen frame is dropped, so the preview never falls behind the
+sensor. Frames live in a fixed pool of three buffers and the resize/convert
+steps write into preallocated arrays, so steady state allocates nothing.
+
+    python camera.py --source synthetic --seconds 10
+"""
+import argparse
+import threading
+import time
+from collections import deque
+
+import numpy as np
+from PIL import Image
+
+from metrics import counter
+
+try:
+    import cv2 as cv
+except ImportError:
+    cv = None
+
+try:
+    from picamera2 import Picamera2
+except ImportError:
+    Picamera2 = None
+
+CAPTURE_WIDTH = 640
+CAPTURE_HEIGHT = 480
+
+CAMERA_FRAMES = counter("odin_display_frames_total", "Frames or partial updates pushed to the panel",
+                        ("source",)).labels(source="camera")
+CAMERA_DROPPED = counter("odin_frames_dropped_total", "Frames superseded before reaching the panel",
+                         ("source",)).labels(source="camera")
+
+
+class SyntheticSource:
+    """Moving colour bars at a fixed rate, for running the pipeline without a camera."""
+
+    channel_order = "RGB"
+
+    def __init__(self, width=CAPTURE_WIDTH, height=CAPTURE_HEIGHT, fps=30):
+        self.width = width
+        self.height = height
+        self.interval = 1.0 / fps if fps else 0
+        self.frame_index = 0
+        self._next_at = time.monotonic()
+        bars = np.array([[255, 255, 255], [255, 255, 0], [0, 255, 255], [0, 255, 0],
+                         [255, 0, 255], [255, 0, 0], [0, 0, 255], [0, 0, 0]], dtype=np.uint8)
+        columns = np.arange(width * 2) * len(bars) // width % len(bars)
+        self._pattern = np.ascontiguousarray(np.broadcast_to(bars[columns], (height, width * 2, 3)))
+
+    def read(self, out):
+        """Fill `out` (height x width x 3) with the next frame; returns its capture timestamp."""
+        if self.interval:
+            delay = self._next_at - time.monotonic()
+            if delay > 0:
+                time.sleep(delay)
+            self._next_at = max(self._next_at + self.interval, time.monotonic() - self.interval)
+        shift = (self.frame_index * 4) % self.width
+        np.copyto(out, self._pattern[:, shift:shift + self.width])
+        self.frame_index += 1
+        return time.monotonic()
+
+    def close(self):
+        pass
+
+
+class OpenCVSource:
+    """USB/V4L2 camera through OpenCV; frames arrive in BGR order."""
+
+    channel_order = "BGR"
+
+    def __init__(self, index=0, width=CAPTURE_WIDTH, height=CAPTURE_HEIGHT):
+        if cv is None:
+            raise RuntimeError("OpenCV (cv2) is not installed")
+        self.capture = cv.VideoCapture(index)
+        self.capture.set(cv.CAP_PROP_FRAME_WIDTH, width)
+        self.capture.set(cv.CAP_PROP_FRAME_HEIGHT, height)
+        self.capture.set(cv.CAP_PROP_BUFFERSIZE, 1)
+        self.width = int(self.capture.get(cv.CAP_PROP_FRAME_WIDTH)) or width
+        self.height = int(self.capture.get(cv.CAP_PROP_FRAME_HEIGHT)) or height
+
+    def read(self, out):
+        ok, _ = self.capture.read(out)  # decodes into `out` when the shape matches
+        if not ok:
+            raise IOError("camera read failed")
+        return time.monotonic()
+
+    def close(self):
+        self.capture.release()
+
+
+class PiCameraSource:
+    """Raspberry Pi camera through picamera2."""
+
+    channel_order = "BGR"  # picamera2 "RGB888" is BGR in memory
+
+    def __init__(self, width=CAPTURE_WIDTH, height=CAPTURE_HEIGHT):
+        if Picamera2 is None:
+            raise RuntimeError("picamera2 is not installed")
+        self.camera = Picamera2()
+        config = self.camera.create_video_configuration(
+            main={"size": (width, height), "format": "RGB888"}, buffer_count=2)
+        self.camera.configure(config)
+        self.camera.start()
+        self.width = width
+        self.height = height
+
+    def read(self, out):
+        request = self.camera.capture_request()
+        try:
+            np.copyto(out, request.make_array("main")[:, :self.width, :3])
+        finally:
+            request.release()
+        return time.monotonic()
+
+    def close(self):
+        self.camera.stop()
+        self.camera.close()
+
+
+def open_source(name, width=CAPTURE_WIDTH, height=CAPTURE_HEIGHT):
+    if name == "synthetic":
+        return SyntheticSource(width, height)
+    if name == "picamera":
+        return PiCameraSource(width, height)
+    if name.startswith("opencv"):
+        _, _, index = name.partition(":")
+        return OpenCVSource(int(index or 0), width, height)
+    raise ValueError(f"unknown camera source {name}")
+
+
+class RGB565Converter:
+    """
+    Nearest-neighbour "cover" scale (fill the screen, crop the overflow) plus RGB565
+    packing, all into buffers allocated once for a given source and panel size.
+    convert() returns a big-endian byte view that can go straight to draw_image.
+    """
+
+    def __init__(self, src_width, src_height, width, height, channel_order="RGB"):
+        scale = max(width / src_width, height / src_height)
+        crop_w, crop_h = width / scale, height / scale
+        left, top = (src_width - crop_w) / 2, (src_height - crop_h) / 2
+        self.rows = np.clip((top + (np.arange(height) + 0.5) / scale).astype(np.intp), 0, src_height - 1)
+        self.cols = np.clip((left + (np.arange(width) + 0.5) / scale).astype(np.intp), 0, src_width - 1)
+        self.channels = (0, 1, 2) if channel_order == "RGB" else (2, 1, 0)
+        self._rows_buffer = np.empty((height, src_width, 3), dtype=np.uint8)
+        self.resized = np.empty((height, width, 3), dtype=np.uint8)
+        self._channel = np.empty((height, width), dtype=np.uint16)
+        self._packed = np.empty((height, width), dtype=np.uint16)
+        self.output = np.empty((height, width), dtype=">u2")
+        self.output_bytes = self.output.view(np.uint8).reshape(-1)
+
+    def convert(self, frame):
+        # mode="clip" writes straight into out; the default mode buffers a full copy
+        np.take(frame, self.rows, axis=0, out=self._rows_buffer, mode="clip")
+        np.take(self._rows_buffer, self.cols, axis=1, out=self.resized, mode="clip")
+        ri, gi, bi = self.channels
+        packed, channel = self._packed, self._channel
+        np.copyto(packed, self.resized[:, :, ri])
+        np.bitwise_and(packed, 0xF8, out=packed)
+        np.left_shift(packed, 8, out=packed)
+        np.copyto(channel, self.resized[:, :, gi])
+        np.bitwise_and(channel, 0xFC, out=channel)
+        np.left_shift(channel, 3, out=channel)
+        np.bitwise_or(packed, channel, out=packed)
+        np.copyto(channel, self.resized[:, :, bi])
+        np.right_shift(channel, 3, out=channel)
+        np.bitwise_or(packed, channel, out=packed)
+        np.copyto(self.output, packed)
+        return self.output_bytes
+
+
+class RateMeter:
+    """Events per second over the last `window` events."""
+
+    def __init__(self, window=60):
+        self.times = deque(maxlen=window)
+
+    def tick(self, now):
+        self.times.append(now)
+
+    @property
+    def rate(self):
+        if len(self.times) < 2:
+            return 0.0
+        return (len(self.times) - 1) / (self.times[-1] - self.times[0])
+
+
+class CameraPipeline:
+    """
+    Threaded preview of `source` on `board`. stats() reports capture and display
+    FPS, dropped frames and capture-to-panel latency percentiles.
+    """
+
+    POOL_SIZE = 3  # one being captured, one waiting in the slot, one being displayed
+
+    def __init__(self, source, board, stats_window=60):
+        self.source = source
+        self.board = board
+        self.converter = RGB565Converter(source.width, source.height, board.LCD_WIDTH,
+                                         board.LCD_HEIGHT, source.channel_order)
+        self._free = [np.empty((source.height, source.width, 3), dtype=np.uint8)
+                      for _ in range(self.POOL_SIZE)]
+        self._slot = None  # (buffer, captured_at)
+        self._cond = threading.Condition()
+        self._running = False
+        self._threads = []
+        self.captured = 0
+        self.displayed = 0
+        self.dropped = 0
+        self.errors = 0
+        self.capture_rate = RateMeter(stats_window)
+        self.display_rate = RateMeter(stats_window)
+        self.latencies = deque(maxlen=stats_window)
+        self.convert_times = deque(maxlen=stats_window)
+
+    def start(self):
+        with self._cond:
+            if self._slot is not None:
+                # Left over from the previous run; do not hand it out as current
+                self._free.append(self._slot[0])
+                self._slot = None
+        self._running = True
+        for target, name in ((self._capture_loop, "camera-capture"), (self._display_loop, "camera-display")):
+            thread = threading.Thread(target=target, name=name, daemon=True)
+            thread.start()
+            self._threads.append(thread)
+        return self
+
+    def stop(self):
+        self._running = False
+        with self._cond:
+            self._cond.notify_all()
+        for thread in self._threads:
+            thread.join(timeout=2)
+        self._threads = []
+
+    def snapshot(self, timeout=2.0):
+        """Full-resolution RGB copy of the newest captured frame (waits for one if none is pending)."""
+        with self._cond:
+            if not self._cond.wait_for(lambda: self._slot is not None or not self._running, timeout):
+                raise TimeoutError("no camera frame")
+            if self._slot is None:
+                raise RuntimeError("camera pipeline is stopped")
+            # The capture thread never writes into the slot buffer, so copying under the lock is safe
+            frame = self._slot[0].copy()
+        if self.source.channel_order == "BGR":
+            frame = frame[:, :, ::-1]
+        return Image.fromarray(np.ascontiguousarray(frame))
+
+    def _capture_loop(self):
+        while self._running:
+            with self._cond:
+                buffer = self._free.pop()
+            try:
+                captured_at = self.source.read(buffer)
+            except Exception as e:
+                print(f"Camera capture failed: {e}")
+                self.errors += 1
+                with self._cond:
+                    self._free.append(buffer)
+                time.sleep(0.5)
+                continue
+            with self._cond:
+                if self._slot is not None:
+                    # The display never saw this one; recycle it
+                    self._free.append(self._slot[0])
+                    self.dropped += 1
+                    CAMERA_DROPPED.inc()
+                self._slot = (buffer, captured_at)
+                self.captured += 1
+                self.capture_rate.tick(captured_at)
+                self._cond.notify()
+
+    def _display_loop(self):
+        while self._running:
+            with self._cond:
+                while self._running and self._slot is None:
+                    self._cond.wait()
+                if not self._running:
+                    return
+                buffer, captured_at = self._slot
+                self._slot = None
+            try:
+                started = time.monotonic()
+                data = self.converter.convert(buffer)
+                self.convert_times.append(time.monotonic() - started)
+                self.board.draw_image(0, 0, self.board.LCD_WIDTH, self.board.LCD_HEIGHT, data)
+            except Exception as e:
+                print(f"Camera display failed: {e}")
+                self.errors += 1
+            finally:
+                with self._cond:
+                    self._free.append(buffer)
+            now = time.monotonic()
+            self.displayed += 1
+            CAMERA_FRAMES.inc()
+            self.display_rate.tick(now)
+            self.latencies.append(now - captured_at)
+
+    def stats(self):
+        latencies = sorted(self.latencies)
+        convert_times = sorted(self.convert_times)
+
+        def percentile(values, q):
+            return round(values[min(len(values) - 1, int(q * len(values)))] * 1000, 1) if values else None
+
+        return {
+            "capture_fps": round(self.capture_rate.rate, 1),
+            "display_fps": round(self.display_rate.rate, 1),
+            "captured": self.captured,
+            "displayed": self.displayed,
+            "dropped": self.dropped,
+            "errors": self.errors,
+            "latency_p50_ms": percentile(latencies, 0.5),
+            "latency_p95_ms": percentile(latencies, 0.95),
+            "convert_p50_ms": percentile(convert_times, 0.5),
+        }
+
+
+class _NullBoard:
+    """Stands in for the panel when benchmarking the pipeline off-device."""
+
+    LCD_WIDTH = 240
+    LCD_HEIGHT = 280
+
+    def __init__(self, draw_seconds=0.0):
+        self.draw_seconds = draw_seconds
+
+    def draw_image(self, x, y, width, height, pixel_data):
+        if self.draw_seconds:
+            time.sleep(self.draw_seconds)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--source", default="synthetic", help="synthetic, picamera or opencv[:INDEX]")
+    parser.add_argument("--width", type=int, default=CAPTURE_WIDTH)
+    parser.add_argument("--height", type=int, default=CAPTURE_HEIGHT)
+    parser.add_argument("--seconds", type=float, default=10)
+    parser.add_argument("--no-display", action="store_true", help="Do not touch the panel (off-device benchmark)")
+    args = parser.parse_args()
+
+    if args.no_display:
+        board = _NullBoard(draw_seconds=0.02)
+    else:
+        from driver.Whisplay import WhisPlayBoard
+        board = WhisPlayBoard()
+        board.set_backlight(50)
+    source = open_source(args.source, args.width, args.height)
+    pipeline = CameraPipeline(source, board).start()
+    try:
+        end = time.monotonic() + args.seconds
+        while time.monotonic() < end:
+            time.sleep(1)
+            print(pipeline.stats())
+    except KeyboardInterrupt:
+        pass
+    finally:
+        pipeline.stop()
+        source.close()
+        if not args.no_display:
+            board.cleanup()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,310 @@
+"""
+Always-on microphone capture with a pre-roll ring buffer.
+
+Starting arecord on the button edge loses the first words to process start-up
+and device open. PrerollCapture keeps one arecord running for the whole
+session, streaming raw S16_LE into a ring that always holds the last
+`preroll` seconds. start_clip() writes the ring's contents to the WAV and
+keeps appending live chunks from the same stream until stop_clip(), so the
+recording starts up to a second before the press with no gap or duplicated
+samples: every byte has one offset in the stream, and the ring copy and the
+live appends are split at the same offset under one lock.
+
+Listeners (add_listener) see every chunk as it arrives, for consumers such as
+a keyword spotter that need the stream without a second arecord.
+
+Idle cost can be measured on the device, or without hardware from a
+synthetic real-time source:
+
+    python capture.py cost --seconds 30
+    python capture.py cost --synthetic
+"""
+import argparse
+import json
+import os
+import subprocess
+import threading
+import time
+import wave
+
+import numpy as np
+
+from metrics import counter
+
+RATE = 16000
+CHANNELS = 2
+SAMPLE_BYTES = 2
+CHUNK_MS = 40
+PREROLL_SECONDS = 1.0
+RESTART_DELAY = 1.0
+ARECORD_COMMAND = ['arecord', '-q', '-D', 'hw:wm8960soundcard', '-f', 'S16_LE', '-r', str(RATE),
+                   '-c', str(CHANNELS), '-t', 'raw']
+
+CAPTURE_RESTARTS = counter("odin_capture_restarts_total", "Times the always-on arecord had to be restarted")
+CLIPS = counter("odin_capture_clips_total", "Recordings cut from the capture stream")
+
+
+class SyntheticSource:
+    """
+    Real-time stand-in for arecord's stdout: a 16-bit ramp, so a clip can be
+    checked for gaps and duplicates sample by sample.
+    """
+
+    def __init__(self, rate=RATE, channels=CHANNELS):
+        self.frame_bytes = channels * SAMPLE_BYTES
+        self.bytes_per_second = rate * self.frame_bytes
+        self.channels = channels
+        self.position = 0
+        self.started = None
+        self.closed = False
+
+    def readinto(self, buffer):
+        if self.closed:
+            return 0
+        if self.started is None:
+            self.started = time.monotonic()
+        frames = len(buffer) // self.frame_bytes
+        due = self.started + (self.position + frames) / (self.bytes_per_second / self.frame_bytes)
+        time.sleep(max(0.0, due - time.monotonic()))
+        ramp = (np.arange(self.position, self.position + frames) % 65536 - 32768).astype("<i2")
+        buffer[:frames * self.frame_bytes] = np.repeat(ramp, self.channels).tobytes()
+        self.position += frames
+        return frames * self.frame_bytes
+
+    def close(self):
+        self.closed = True
+
+
+class PrerollCapture:
+    def __init__(self, preroll=PREROLL_SECONDS, command=ARECORD_COMMAND, rate=RATE, channels=CHANNELS,
+                 chunk_ms=CHUNK_MS, source=None):
+        """source: a readinto()-able stream to use instead of spawning `command` (tests, benchmarks)."""
+        self.command = command
+        self.rate = rate
+        self.channels = channels
+        self.frame_bytes = channels * SAMPLE_BYTES
+        self.bytes_per_second = rate * self.frame_bytes
+        self.ring_size = max(1, int(preroll * rate)) * self.frame_bytes
+        self.ring = bytearray(self.ring_size)
+        self.chunk = bytearray(max(1, rate * chunk_ms // 1000) * self.frame_bytes)
+        self.total = 0  # bytes read from the stream since start()
+        self.process = None
+        self.source = source
+        self.restarts = 0
+        self.clip = None
+        self.clip_path = None
+        self.clip_start = 0
+        self._listeners = []
+        self._lock = threading.Lock()
+        self._running = False
+        self._thread = None
+
+    def add_listener(self, callback):
+        """callback(chunk) for every chunk read; `chunk` is only valid during the call."""
+        self._listeners.append(callback)
+
+    # ========== Stream ==========
+    def start(self):
+        self._running = True
+        self._thread = threading.Thread(target=self._run, name="capture", daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._running = False
+        if self.process and self.process.poll() is None:
+            self.process.terminate()
+        elif self.source is not None:
+            self.source.close()
+        if self._thread:
+            self._thread.join(timeout=2)
+        with self._lock:
+            self._close_clip()
+
+    def _open(self):
+        if self.source is not None:
+            return self.source
+        self.process = subprocess.Popen(self.command, stdout=subprocess.PIPE, bufsize=0)
+        return self.process.stdout
+
+    def _run(self):
+        chunk = memoryview(self.chunk)
+        stream = self._open()
+        while self._running:
+            try:
+                n = stream.readinto(chunk)
+            except (OSError, ValueError):
+                n = 0
+            if n:
+                self._append(chunk[:n])
+                continue
+            if not self._running or self.source is not None:
+                break
+            # arecord died (device reset, xrun it couldn't recover); the stream continues after a gap
+            code = self.process.wait()
+            print(f"Capture: arecord exited with {code}, restarting")
+            self.restarts += 1
+            CAPTURE_RESTARTS.inc()
+            time.sleep(RESTART_DELAY)
+            # Keep later samples frame-aligned if it died mid-frame
+            if self.total % self.frame_bytes:
+                self._append(bytes(-self.total % self.frame_bytes))
+            stream = self._open()
+        if self.process:
+            self.process.wait()
+
+    def _append(self, data):
+        n = len(data)
+        with self._lock:
+            keep = data[n - self.ring_size:] if n > self.ring_size else data
+            pos = (self.total + n - len(keep)) % self.ring_size
+            first = min(len(keep), self.ring_size - pos)
+            self.ring[pos:pos + first] = keep[:first]
+            self.ring[:len(keep) - first] = keep[first:]
+            self.total += n
+            if self.clip is not None:
+                self.clip.writeframesraw(data)
+        for callback in self._listeners:
+            try:
+                callback(data)
+            except Exception as e:
+                print(f"Capture listener failed: {e}")
+
+    def _ring_since(self, offset):
+        """Bytes from stream offset `offset` to now; the caller holds the lock."""
+        start = offset % self.ring_size
+        end = self.total % self.ring_size
+        if self.total - offset == self.ring_size:
+            return bytes(self.ring[start:]) + bytes(self.ring[:start])
+        if start <= end:
+            return bytes(self.ring[start:end])
+        return bytes(self.ring[start:]) + bytes(self.ring[:end])
+
+    # ========== Clips ==========
+    def start_clip(self, path, preroll=None):
+        """
+        Start recording to `path`, beginning `preroll` seconds (default: the
+        whole ring) before now. Returns the pre-roll actually included.
+        """
+        with self._lock:
+            self._close_clip()
+            want = self.ring_size if preroll is None else int(preroll * self.rate) * self.frame_bytes
+            oldest = self.total - min(self.ring_size, self.total)
+            offset = max(oldest, self.total - want)
+            # Start on a frame boundary: the one before, unless the ring no longer holds it
+            offset -= offset % self.frame_bytes
+            if offset < oldest:
+                offset += self.frame_bytes
+            offset = min(offset, self.total)
+            clip = wave.open(path, "wb")
+            clip.setnchannels(self.channels)
+            clip.setsampwidth(SAMPLE_BYTES)
+            clip.setframerate(self.rate)
+            clip.writeframesraw(self._ring_since(offset))
+            self.clip, self.clip_path, self.clip_start = clip, path, offset
+            return (self.total - offset) / self.bytes_per_second
+
+    def stop_clip(self, end=None):
+        """
+        Finish the recording; returns (path, seconds), or (None, 0) if none was
+        running. `end` (stream seconds since start(), e.g. where a stop keyword
+        began) drops what was recorded after it.
+        """
+        with self._lock:
+            if self.clip is None:
+                return None, 0.0
+            stop = self.total
+            if end is not None:
+                stop = min(stop, max(self.clip_start, int(end * self.rate) * self.frame_bytes))
+            path, frames = self.clip_path, (stop - self.clip_start) // self.frame_bytes
+            self._close_clip()
+        if stop < self.total:
+            _truncate_wav(path, frames)
+        CLIPS.inc()
+        return path, frames * self.frame_bytes / self.bytes_per_second
+
+    def _close_clip(self):
+        if self.clip is not None:
+            self.clip.close()
+            self.clip = None
+
+    def stats(self):
+        with self._lock:
+            return {
+                "seconds_captured": round(self.total / self.bytes_per_second, 1),
+                "ring_bytes": self.ring_size,
+                "chunk_bytes": len(self.chunk),
+                "restarts": self.restarts,
+                "recording": self.clip is not None,
+            }
+
+
+def _truncate_wav(path, frames):
+    """Rewrite the WAV at `path` keeping only its first `frames` frames."""
+    with wave.open(path, "rb") as wav:
+        params = wav.getparams()
+        data = wav.readframes(frames)
+    with wave.open(path, "wb") as wav:
+        wav.setparams(params)
+        wav.writeframes(data)
+
+
+# ========== Cost measurement ==========
+def _rss_bytes(pid="self"):
+    try:
+        with open(f"/proc/{pid}/status") as f:
+            for line in f:
+                if line.startswith("VmRSS:"):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+    return None
+
+
+def _cpu_seconds(pid):
+    """utime + stime of another process, from /proc."""
+    try:
+        with open(f"/proc/{pid}/stat") as f:
+            fields = f.read().rsplit(")", 1)[1].split()
+        return (int(fields[11]) + int(fields[12])) / os.sysconf("SC_CLK_TCK")
+    except (OSError, IndexError, ValueError):
+        return None
+
+
+def measure_cost(capture, seconds):
+    """CPU share and resident memory of the running capture while nothing else happens."""
+    rss_before = _rss_bytes()
+    capture.start()
+    time.sleep(1.0)  # let arecord open the device and the ring fill once
+    child = capture.process.pid if capture.process else None
+    cpu, child_cpu, wall = time.process_time(), child and _cpu_seconds(child), time.monotonic()
+    time.sleep(seconds)
+    wall = time.monotonic() - wall
+    cpu = time.process_time() - cpu
+    report = {
+        "seconds": round(wall, 1),
+        "process_cpu_percent": round(cpu / wall * 100, 2),
+        "rss_increase_bytes": (_rss_bytes() - rss_before) if rss_before else None,
+    }
+    child_cpu_after = _cpu_seconds(child) if child else None
+    if child_cpu_after is not None and child_cpu is not None:
+        report["arecord_cpu_percent"] = round((child_cpu_after - child_cpu) / wall * 100, 2)
+        report["arecord_rss_bytes"] = _rss_bytes(child)
+    report.update(capture.stats())
+    capture.stop()
+    return report
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Measure the idle cost of the always-on capture")
+    parser.add_argument("command", choices=("cost",))
+    parser.add_argument("--seconds", type=float, default=10)
+    parser.add_argument("--preroll", type=float, default=PREROLL_SECONDS)
+    parser.add_argument("--synthetic", action="store_true", help="Read a generated stream instead of arecord")
+    args = parser.parse_args()
+    capture = PrerollCapture(args.preroll, source=SyntheticSource() if args.synthetic else None)
+    print(json.dumps(measure_cost(capture, args.seconds), indent=2))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,141 @@
+import os
+import json
+import re
+import threading
+import time
+from collections import deque
+
+CONVERSATION_FILE = "data/conversation.json"
+SUMMARY_SNIPPET_CHARS = 160
+# Openers and pronouns that only make sense against the turns before them
+FOLLOW_UP = re.compile(
+    r"^\s*(and|but|so|also|then|why|what about|how about|tell me more)\b"
+    r"|\b(it|its|that|this|these|those|they|them|their|he|she|him|her|more|else|again|another|instead)\b",
+    re.IGNORECASE)
+
+
+def estimate_tokens(text):
+    """Rough token count (~4 characters per token), good enough for budgeting."""
+    return len(text) // 4 + 1
+
+
+def is_follow_up(question):
+    """True if the question probably leans on earlier turns ("and on Windows?", "why is that?")."""
+    return bool(FOLLOW_UP.search(question))
+
+
+def compact(text, limit=SUMMARY_SNIPPET_CHARS):
+    """Collapse whitespace and code blocks so a turn fits in the running summary."""
+    text = re.sub(r"```.*?```", "[code]", text, flags=re.DOTALL)
+    text = " ".join(text.split())
+    return text if len(text) <= limit else text[:limit - 3] + "..."
+
+
+class ConversationStore:
+    """
+    Recent turns of the current conversation, kept in a fixed-size ring and
+    persisted to a small JSON file so a session survives restarts.
+    contents() returns only as much history as fits the token budget; older
+    turns are folded into a compact summary instead of being resent verbatim.
+    """
+
+    def __init__(self, path=CONVERSATION_FILE, max_turns=16, token_budget=2000, session_timeout=600):
+        self.path = path
+        self.max_turns = max_turns
+        self.token_budget = token_budget
+        self.session_timeout = session_timeout
+        self.turns = deque(maxlen=max_turns)
+        self.summary = ""
+        self.updated_at = 0
+        self._lock = threading.Lock()
+        self._load()
+
+    def _load(self):
+        try:
+            with open(self.path, "r") as f:
+                state = json.load(f)
+        except (OSError, ValueError):
+            return
+        self.turns.extend(state.get("turns", []))
+        self.summary = state.get("summary", "")
+        self.updated_at = state.get("updated_at", 0)
+
+    def _save(self):
+        tmp_path = self.path + ".tmp"
+        try:
+            with open(tmp_path, "w") as f:
+                json.dump({"turns": list(self.turns), "summary": self.summary,
+                           "updated_at": self.updated_at}, f)
+            os.replace(tmp_path, self.path)
+        except OSError as e:
+            print(f"Failed to save conversation: {e}")
+
+    def _expire(self):
+        if self.updated_at and time.time() - self.updated_at > self.session_timeout:
+            self.turns.clear()
+            self.summary = ""
+
+    def _fold(self, turn):
+        """Add a turn that no longer fits the budget to the summary."""
+        who = "User" if turn["role"] == "user" else "Assistant"
+        self.summary = f"{self.summary} {who}: {compact(turn['text'])}".strip()
+        max_chars = self.token_budget  # summary gets at most ~1/4 of the budget
+        if len(self.summary) > max_chars:
+            self.summary = "..." + self.summary[-(max_chars - 3):]
+
+    def add_exchange(self, question, answer):
+        with self._lock:
+            self._expire()
+            for role, text in (("user", question), ("model", answer)):
+                if len(self.turns) == self.turns.maxlen:
+                    self._fold(self.turns[0])
+                self.turns.append({"role": role, "text": text})
+            self.updated_at = time.time()
+            self._save()
+
+    def active(self):
+        """True while the conversation has turns that haven't timed out."""
+        with self._lock:
+            self._expire()
+            return bool(self.turns or self.summary)
+
+    def reset(self):
+        with self._lock:
+            self.turns.clear()
+            self.summary = ""
+            self.updated_at = 0
+            self._save()
+
+    def contents(self, question):
+        """Build generateContent `contents`: summary, recent turns within budget, then the new question."""
+        with self._lock:
+            self._expire()
+            # A quarter of the budget is reserved for the summary (capped at token_budget chars)
+            budget = self.token_budget - estimate_tokens(question) - self.token_budget // 4
+            history = []
+            turns = list(self.turns)
+            # Walk back in (user, model) pairs so roles keep alternating
+            i = len(turns)
+            while i >= 2:
+                pair = turns[i - 2:i]
+                cost = sum(estimate_tokens(t["text"]) for t in pair)
+                if cost > budget:
+                    break
+                budget -= cost
+                history[:0] = pair
+                i -= 2
+            # Older turns that did not fit: summarize rather than drop
+            skipped = " ".join(
+                f"{'User' if t['role'] == 'user' else 'Assistant'}: {compact(t['text'])}" for t in turns[:i])
+            summary = f"{self.summary} {skipped}".strip()
+            if len(summary) > self.token_budget:
+                summary = "..." + summary[-(self.token_budget - 3):]
+
+        contents = []
+        if summary:
+            contents.append({"role": "user", "parts": [{"text": f"Summary of our earlier conversation: {summary}"}]})
+            contents.append({"role": "model", "parts": [{"text": "Understood."}]})
+        for turn in history:
+            contents.append({"role": turn["role"], "parts": [{"text": turn["text"]}]})
+        contents.append({"role": "user", "parts": [{"text": question}]})
+        return contents
@@ -1,7 +1,16 @@
 import RPi.GPIO as GPIO
 import spidev
+import threading
 import time
 
+try:
+    from metrics import counter
+    _spi_bytes = counter("odin_spi_bytes_total", "Bytes written to the LCD over SPI")
+    _draw_calls = counter("odin_display_draws_total", "draw_image/fill_screen calls")
+except ImportError:
+    # 驱动可脱离主程序单独使用，此时不统计
+    _spi_bytes = _draw_calls = None
+
 
 class WhisPlayBoard:
     # LCD 参数
@@ -41,6 +50,7 @@ class WhisPlayBoard:
         self.green_pwm.start(0)
         self.blue_pwm.start(0)
         self.backlight_pwm = None
+        self._led_effects = None
 
         # 初始化按键
         GPIO.setup(self.BUTTON_PIN, GPIO.IN, pull_up_down=GPIO.PUD_UP)
@@ -57,6 +67,9 @@ class WhisPlayBoard:
         self.spi.mode = 0b00
 
         self.previous_frame = None
+        self._draw_lock = threading.RLock()  # 窗口设置与像素写入须成对完成
+        self._sleeping = False
+        self._sleep_changed_at = 0.0  # 上次 SLPIN/SLPOUT 的时间，两者间隔须 >= 120ms
         # 检测硬件版本并设置背光模式
         self._detect_hardware_version()
         self._detect_wm8960()
@@ -215,6 +228,8 @@ class WhisPlayBoard:
 
     def _send_data(self, data):
         GPIO.output(self.DC_PIN, GPIO.HIGH)
+        if _spi_bytes is not None:
+            _spi_bytes.inc(len(data))
         
         try:
             self.spi.writebytes2(data)
@@ -264,19 +279,69 @@ class WhisPlayBoard:
                 y0 += sy
 
     def fill_screen(self, color):
-        self.set_window(0, 0, self.LCD_WIDTH - 1, self.LCD_HEIGHT - 1)
-        buffer = []
-        high = (color >> 8) & 0xFF
-        low = color & 0xFF
-        for _ in range(self.LCD_WIDTH * self.LCD_HEIGHT):
-            buffer.extend([high, low])
-        self._send_data(buffer)
+        # 直接生成 bytes，避免构造 13 万项的 int 列表
+        buffer = bytes(((color >> 8) & 0xFF, color & 0xFF)) * (self.LCD_WIDTH * self.LCD_HEIGHT)
+        if _draw_calls is not None:
+            _draw_calls.inc()
+        with self._draw_lock:
+            self.set_window(0, 0, self.LCD_WIDTH - 1, self.LCD_HEIGHT - 1)
+            self._send_data(buffer)
 
     def draw_image(self, x, y, width, height, pixel_data):
         if (x + width > self.LCD_WIDTH) or (y + height > self.LCD_HEIGHT):
             raise ValueError("图像尺寸超出屏幕范围")
-        self.set_window(x, y, x + width - 1, y + height - 1)
-        self._send_data(pixel_data)
+        if _draw_calls is not None:
+            _draw_calls.inc()
+        with self._draw_lock:
+            self.set_window(x, y, x + width - 1, y + height - 1)
+            self._send_data(pixel_data)
+
+    # ========== 省电模式 ==========
+    FRAME_RATE_60HZ = 0x0F
+    FRAME_RATE_39HZ = 0x1F  # FRCTRL2 可设的最低刷新率
+
+    @property
+    def sleeping(self):
+        return self._sleeping
+
+    def set_frame_rate(self, rtna):
+        """正常模式刷新率 (FRCTRL2 0xC6)，刷新越慢面板功耗越低"""
+        with self._draw_lock:
+            self._send_command(0xC6, rtna)
+
+    def set_idle_mode(self, enabled):
+        """空闲模式 (IDMON 0x39 / IDMOFF 0x38)：只显示 8 色，降低面板功耗"""
+        with self._draw_lock:
+            self._send_command(0x39 if enabled else 0x38)
+
+    def sleep(self):
+        """关显示并进入睡眠 (DISPOFF 0x28, SLPIN 0x10)，显存内容保留，睡眠中仍可写入"""
+        with self._draw_lock:
+            if self._sleeping:
+                return
+            self._wait_sleep_interval()
+            self._send_command(0x28)
+            self._send_command(0x10)
+            self._sleep_changed_at = time.monotonic()
+            self._sleeping = True
+        time.sleep(0.005)
+
+    def wake(self):
+        """退出睡眠 (SLPOUT 0x11) 并开显示 (DISPON 0x29)，最长耗时约 125ms"""
+        with self._draw_lock:
+            if not self._sleeping:
+                return
+            self._wait_sleep_interval()
+            self._send_command(0x11)
+            self._sleep_changed_at = time.monotonic()
+            self._sleeping = False
+            time.sleep(0.005)  # SLPOUT 后需等待 5ms 才能发送下一条命令
+            self._send_command(0x29)
+
+    def _wait_sleep_interval(self):
+        remaining = self._sleep_changed_at + 0.12 - time.monotonic()
+        if remaining > 0:
+            time.sleep(remaining)
 
     # ========== RGB 与按键 ==========
     def set_rgb(self, r, g, b):
@@ -287,24 +352,19 @@ class WhisPlayBoard:
         self._current_g = g
         self._current_b = b
 
-    def set_rgb_fade(self, r_target, g_target, b_target, duration_ms=100):
-        steps = 20  # 可以调整步数来控制渐变的平滑度
-        delay_ms = duration_ms / steps
-
-        r_step = (r_target - self._current_r) / steps
-        g_step = (g_target - self._current_g) / steps
-        b_step = (b_target - self._current_b) / steps
-
-        for _ in range(steps + 1):
-            r_interim = int(self._current_r + _ * r_step)
-            g_interim = int(self._current_g + _ * g_step)
-            b_interim = int(self._current_b + _ * b_step)
-            self.set_rgb(
-                max(0, min(255, r_interim)),
-                max(0, min(255, g_interim)),
-                max(0, min(255, b_interim)),
-            )
-            time.sleep(delay_ms / 1000.0)
+    def set_rgb_fade(self, r_target, g_target, b_target, duration_ms=100, blocking=True):
+        effect = LedEffect.fade(r_target, g_target, b_target, duration_ms)
+        self.led_effects.play(effect)
+        if blocking:
+            effect.wait()
+        return effect
+
+    @property
+    def led_effects(self):
+        """RGB 灯效引擎，首次使用时启动后台线程"""
+        if self._led_effects is None:
+            self._led_effects = LedEffectEngine(self)
+        return self._led_effects
 
     def button_pressed(self):
         return GPIO.input(self.BUTTON_PIN) == 1
@@ -334,6 +394,8 @@ class WhisPlayBoard:
 
     # ========== 清理 ==========
     def cleanup(self):
+        if self._led_effects is not None:
+            self._led_effects.stop()
         # 清理代码中添加对 backlight_pwm 的处理
         if self.backlight_pwm is not None:
             self.backlight_pwm.stop()
@@ -342,3 +404,130 @@ class WhisPlayBoard:
         self.green_pwm.stop()
         self.blue_pwm.stop()
         GPIO.cleanup()
+
+
+class LedEffect:
+    """
+    由关键帧组成的灯效：每帧 (r, g, b, duration_ms, fade)，
+    fade 为 True 时从上一帧颜色线性过渡，否则立即切换并保持。
+    repeat 为 None 时无限循环。
+    """
+
+    def __init__(self, keyframes, repeat=1):
+        self.keyframes = [(r, g, b, duration_ms / 1000.0, fade) for r, g, b, duration_ms, fade in keyframes]
+        self.repeat = repeat
+        self.cycle = sum(k[3] for k in self.keyframes)
+        self.start_color = (0, 0, 0)
+        self.started_at = None
+        self._done = threading.Event()
+
+    @classmethod
+    def solid(cls, r, g, b):
+        return cls([(r, g, b, 0, False)])
+
+    @classmethod
+    def fade(cls, r, g, b, duration_ms=100):
+        return cls([(r, g, b, duration_ms, True)])
+
+    @classmethod
+    def pulse(cls, r, g, b, period_ms=1000, repeat=None):
+        half = period_ms / 2
+        return cls([(r, g, b, half, True), (0, 0, 0, half, True)], repeat=repeat)
+
+    @classmethod
+    def blink(cls, r, g, b, on_ms=200, off_ms=200, repeat=3):
+        return cls([(r, g, b, on_ms, False), (0, 0, 0, off_ms, False)], repeat=repeat)
+
+    @classmethod
+    def sequence(cls, keyframes, repeat=1):
+        return cls(keyframes, repeat=repeat)
+
+    @property
+    def done(self):
+        return self._done.is_set()
+
+    def wait(self, timeout=None):
+        return self._done.wait(timeout)
+
+    def color_at(self, elapsed):
+        """返回 (颜色, 是否结束)"""
+        if self.cycle <= 0:
+            r, g, b = self.keyframes[-1][:3]
+            return (r, g, b), True
+        if self.repeat is not None and elapsed >= self.cycle * self.repeat:
+            r, g, b = self.keyframes[-1][:3]
+            return (r, g, b), True
+        t = elapsed % self.cycle
+        # 第一轮从启动时的颜色过渡，后续从上一轮最后一帧过渡
+        prev = self.start_color if elapsed < self.cycle else self.keyframes[-1][:3]
+        for r, g, b, duration, fade in self.keyframes:
+            if t < duration:
+                if not fade:
+                    return (r, g, b), False
+                k = t / duration
+                return tuple(int(p + (c - p) * k) for p, c in zip(prev, (r, g, b))), False
+            t -= duration
+            prev = (r, g, b)
+        return prev, False
+
+
+class LedEffectEngine:
+    """
+    在独立线程上驱动 RGB 灯效，调用方不会被阻塞。
+    play() 会替换当前灯效，cancel() 停止并保持当前颜色。
+    """
+
+    TICK_S = 0.02
+
+    def __init__(self, board):
+        self.board = board
+        self.current = None
+        self._cond = threading.Condition()
+        self._running = True
+        self._thread = threading.Thread(target=self._run, name="led-effects", daemon=True)
+        self._thread.start()
+
+    def play(self, effect):
+        with self._cond:
+            if self.current is not None:
+                self.current._done.set()
+            effect.start_color = (self.board._current_r, self.board._current_g, self.board._current_b)
+            effect.started_at = time.monotonic()
+            self.current = effect
+            self._cond.notify()
+        return effect
+
+    def cancel(self, off=False):
+        with self._cond:
+            if self.current is not None:
+                self.current._done.set()
+                self.current = None
+            if off:
+                self.board.set_rgb(0, 0, 0)
+
+    def stop(self):
+        with self._cond:
+            self._running = False
+            self._cond.notify()
+        self._thread.join(timeout=1)
+
+    def _run(self):
+        while True:
+            with self._cond:
+                while self._running and self.current is None:
+                    self._cond.wait()
+                if not self._running:
+                    return
+                effect = self.current
+                color, finished = effect.color_at(time.monotonic() - effect.started_at)
+                if finished:
+                    self.current = None
+                # 在锁内写入，play()/cancel() 之后不会再被旧灯效的颜色覆盖
+                if color != (self.board._current_r, self.board._current_g, self.board._current_b):
+                    self.board.set_rgb(*color)
+            if finished:
+                effect._done.set()
+                continue
+            with self._cond:
+                if self.current is effect and self._running:
+                    self._cond.wait(self.TICK_S)
@@ -0,0 +1,202 @@
+"""
+Shared-memory framebuffer between the renderers and the panel.
+
+SharedFramebuffer looks like a board to the compositor and the remote display
+server: draw_image() copies the RGB565 big-endian pixels into a
+multiprocessing.shared_memory block and returns at memory speed. A
+FramePresenter thread in the process that owns WhisPlayBoard pushes the changed
+rectangles to the panel, so rendering never waits on SPI, and rectangles drawn
+faster than the panel takes them are merged into one transfer.
+
+The block is named, so other processes can attach to it read-only, for example
+to grab what a running unit is showing:
+
+    python framebuffer.py screenshot screen.png
+
+Writes must come from the owning process; they are serialized by a lock that
+other processes can't see.
+"""
+import sys
+import threading
+from multiprocessing import resource_tracker, shared_memory
+
+import numpy as np
+
+from metrics import counter
+
+FRAMEBUFFER_NAME = "odin_framebuffer"
+LCD_WIDTH = 240
+LCD_HEIGHT = 280
+
+PANEL_FRAMES = counter("odin_display_frames_total", "Frames or partial updates pushed to the panel",
+                       ("source",)).labels(source="framebuffer")
+MERGED_RECTS = counter("odin_frames_dropped_total", "Frames superseded before reaching the panel",
+                       ("source",)).labels(source="framebuffer")
+
+
+def _attach(name):
+    """Open an existing block without this process's resource tracker unlinking it at exit."""
+    shm = shared_memory.SharedMemory(name=name)
+    try:
+        resource_tracker.unregister(shm._name, "shared_memory")
+    except (AttributeError, KeyError):
+        pass
+    return shm
+
+
+def merge_rects(rects):
+    """Replace every group of overlapping or touching (x, y, w, h) rectangles by its bounding box."""
+    merged = []
+    for rect in rects:
+        x0, y0, x1, y1 = rect[0], rect[1], rect[0] + rect[2], rect[1] + rect[3]
+        i = 0
+        while i < len(merged):
+            mx0, my0, mx1, my1 = merged[i]
+            if x0 <= mx1 and mx0 <= x1 and y0 <= my1 and my0 <= y1:
+                x0, y0, x1, y1 = min(x0, mx0), min(y0, my0), max(x1, mx1), max(y1, my1)
+                merged.pop(i)
+                i = 0
+            else:
+                i += 1
+        merged.append((x0, y0, x1, y1))
+    return [(x0, y0, x1 - x0, y1 - y0) for x0, y0, x1, y1 in merged]
+
+
+class SharedFramebuffer:
+    """A board-compatible RGB565 surface in shared memory (create=False attaches to an existing one)."""
+
+    def __init__(self, width=LCD_WIDTH, height=LCD_HEIGHT, name=FRAMEBUFFER_NAME, create=True):
+        self.LCD_WIDTH = width
+        self.LCD_HEIGHT = height
+        self.owner = create
+        size = width * height * 2
+        if create:
+            try:
+                self.shm = shared_memory.SharedMemory(name=name, create=True, size=size)
+            except FileExistsError:
+                # Left behind by a unit that was killed
+                stale = _attach(name)
+                stale.close()
+                stale.unlink()
+                self.shm = shared_memory.SharedMemory(name=name, create=True, size=size)
+        else:
+            self.shm = _attach(name)
+        self.name = self.shm.name
+        self.pixels = np.ndarray((height, width), dtype=">u2", buffer=self.shm.buf)
+        if create:
+            self.pixels[:] = 0
+        self.writes = 0
+        self.taken = 0  # writes covered by the rectangles handed out so far
+        self._pending = []
+        self._closed = False
+        self._cond = threading.Condition()
+
+    def draw_image(self, x, y, width, height, pixel_data):
+        region = np.frombuffer(pixel_data, dtype=">u2").reshape(height, width)
+        with self._cond:
+            self.pixels[y:y + height, x:x + width] = region
+            self._pending.append((x, y, width, height))
+            self.writes += 1
+            self._cond.notify()
+
+    def take(self, timeout=None):
+        """
+        Wait for drawn rectangles and return them merged, each as
+        (x, y, w, h, pixel bytes); [] on timeout or once closed.
+        """
+        with self._cond:
+            if not self._cond.wait_for(lambda: self._pending or self._closed, timeout) or self._closed:
+                return []
+            rects = merge_rects(self._pending)
+            MERGED_RECTS.inc(len(self._pending) - len(rects))
+            self._pending = []
+            self.taken = self.writes
+            return [(x, y, w, h, self.pixels[y:y + h, x:x + w].tobytes()) for x, y, w, h in rects]
+
+    def pending(self):
+        with self._cond:
+            return len(self._pending)
+
+    def snapshot(self):
+        """Copy of the current frame as an HxW uint16 array."""
+        with self._cond:
+            return self.pixels.astype(np.uint16)
+
+    def close(self):
+        with self._cond:
+            self._closed = True
+            self._cond.notify_all()
+        self.pixels = None
+        self.shm.close()
+        if self.owner:
+            self.shm.unlink()
+
+
+class FramePresenter:
+    """Thread that copies what is drawn into `framebuffer` to `board`."""
+
+    def __init__(self, framebuffer, board):
+        self.framebuffer = framebuffer
+        self.board = board
+        self.transfers = 0
+        self.bytes_sent = 0
+        self.presented = 0
+        self._running = False
+        self._cond = threading.Condition()
+        self._thread = None
+
+    def start(self):
+        self._running = True
+        self._thread = threading.Thread(target=self._run, name="presenter", daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        """Push what is still pending, then stop."""
+        self.flush(timeout=1.0)
+        self._running = False
+        if self._thread:
+            self._thread.join(timeout=2)
+
+    def flush(self, timeout=None):
+        """Wait until everything drawn so far has reached the panel; False on timeout."""
+        target = self.framebuffer.writes
+        with self._cond:
+            return self._cond.wait_for(lambda: self.presented >= target, timeout)
+
+    def _run(self):
+        while self._running:
+            rects = self.framebuffer.take(timeout=0.5)
+            if not rects:
+                continue
+            taken = self.framebuffer.taken
+            try:
+                for x, y, w, h, data in rects:
+                    self.board.draw_image(x, y, w, h, data)
+                    self.transfers += 1
+                    self.bytes_sent += len(data)
+                    PANEL_FRAMES.inc()
+            except Exception as e:
+                print(f"Presenter: panel write failed: {e}")
+            with self._cond:
+                self.presented = taken
+                self._cond.notify_all()
+
+
+def main():
+    if len(sys.argv) != 3 or sys.argv[1] != "screenshot":
+        sys.exit("usage: framebuffer.py screenshot OUT.png")
+    from PIL import Image
+    try:
+        framebuffer = SharedFramebuffer(create=False)
+    except FileNotFoundError:
+        sys.exit(f"No framebuffer named {FRAMEBUFFER_NAME}; is OdinSpecter running?")
+    rgb565 = framebuffer.pixels.astype(np.uint16)
+    framebuffer.close()
+    rgb = np.dstack([((rgb565 >> 11) & 0x1F) << 3, ((rgb565 >> 5) & 0x3F) << 2, (rgb565 & 0x1F) << 3])
+    Image.fromarray(rgb.astype(np.uint8), "RGB").save(sys.argv[2])
+    print(f"Saved {sys.argv[2]}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,432 @@
+"""
+LAN gateway shared by several OdinSpecter devices.
+
+It speaks the same REST paths gemini.py uses (resumable upload, cachedContents,
+generateContent), so a device switches over by setting
+
+    "API_BASE": "http://<gateway-host>:8766"
+
+in its config.json. The gateway keeps a pool of warm upstream connections,
+collapses identical in-flight requests from different devices into one upstream
+call, answers repeats from a shared response cache and applies one rate limit
+to everything it sends upstream.
+
+Each request goes upstream with the API key its device sent. The gateway's own
+GEMINI_API_KEY is only lent to devices that send GATEWAY_TOKEN as their key,
+so a device on the fleet key sets
+
+    "GEMINI_API_KEY": "<GATEWAY_TOKEN>"
+
+Requests without a key are refused. The gateway listens on loopback unless
+GATEWAY_HOST (or --host) names the LAN address to serve.
+
+    python gateway.py --port 8766
+"""
+import argparse
+import hashlib
+import hmac
+import json
+import threading
+import time
+import uuid
+from collections import OrderedDict
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import requests
+from requests.adapters import HTTPAdapter
+
+from quota import retry_after_seconds
+
+DEFAULT_UPSTREAM = "https://generativelanguage.googleapis.com"
+DEFAULT_HOST = "127.0.0.1"
+FORWARD_REQUEST_HEADERS = ("content-type",)
+FORWARD_RESPONSE_HEADERS = ("content-type", "retry-after")
+UPLOAD_SESSION_TTL = 3600
+
+
+class ResponseCache:
+    """Byte-budgeted LRU of upstream responses, each with its own expiry."""
+
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self.current_bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()  # key -> (expires_at, response)
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None or entry[0] < time.time():
+                if entry is not None:
+                    self._remove(key)
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return entry[1]
+
+    def put(self, key, response, ttl):
+        size = len(response[2])
+        with self._lock:
+            if key in self._entries:
+                self._remove(key)
+            if size > self.max_bytes:
+                return
+            self._entries[key] = (time.time() + ttl, response)
+            self.current_bytes += size
+            while self.current_bytes > self.max_bytes:
+                oldest = next(iter(self._entries))
+                self._remove(oldest)
+
+    def _remove(self, key):
+        _, response = self._entries.pop(key)
+        self.current_bytes -= len(response[2])
+
+    def stats(self):
+        with self._lock:
+            return {"entries": len(self._entries), "bytes": self.current_bytes,
+                    "hits": self.hits, "misses": self.misses}
+
+
+class _Flight:
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+
+
+class Coalescer:
+    """Concurrent calls with the same key share the first caller's upstream request."""
+
+    def __init__(self):
+        self.coalesced = 0
+        self._flights = {}
+        self._lock = threading.Lock()
+
+    def run(self, key, fn, timeout):
+        with self._lock:
+            flight = self._flights.get(key)
+            leader = flight is None
+            if leader:
+                flight = self._flights[key] = _Flight()
+            else:
+                self.coalesced += 1
+        if not leader:
+            if not flight.done.wait(timeout):
+                raise TimeoutError("coalesced request timed out")
+            if flight.error is not None:
+                raise flight.error
+            return flight.result
+        try:
+            flight.result = fn()
+            return flight.result
+        except Exception as e:
+            flight.error = e
+            raise
+        finally:
+            with self._lock:
+                del self._flights[key]
+            flight.done.set()
+
+
+class TokenBucket:
+    """
+    Global upstream rate limit: `rate` requests per minute with bursts up to
+    `burst`; a rate of 0 means unlimited. hold() stops everything for as long as
+    upstream asked in a 429.
+    """
+
+    def __init__(self, rate, burst=None):
+        if rate < 0:
+            raise ValueError(f"rate limit must be 0 (unlimited) or more, not {rate}")
+        self.rate = rate / 60.0
+        self.capacity = burst or max(1, rate // 6)
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+        self.blocked_until = 0.0
+        self.throttled = 0
+        self._lock = threading.Lock()
+
+    def hold(self, seconds):
+        with self._lock:
+            self.blocked_until = max(self.blocked_until, time.monotonic() + seconds)
+
+    def _refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def acquire(self, timeout):
+        """Take one token, waiting up to `timeout` seconds. Returns 0 or the seconds still to wait."""
+        give_up_at = time.monotonic() + timeout
+        while True:
+            with self._lock:
+                wait = self.blocked_until - time.monotonic()
+                if wait <= 0:
+                    if not self.rate:
+                        return 0
+                    self._refill()
+                    if self.tokens >= 1:
+                        self.tokens -= 1
+                        return 0
+                    wait = (1 - self.tokens) / self.rate
+            if time.monotonic() + wait > give_up_at:
+                with self._lock:
+                    self.throttled += 1
+                return wait
+            time.sleep(wait)
+
+
+class GatewayHandler(BaseHTTPRequestHandler):
+    server_version = "OdinGateway/1.0"
+    protocol_version = "HTTP/1.1"
+
+    def log_message(self, format, *args):
+        pass
+
+    def _read_body(self):
+        length = int(self.headers.get("Content-Length") or 0)
+        return self.rfile.read(length) if length else b""
+
+    def _upstream_headers(self, require_key=True):
+        """Headers to send upstream, or None (after answering 401) if the device sent no key."""
+        headers = {k: v for k, v in self.headers.items()
+                   if k.lower() in FORWARD_REQUEST_HEADERS or k.lower().startswith("x-goog-upload-")}
+        api_key = self.server.upstream_key(self.headers.get("x-goog-api-key"))
+        if not api_key:
+            if not require_key:
+                return headers
+            self._send_json(401, {"error": {"code": 401, "message": "x-goog-api-key required"}})
+            return None
+        headers["x-goog-api-key"] = api_key
+        return headers
+
+    def _send(self, status, headers, body):
+        try:
+            self.send_response(status)
+            for key, value in headers.items():
+                self.send_header(key, value)
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+        except (BrokenPipeError, ConnectionResetError):
+            pass
+
+    def _send_json(self, status, body):
+        self._send(status, {"Content-Type": "application/json"}, json.dumps(body).encode("utf-8"))
+
+    def do_GET(self):
+        if self.path == "/gateway/stats":
+            self._send_json(200, self.server.stats())
+        else:
+            self._send_json(404, {"error": {"code": 404, "message": self.path}})
+
+    def do_PATCH(self):
+        body = self._read_body()
+        headers = self._upstream_headers()
+        if headers is not None:
+            self._send(*self.server.forward("PATCH", self.path, headers, body))
+
+    def do_POST(self):
+        body = self._read_body()
+        path = self.path.split("?")[0]
+        # An upload session URL is its own credential: chunks and offset queries carry no key
+        headers = self._upstream_headers(require_key=not path.startswith("/_upload/"))
+        if headers is None:
+            return
+        if path == "/upload/v1beta/files":
+            self._start_upload(headers, body)
+        elif path.startswith("/_upload/"):
+            upload_url = self.server.upload_url(path.rsplit("/", 1)[-1])
+            if upload_url is None:
+                self._send_json(404, {"error": {"code": 404, "message": "unknown upload session"}})
+                return
+            self._send(*self.server.forward("POST", upload_url, headers, body))
+        elif path == "/v1beta/cachedContents":
+            ttl = self._cached_content_ttl(body)
+            self._send(*self.server.shared("POST", self.path, headers, body, ttl))
+        elif path.endswith(":generateContent"):
+            self._send(*self.server.shared("POST", self.path, headers, body, self._generate_ttl(body)))
+        else:
+            self._send(*self.server.forward("POST", self.path, headers, body))
+
+    def _start_upload(self, headers, body):
+        status, response_headers, response_body = self.server.forward("POST", self.path, headers, body)
+        upstream_url = response_headers.pop("x-goog-upload-url", None)
+        if upstream_url:
+            # Later chunks and offset queries come back through the gateway
+            upload_id = self.server.register_upload(upstream_url)
+            response_headers["x-goog-upload-url"] = f"http://{self.headers['Host']}/_upload/{upload_id}"
+        self._send(status, response_headers, response_body)
+
+    def _cached_content_ttl(self, body):
+        """Share a guardrail cache between devices until shortly before it expires upstream."""
+        try:
+            ttl = float(json.loads(body).get("ttl", "0s").rstrip("s"))
+        except (ValueError, AttributeError):
+            return 0
+        return max(0, ttl - 300)
+
+    def _generate_ttl(self, body):
+        try:
+            request = json.loads(body)
+        except ValueError:
+            return 0
+        if "AUDIO" in request.get("generationConfig", {}).get("responseModalities", []):
+            return self.server.tts_ttl
+        parts = [p for c in request.get("contents", []) for p in c.get("parts", [])]
+        if any("file_data" in p or "inline_data" in p for p in parts):
+            # Transcription of a unique recording, never repeated
+            return 0
+        return self.server.answer_ttl
+
+
+class Gateway(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(self, host=DEFAULT_HOST, port=8766, upstream=DEFAULT_UPSTREAM, api_key=None, token=None,
+                 rate_limit=60, cache_bytes=64 * 1024 * 1024, answer_ttl=300, tts_ttl=86400,
+                 timeout=60, pool_size=16):
+        super().__init__((host, port), GatewayHandler)
+        self.upstream = upstream.rstrip("/")
+        self.api_key = api_key
+        self.token = token
+        if api_key and not token:
+            print("Gateway: no GATEWAY_TOKEN set, so GEMINI_API_KEY is never used; devices must send their own")
+        self.answer_ttl = answer_ttl
+        self.tts_ttl = tts_ttl
+        self.timeout = timeout
+        self.rate_wait = min(10, timeout)
+        self.cache = ResponseCache(cache_bytes)
+        self.coalescer = Coalescer()
+        self.limiter = TokenBucket(rate_limit)
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=4, pool_maxsize=pool_size)
+        self.session.mount("https://", adapter)
+        self.session.mount("http://", adapter)
+        self.counters = {"upstream": 0, "upstream_errors": 0}
+        self._uploads = {}  # upload id -> (upstream url, created_at)
+        self._lock = threading.Lock()
+        self._thread = None
+
+    def register_upload(self, upstream_url):
+        upload_id = uuid.uuid4().hex
+        now = time.time()
+        with self._lock:
+            for stale in [k for k, (_, created) in self._uploads.items() if now - created > UPLOAD_SESSION_TTL]:
+                del self._uploads[stale]
+            self._uploads[upload_id] = (upstream_url, now)
+        return upload_id
+
+    def upload_url(self, upload_id):
+        with self._lock:
+            entry = self._uploads.get(upload_id)
+        return entry[0] if entry else None
+
+    def upstream_key(self, device_key):
+        """The key to send upstream for a device's key: the gateway's own for the token, else the device's."""
+        if device_key and self.api_key and self.token and hmac.compare_digest(device_key, self.token):
+            return self.api_key
+        return device_key
+
+    def _count(self, key):
+        with self._lock:
+            self.counters[key] += 1
+
+    def forward(self, method, path, headers, body):
+        """Send one request upstream through the shared pool. Returns (status, headers, body)."""
+        wait = self.limiter.acquire(self.rate_wait)
+        if wait:
+            return self._error(429, "gateway rate limit", {"Retry-After": str(int(wait) + 1)})
+        url = path if path.startswith("http") else self.upstream + path
+        self._count("upstream")
+        try:
+            response = self.session.request(method, url, headers=headers, data=body, timeout=self.timeout)
+        except requests.RequestException as e:
+            self._count("upstream_errors")
+            return self._error(502, f"upstream unreachable: {e}")
+        if response.status_code == 429:
+            # Quota is per key, but the fleet mostly shares one: back everyone off rather than
+            # let the other devices spend their requests on more 429s
+            self.limiter.hold(retry_after_seconds(response))
+        response_headers = {k.lower(): v for k, v in response.headers.items()
+                            if k.lower() in FORWARD_RESPONSE_HEADERS or k.lower().startswith("x-goog-upload-")}
+        return response.status_code, response_headers, response.content
+
+    def shared(self, method, path, headers, body, ttl):
+        """
+        forward(), but served from the shared cache and coalesced across devices.
+        Only devices sending with the same API key share: an answer or a
+        cachedContents name created under one key is no use to another.
+        """
+        api_key = headers.get("x-goog-api-key", "")
+        key = hashlib.sha256(api_key.encode() + b"\n" + method.encode() + path.encode() + b"\n" + body).hexdigest()
+        if ttl > 0:
+            cached = self.cache.get(key)
+            if cached is not None:
+                return cached
+        try:
+            status, response_headers, response_body = self.coalescer.run(
+                key, lambda: self.forward(method, path, headers, body), self.timeout)
+        except TimeoutError as e:
+            return self._error(504, str(e))
+        if ttl > 0 and status == 200:
+            self.cache.put(key, (status, response_headers, response_body), ttl)
+        return status, response_headers, response_body
+
+    def _error(self, status, message, headers=None):
+        body = json.dumps({"error": {"code": status, "message": message}}).encode("utf-8")
+        return status, dict(headers or {}, **{"content-type": "application/json"}), body
+
+    def stats(self):
+        with self._lock:
+            counters = dict(self.counters, upload_sessions=len(self._uploads))
+        counters.update(coalesced=self.coalescer.coalesced, throttled=self.limiter.throttled,
+                        cache=self.cache.stats())
+        return counters
+
+    def start(self):
+        self._thread = threading.Thread(target=self.serve_forever, name="gateway", daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
+        self.session.close()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--host", help="Address to serve (default: GATEWAY_HOST, else loopback)")
+    parser.add_argument("--port", type=int, default=8766)
+    parser.add_argument("--config", default="config.json")
+    args = parser.parse_args()
+
+    with open(args.config, 'r') as file:
+        data = json.load(file)
+
+    host = args.host or data.get("GATEWAY_HOST") or DEFAULT_HOST
+    server = Gateway(
+        host, args.port,
+        upstream=data.get("GATEWAY_UPSTREAM", DEFAULT_UPSTREAM),
+        api_key=data.get("GEMINI_API_KEY") or None,
+        token=data.get("GATEWAY_TOKEN") or None,
+        rate_limit=data.get("GATEWAY_RATE_LIMIT", 60),
+        cache_bytes=data.get("GATEWAY_CACHE_BYTES", 64 * 1024 * 1024),
+        answer_ttl=data.get("GATEWAY_ANSWER_TTL", 300),
+        tts_ttl=data.get("GATEWAY_TTS_TTL", 86400),
+    )
+    print(f"Gateway listening on {host}:{args.port}, upstream {server.upstream}")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+
+
+if __name__ == "__main__":
+    main()
@@ -1,9 +1,24 @@
 import os
+import base64
+import sqlite3
 import json
 import requests
 import mimetypes
-import base64
-import subprocess
+import hashlib
+import shutil
+import threading
+import time
+import wave
+
+from utils import ImageUtils
+from metrics import counter, histogram
+from profiling import profiler
+from conversation import ConversationStore, is_follow_up
+from history import HistoryStore
+from router import ModelRouter, ModelUnavailable, SHORT_ANSWER, TRANSCRIPTION, TTS, classify_question
+from quota import BACKGROUND, QuotaScheduler, estimate_request_tokens, retry_after_seconds
+from resilience import CircuitBreaker, CircuitOpen, Deadline, DeadlineExceeded, hedged
+from streaming import InlineDataNotFound, stream_inline_data
 
 with open('config.json', 'r') as file:
     data = json.load(file)
@@ -15,14 +30,293 @@ with open('data/guardrail.yaml', 'r') as file:
 API_KEY = data["GEMINI_API_KEY"]
 AUDIO_PATH = data["FILE"]
 DISPLAY_NAME = "AUDIO"
+API_BASE = data.get("API_BASE", "https://generativelanguage.googleapis.com")
+GUARDRAIL_CACHE_TTL = data.get("GUARDRAIL_CACHE_TTL", 3600)
+# Explicit caching rejects content below a per-model minimum (1024 tokens on the Flash models)
+GUARDRAIL_CACHE_MIN_TOKENS = data.get("GUARDRAIL_CACHE_MIN_TOKENS", 1024)
+GUARDRAIL_CACHE_FILE = "data/guardrail_cache.json"
+CONVERSATION_TOKEN_BUDGET = data.get("CONVERSATION_TOKEN_BUDGET", 2000)
+CONVERSATION_TIMEOUT = data.get("CONVERSATION_TIMEOUT", 600)
+STAGE_DEADLINES = dict({"upload": 30, "transcription": 20, "answer": 40, "tts": 30},
+                       **data.get("STAGE_DEADLINES", {}))
+TTS_CACHE_DIR = "data/tts_cache"
+TTS_CACHE_MAX_FILES = 50
+HISTORY_MAX_BYTES = data.get("HISTORY_MAX_BYTES", 16 * 1024 * 1024)
+# Off by default: a replayed answer can be stale, turn it on per device in config.json
+HISTORY_RECALL = data.get("HISTORY_RECALL", False)
+HISTORY_RECALL_MAX_AGE = data.get("HISTORY_RECALL_MAX_AGE", 86400)
+IMAGE_MAX_BYTES = data.get("IMAGE_MAX_BYTES", 150_000)
+IMAGE_MIN_BYTES = 15_000
+IMAGE_UPLOAD_SECONDS = data.get("IMAGE_UPLOAD_SECONDS", 2.0)
+IMAGE_QUESTION_PROMPT = ("The recording is a spoken question about the attached image. On the first line "
+                         "write 'Question: ' followed by a transcript of the question, then answer it.")
+UPLOAD_QUOTA = "files"  # the scheduler's name for the Files API; MODEL_LIMITS may give it an rpm
+CANNED_UNAVAILABLE = "I can't reach the server right now. Please try again in a moment."
+PAYLOAD_NOTICE = "Creating Security Payload. Please wait while I create the payload and execute it!."
 
-def upload_and_generate():
-    # 1. Prepare Metadata
-    mime_type, _ = mimetypes.guess_type(AUDIO_PATH)
-    num_bytes = os.path.getsize(AUDIO_PATH)
-    
-    upload_url_endpoint = "https://generativelanguage.googleapis.com/upload/v1beta/files"
-    
+
+INTERACTIONS = counter("odin_interactions_total", "Questions sent to Gemini", ("kind",))
+UPLOAD_BYTES = counter("odin_upload_bytes_total", "Recording bytes uploaded")
+IMAGE_BYTES = counter("odin_image_bytes_total", "JPEG bytes sent with image questions")
+REQUEST_SECONDS = histogram("odin_gemini_request_seconds", "Gemini HTTP call latency until response headers",
+                            ("endpoint",))
+REQUEST_ERRORS = counter("odin_gemini_request_errors_total", "Gemini HTTP calls that failed or returned 429/5xx",
+                         ("endpoint",))
+TTS_CACHE = counter("odin_tts_cache_requests_total", "TTS cache lookups", ("result",))
+TTS_CACHE_HITS = TTS_CACHE.labels(result="hit")
+TTS_CACHE_MISSES = TTS_CACHE.labels(result="miss")
+RECALLED = INTERACTIONS.labels(kind="recalled")
+GENERATE_SECONDS = REQUEST_SECONDS.labels(endpoint="generateContent")
+GENERATE_ERRORS = REQUEST_ERRORS.labels(endpoint="generateContent")
+
+
+class GuardrailCache:
+    """
+    Server-side cached content holding the guardrail system instruction.
+    The handle is reused across restarts, refreshed before its TTL runs out and
+    dropped (falling back to inline system_instruction) whenever the API rejects it.
+    A guardrail below the model's minimum cacheable size is never sent for caching,
+    and a 400 on creation turns caching off for the rest of the process: the same
+    request would be rejected again.
+    """
+
+    REFRESH_MARGIN = 300  # seconds before expiry to extend the TTL
+    RETRY_AFTER_FAILURE = 600  # seconds to wait before trying to create again
+    REQUEST_TIMEOUT = 5  # seconds, for each create or refresh call
+
+    def __init__(self, model, text, ttl=GUARDRAIL_CACHE_TTL, state_file=GUARDRAIL_CACHE_FILE,
+                 min_tokens=GUARDRAIL_CACHE_MIN_TOKENS):
+        self.model = model
+        self.text = text
+        self.ttl = ttl
+        self.state_file = state_file
+        self.digest = hashlib.sha256(f"{model}\n{text}".encode("utf-8")).hexdigest()
+        self.name = None
+        self.expires_at = 0
+        self.disabled_until = 0
+        tokens = estimate_request_tokens(text)
+        if tokens < min_tokens:
+            print(f"Guardrail is ~{tokens} tokens, below the {min_tokens} needed for caching; sending inline")
+            self.disabled_until = float("inf")
+        self.requests = 0
+        self.cached_tokens = 0
+        self._updating = False
+        self._lock = threading.Lock()
+        self._load_state()
+
+    def _load_state(self):
+        try:
+            with open(self.state_file, "r") as f:
+                state = json.load(f)
+        except (OSError, ValueError):
+            return
+        if state.get("digest") == self.digest and state.get("expires_at", 0) > time.time():
+            self.name = state["name"]
+            self.expires_at = state["expires_at"]
+
+    def _save_state(self):
+        try:
+            with open(self.state_file, "w") as f:
+                json.dump({"name": self.name, "expires_at": self.expires_at, "digest": self.digest}, f)
+        except OSError as e:
+            print(f"Failed to save guardrail cache state: {e}")
+
+    def _timeout(self, deadline):
+        """Create/refresh run on the answer path: bound them by REQUEST_TIMEOUT and the answer's deadline."""
+        if deadline is None:
+            return (self.REQUEST_TIMEOUT, self.REQUEST_TIMEOUT)
+        return Deadline(min(self.REQUEST_TIMEOUT, deadline.remaining())).timeout()
+
+    def _create(self, timeout):
+        url = f"{API_BASE}/v1beta/cachedContents"
+        body = {
+            "model": f"models/{self.model}",
+            "displayName": "guardrail",
+            "systemInstruction": {"parts": [{"text": self.text}]},
+            "ttl": f"{self.ttl}s",
+        }
+        with REQUEST_SECONDS.labels(endpoint="cachedContents").time():
+            return requests.post(url, headers={"x-goog-api-key": API_KEY}, json=body, timeout=timeout)
+
+    def _refresh(self, name, timeout):
+        url = f"{API_BASE}/v1beta/{name}?updateMask=ttl"
+        response = requests.patch(url, headers={"x-goog-api-key": API_KEY}, json={"ttl": f"{self.ttl}s"},
+                                  timeout=timeout)
+        return response.status_code == 200
+
+    def _store(self, name):
+        with self._lock:
+            self.name = name
+            self.expires_at = time.time() + self.ttl
+            self._save_state()
+        return name
+
+    def _fail(self, retry_after):
+        """Send inline for `retry_after` seconds (None: for the rest of the process)."""
+        with self._lock:
+            self.name = None
+            self.disabled_until = float("inf") if retry_after is None else time.time() + retry_after
+        return None
+
+    def _update(self, name, deadline):
+        """Refresh `name`, or create a new cache if there is none or it's gone; runs without the lock."""
+        try:
+            timeout = self._timeout(deadline)
+            if name and self._refresh(name, timeout):
+                return self._store(name)
+            response = self._create(timeout)
+        except DeadlineExceeded:
+            return None  # this answer is out of time; the next one can try again
+        except requests.RequestException as e:
+            REQUEST_ERRORS.labels(endpoint="cachedContents").inc()
+            print(f"Guardrail cache error: {e}")
+            return self._fail(self.RETRY_AFTER_FAILURE)
+        if response.status_code == 400:
+            # Typically "content too small": retrying the same body can't succeed
+            REQUEST_ERRORS.labels(endpoint="cachedContents").inc()
+            print(f"Guardrail cache rejected, sending inline from now on: {response.text[:200]}")
+            return self._fail(None)
+        if response.status_code != 200:
+            REQUEST_ERRORS.labels(endpoint="cachedContents").inc()
+            print(f"Guardrail cache unavailable ({response.status_code}), sending inline")
+            return self._fail(self.RETRY_AFTER_FAILURE)
+        try:
+            name = response.json()["name"]
+        except (KeyError, ValueError) as e:
+            print(f"Guardrail cache error: {e}")
+            return self._fail(self.RETRY_AFTER_FAILURE)
+        print(f"Created guardrail cache {name}")
+        return self._store(name)
+
+    def handle(self, deadline=None):
+        """
+        Return the cachedContent name to use, or None to send the guardrail inline.
+        Network calls happen outside the lock; while one is in flight other callers
+        use the current handle if it hasn't expired, and go inline otherwise.
+        """
+        with self._lock:
+            now = time.time()
+            if now < self.disabled_until:
+                return None
+            if self.name and self.expires_at - now >= self.REFRESH_MARGIN:
+                return self.name
+            if self._updating:
+                return self.name if self.expires_at > now else None
+            self._updating = True
+            name = self.name
+        try:
+            return self._update(name, deadline)
+        finally:
+            with self._lock:
+                self._updating = False
+
+    def invalidate(self):
+        with self._lock:
+            self.name = None
+            self.expires_at = 0
+            self._save_state()
+
+    def record_usage(self, usage):
+        """Track prompt tokens served from the cache; returns the tokens saved by this request."""
+        saved = usage.get("cachedContentTokenCount", 0)
+        self.requests += 1
+        self.cached_tokens += saved
+        return saved
+
+
+class UplinkEstimator:
+    """Smoothed upload throughput, measured on the audio uploads, used to size image payloads."""
+
+    def __init__(self, default_bps=32_000, alpha=0.3):
+        self.bytes_per_second = default_bps
+        self.alpha = alpha
+        self.samples = 0
+
+    def record(self, num_bytes, seconds):
+        if num_bytes < 4096 or seconds <= 0:
+            return  # too small to say anything about bandwidth
+        rate = num_bytes / seconds
+        self.bytes_per_second += self.alpha * (rate - self.bytes_per_second)
+        self.samples += 1
+
+    def budget(self, seconds, min_bytes, max_bytes):
+        """Bytes that should upload in about `seconds` on the current link."""
+        return int(max(min_bytes, min(max_bytes, self.bytes_per_second * seconds)))
+
+
+guardrail_caches = {}
+uplink = UplinkEstimator()
+router = ModelRouter(routes=data.get("MODEL_ROUTES"), latency_budget=data.get("LATENCY_BUDGET"))
+conversation = ConversationStore(token_budget=CONVERSATION_TOKEN_BUDGET,
+                                 session_timeout=CONVERSATION_TIMEOUT)
+history = HistoryStore(max_bytes=HISTORY_MAX_BYTES)
+scheduler = QuotaScheduler(data.get("MODEL_LIMITS"))
+breakers = {
+    "upload": CircuitBreaker("upload"),
+    "generate": CircuitBreaker("generate"),
+    "tts": CircuitBreaker("tts"),
+}
+
+
+def get_guardrail_cache(model):
+    """Cached content is bound to a model, so keep one handle per routed model."""
+    cache = guardrail_caches.get(model)
+    if cache is None:
+        state_file = GUARDRAIL_CACHE_FILE.replace(".json", f".{model}.json")
+        cache = guardrail_caches[model] = GuardrailCache(model, guardrail, state_file=state_file)
+    return cache
+
+
+def generate_content(model, body, deadline, stream=False):
+    """
+    POST generateContent within the stage deadline, hedging with a duplicate
+    request once the call is slower than the model's observed p95.
+    429/5xx raise ModelUnavailable so the router can fail over.
+    With stream=True the body is left unread for incremental parsing.
+    """
+    url = f"{API_BASE}/v1beta/models/{model}:generateContent"
+    headers = {"x-goog-api-key": API_KEY, "Content-Type": "application/json"}
+    payload = json.dumps(body)
+    tokens = estimate_request_tokens(payload)
+    # One admission per logical request: a hedge is a duplicate of it, not another request
+    scheduler.acquire(model, tokens, deadline, scheduler.current_priority())
+
+    def post():
+        started = time.monotonic()
+        try:
+            response = requests.post(url, headers=headers, data=payload, timeout=deadline.timeout(), stream=stream)
+        except requests.RequestException:
+            GENERATE_ERRORS.inc()
+            raise
+        GENERATE_SECONDS.observe(time.monotonic() - started)
+        if response.status_code == 429 or response.status_code >= 500:
+            GENERATE_ERRORS.inc()
+            if response.status_code == 429 or "Retry-After" in response.headers:
+                scheduler.rate_limited(model, retry_after_seconds(response))
+            response.close()
+            raise ModelUnavailable(f"HTTP {response.status_code}")
+        response.estimated_tokens = tokens  # for record_usage() once the body is parsed
+        return response
+
+    return hedged(post, router.hedge_delay(model), deadline, discard=lambda response: response.close())
+
+
+def check_upload_rate_limit(response):
+    """A 429 from the Files API holds back every upload, like one from a model holds back that model."""
+    if response.status_code == 429:
+        REQUEST_ERRORS.labels(endpoint="upload").inc()
+        scheduler.rate_limited(UPLOAD_QUOTA, retry_after_seconds(response))
+        response.close()
+        raise ModelUnavailable("upload rate limited")
+
+
+def upload_file(path, mime_type, deadline):
+    """
+    Resumable upload. The session is started once; if sending the bytes fails
+    the server is asked how much it received and the upload resumes from that
+    offset, so a retry never creates a second file or re-sends finalized data.
+    """
+    num_bytes = os.path.getsize(path)
     headers_start = {
         "x-goog-api-key": API_KEY,
         "X-Goog-Upload-Protocol": "resumable",
@@ -31,33 +325,106 @@ def upload_and_generate():
         "X-Goog-Upload-Header-Content-Type": mime_type,
         "Content-Type": "application/json"
     }
-    
     metadata = {"file": {"display_name": DISPLAY_NAME}}
 
-    # 2. Initial Resumable Request
     print("Initiating upload...")
-    response_start = requests.post(upload_url_endpoint, headers=headers_start, json=metadata)
-    upload_url = response_start.headers.get("x-goog-upload-url")
+    scheduler.acquire(UPLOAD_QUOTA, 0, deadline, scheduler.current_priority())
+    response_start = requests.post(f"{API_BASE}/upload/v1beta/files", headers=headers_start,
+                                   json=metadata, timeout=deadline.timeout())
+    check_upload_rate_limit(response_start)
+    response_start.raise_for_status()
+    upload_url = response_start.headers["x-goog-upload-url"]
 
-    # 3. Upload Actual Bytes
     print("Uploading bytes...")
-    headers_upload = {
-        "Content-Length": str(num_bytes),
-        "X-Goog-Upload-Offset": "0",
-        "X-Goog-Upload-Command": "upload, finalize"
-    }
-    
-    with open(AUDIO_PATH, "rb") as f:
-        response_upload = requests.post(upload_url, headers=headers_upload, data=f)
-    
-    file_info = response_upload.json()
-    file_uri = file_info["file"]["uri"]
+    offset = 0
+    for attempt in range(3):
+        headers_upload = {
+            "Content-Length": str(num_bytes - offset),
+            "X-Goog-Upload-Offset": str(offset),
+            "X-Goog-Upload-Command": "upload, finalize"
+        }
+        try:
+            started = time.monotonic()
+            with open(path, "rb") as f:
+                f.seek(offset)
+                response_upload = requests.post(upload_url, headers=headers_upload, data=f,
+                                                timeout=deadline.timeout())
+            check_upload_rate_limit(response_upload)
+            response_upload.raise_for_status()
+            uplink.record(num_bytes - offset, time.monotonic() - started)
+            REQUEST_SECONDS.labels(endpoint="upload").observe(time.monotonic() - started)
+            UPLOAD_BYTES.inc(num_bytes - offset)
+        except requests.RequestException as e:
+            REQUEST_ERRORS.labels(endpoint="upload").inc()
+            print(f"Upload interrupted ({e}), querying offset...")
+            response_query = requests.post(upload_url, headers={"X-Goog-Upload-Command": "query"},
+                                           timeout=deadline.timeout())
+            check_upload_rate_limit(response_query)
+            if response_query.headers.get("X-Goog-Upload-Status") == "final":
+                return uploaded_file_uri(response_query)
+            offset = int(response_query.headers.get("X-Goog-Upload-Size-Received", 0))
+        else:
+            return uploaded_file_uri(response_upload)
+    raise ModelUnavailable("upload did not complete")
+
+
+def uploaded_file_uri(response):
+    """File URI from a finished upload; a body that isn't one (e.g. a proxy's error page) is an outage."""
+    try:
+        return response.json()["file"]["uri"]
+    except (KeyError, TypeError, ValueError):
+        REQUEST_ERRORS.labels(endpoint="upload").inc()
+        raise ModelUnavailable(f"upload response had no file URI (HTTP {response.status_code})")
+
+
+def tts_cache_path(text, voice):
+    digest = hashlib.sha1(f"{voice}\n{text}".encode("utf-8")).hexdigest()
+    return os.path.join(TTS_CACHE_DIR, f"{digest}.wav")
+
+
+def store_tts_cache(path, output_filename):
+    os.makedirs(TTS_CACHE_DIR, exist_ok=True)
+    shutil.copyfile(output_filename, path)
+    cached = sorted((os.path.join(TTS_CACHE_DIR, name) for name in os.listdir(TTS_CACHE_DIR)),
+                    key=os.path.getmtime)
+    for old in cached[:-TTS_CACHE_MAX_FILES]:
+        os.remove(old)
+
+
+def upload_recording(audio_path=None, output_filename="data/answer.wav", fallback=True):
+    """Upload the recording; returns (mime_type, file_uri), or None after speaking the canned reply."""
+    audio_path = audio_path or AUDIO_PATH
+    mime_type, _ = mimetypes.guess_type(audio_path)
+    try:
+        deadline = Deadline(STAGE_DEADLINES["upload"])
+        file_uri = breakers["upload"].call(lambda: upload_file(audio_path, mime_type, deadline))
+    except (CircuitOpen, DeadlineExceeded, ModelUnavailable, requests.RequestException, KeyError, ValueError) as e:
+        print(f"Upload failed: {e}")
+        if not fallback:
+            raise
+        generate_gemini_speech(CANNED_UNAVAILABLE, output_filename)
+        return None
     print(f"File URI: {file_uri}")
+    return mime_type, file_uri
+
 
-    # 4. Generate Content
+def upload_and_generate(audio_path=None, output_filename="data/answer.wav", fallback=True):
+    """
+    Transcribe the recording, answer it and synthesize the answer into output_filename.
+    Returns the answer text. With fallback=False upstream failures raise instead
+    of producing the canned "unavailable" speech, so the caller can retry later.
+    """
+    INTERACTIONS.labels(kind="voice").inc()
+    interaction = new_interaction("voice")
+    # 1-2. Resumable upload of the recording
+    uploaded = upload_recording(audio_path, output_filename, fallback)
+    if uploaded is None:
+        return None
+    mime_type, file_uri = uploaded
+    lap(interaction, "upload")
+
+    # 3. Generate Content
     print("Generating description...")
-    gen_url = f"https://generativelanguage.googleapis.com/v1beta/models/gemini-3-flash-preview:generateContent?key={API_KEY}"
-    
     payload = {
         "contents": [{
             "parts": [
@@ -66,56 +433,249 @@ def upload_and_generate():
             ]
         }]
     }
-    
-    response_gen = requests.post(gen_url, json=payload)
-    
-    # 5. Parse and Print Output
-    result = response_gen.json()
+
+    try:
+        deadline = Deadline(STAGE_DEADLINES["transcription"])
+        model, response_gen = breakers["generate"].call(
+            lambda: router.call(TRANSCRIPTION, lambda model: generate_content(model, payload, deadline)))
+    except (CircuitOpen, DeadlineExceeded, ModelUnavailable, requests.RequestException) as e:
+        print(f"Transcription failed: {e}")
+        if not fallback:
+            raise
+        generate_gemini_speech(CANNED_UNAVAILABLE, output_filename)
+        return None
+    print(f"Transcribed with {model}")
+    interaction["transcription_model"] = model
+
+    # 4. Parse and Print Output
+    with profiler.stage("gemini.transcription_parse"):
+        result = response_json(response_gen)
+    scheduler.record_usage(model, result.get("usageMetadata"), response_gen.estimated_tokens)
     try:
         text_output = result['candidates'][0]['content']['parts'][0]['text']
         print("\nGemini Response:\n", text_output)
-        get_response(text_output)
     except (KeyError, IndexError):
         print("Error in response:", json.dumps(result, indent=2))
+        if not fallback:
+            raise ModelUnavailable("transcription response had no text")
+        return None
+    lap(interaction, "transcription")
+    return get_response(text_output, output_filename, fallback, interaction)
 
-def get_response(text):
-    url = "https://generativelanguage.googleapis.com/v1beta/models/gemini-3-flash-preview:generateContent"
+def response_json(response):
+    """
+    Parsed body of a generateContent response, {} if it isn't JSON (a proxy's
+    HTML error page, a truncated body), so it takes the no-candidates path.
+    """
+    try:
+        result = response.json()
+    except ValueError:
+        print(f"Response is not JSON ({response.status_code}): {response.text[:200]}")
+        return {}
+    return result if isinstance(result, dict) else {}
 
-    payload = json.dumps({
-    "system_instruction": {
-      "parts": [
-        {
-          "text": guardrail
-        }
-      ]
-    },
-    "contents": [
-        {
-        "parts": [
-            {
-            "text": "{}".format(text)
-            }
-        ]
-        }
-    ]
-    })
-    headers = {
-    'x-goog-api-key': API_KEY,
-    'Content-Type': 'application/json'
-    }
 
-    response = requests.request("POST", url, headers=headers, data=payload)
-    result = response.json()
-    answer = result['candidates'][0]['content']['parts'][0]['text']
+def ask_with_guardrail(model, contents, deadline):
+    """generateContent with the guardrail from the server-side cache, or inline if the cache is unusable."""
+    body = {"contents": contents}
+    cache = get_guardrail_cache(model)
+    cache_name = cache.handle(deadline)
+    if cache_name:
+        body["cachedContent"] = cache_name
+        response = generate_content(model, body, deadline)
+        if response.status_code in (400, 403, 404):
+            # Cache expired or was deleted server-side: fall back to inline guardrail
+            print(f"Guardrail cache rejected ({response.status_code}), resending inline")
+            cache.invalidate()
+            cache_name = None
+    if not cache_name:
+        body.pop("cachedContent", None)
+        body["system_instruction"] = {"parts": [{"text": guardrail}]}
+        response = generate_content(model, body, deadline)
+    return response
+
+
+def answer_contents(contents, request_type, output_filename, fallback, interaction=None):
+    """Route an answer request; returns the answer text or None after speaking the canned reply."""
+    deadline = Deadline(STAGE_DEADLINES["answer"])
+    try:
+        model, response = breakers["generate"].call(
+            lambda: router.call(request_type, lambda model: ask_with_guardrail(model, contents, deadline)))
+    except (CircuitOpen, DeadlineExceeded, ModelUnavailable, requests.RequestException) as e:
+        print(f"Answer failed: {e}")
+        if not fallback:
+            raise
+        generate_gemini_speech(CANNED_UNAVAILABLE, output_filename)
+        return None
+    with profiler.stage("gemini.answer_parse"):
+        result = response_json(response)
+    usage = result.get("usageMetadata", {})
+    scheduler.record_usage(model, usage, response.estimated_tokens)
+    cache = get_guardrail_cache(model)
+    saved = cache.record_usage(usage)
+    print(f"Answered by {model} ({request_type})")
+    print(f"Prompt tokens: {usage.get('promptTokenCount', 0)} (from cache: {saved}, "
+          f"total saved: {cache.cached_tokens})")
+    try:
+        answer = result['candidates'][0]['content']['parts'][0]['text']
+    except (KeyError, IndexError, TypeError):
+        # Error body, or the prompt/answer was blocked (no candidates, or a candidate without parts)
+        print(f"No answer in response ({response.status_code}):", json.dumps(result, indent=2)[:1000])
+        if not fallback:
+            raise ModelUnavailable(f"answer response had no text (HTTP {response.status_code})")
+        generate_gemini_speech(CANNED_UNAVAILABLE, output_filename)
+        return None
     print(answer)
+    if interaction is not None:
+        interaction["model"] = model
+        lap(interaction, "answer")
+    return answer
+
+
+def speak_answer(answer, output_filename, fallback):
     if len(answer) < 3000 and "```text" not in answer:
-        generate_gemini_speech(answer)
+        generate_gemini_speech(answer, output_filename, fallback=fallback)
     elif "```text" in answer or len(answer) > 3000:
-        generate_gemini_speech("Creating Security Payload. Please wait while I create the payload and execute it!.")
+        generate_gemini_speech(PAYLOAD_NOTICE, output_filename, fallback=fallback)
+
+
+def new_interaction(kind):
+    """Timing and model details of one question, collected for the history."""
+    now = time.monotonic()
+    return {"kind": kind, "started": now, "lap": now, "latencies": {}}
+
+
+def lap(interaction, stage):
+    now = time.monotonic()
+    interaction["latencies"][stage] = round(now - interaction["lap"], 3)
+    interaction["lap"] = now
+
+
+def record_interaction(interaction, question, answer):
+    interaction["latencies"]["total"] = round(time.monotonic() - interaction["started"], 3)
+    try:
+        history.record(interaction["kind"], question, answer, model=interaction.get("model"),
+                       transcription_model=interaction.get("transcription_model"),
+                       latencies=interaction["latencies"])
+    except sqlite3.Error as e:
+        print(f"Failed to record history: {e}")
+
+
+def recall_answer(question):
+    """
+    A stored answer to the same question, if recall is enabled and one is recent
+    enough. Not for follow-ups during a conversation: "tell me more" means
+    something different in every one of them.
+    """
+    if not HISTORY_RECALL or (is_follow_up(question) and conversation.active()):
+        return None
+    try:
+        entry = history.recall(question, max_age=HISTORY_RECALL_MAX_AGE)
+    except sqlite3.Error as e:
+        print(f"History recall failed: {e}")
+        return None
+    if entry is not None:
+        print(f"Recalled answer #{entry['id']} to: '{entry['question']}'")
+    return entry
+
+
+def get_response(text, output_filename="data/answer.wav", fallback=True, interaction=None):
+    interaction = interaction or new_interaction("text")
+    recalled = recall_answer(text)
+    if recalled is not None:
+        RECALLED.inc()
+        answer = recalled["answer"]
+        interaction["model"] = f"history:{recalled['id']}"
+        lap(interaction, "answer")
+    else:
+        contents = conversation.contents("{}".format(text))
+        answer = answer_contents(contents, classify_question(text), output_filename, fallback, interaction)
+        if answer is None:
+            return None
+    speak_answer(answer, output_filename, fallback)
+    # Only once the answer is deliverable: a TTS failure with fallback=False is retried
+    # by the job queue, and recording it first would add the same turn on every attempt
+    conversation.add_exchange(text, answer)
+    lap(interaction, "tts")
+    record_interaction(interaction, text, answer)
+    return answer
+
+
+def ask_about_image(image, audio_path=None, output_filename="data/answer.wav", fallback=True):
+    """
+    Capture-and-ask: the spoken question and a downscaled JPEG of `image` go to the
+    model in a single request, skipping the separate transcription call. The JPEG
+    is sized to upload in about IMAGE_UPLOAD_SECONDS on the measured uplink.
+    """
+    INTERACTIONS.labels(kind="image").inc()
+    interaction = new_interaction("image")
+    budget = uplink.budget(IMAGE_UPLOAD_SECONDS, IMAGE_MIN_BYTES, IMAGE_MAX_BYTES)
+    with profiler.stage("gemini.image_encode"):
+        jpeg, quality, size = ImageUtils.encode_jpeg(image, budget)
+    print(f"Image {size[0]}x{size[1]} q{quality}: {len(jpeg)} bytes (budget {budget})")
+    IMAGE_BYTES.inc(len(jpeg))
+
+    uploaded = upload_recording(audio_path, output_filename, fallback)
+    if uploaded is None:
+        return None
+    mime_type, file_uri = uploaded
+    lap(interaction, "upload")
+
+    contents = conversation.contents(IMAGE_QUESTION_PROMPT)
+    contents[-1]["parts"] = [
+        {"file_data": {"mime_type": mime_type, "file_uri": file_uri}},
+        {"inline_data": {"mime_type": "image/jpeg", "data": base64.b64encode(jpeg).decode("ascii")}},
+        {"text": IMAGE_QUESTION_PROMPT},
+    ]
+    answer = answer_contents(contents, SHORT_ANSWER, output_filename, fallback, interaction)
+    if answer is None:
+        return None
+    first_line, _, rest = answer.partition("\n")
+    question = "(about an image)"
+    if first_line.strip().lower().startswith("question:"):
+        question = f"{first_line.strip()[len('question:'):].strip()} (about an image)"
+        answer = rest.strip()
+    speak_answer(answer, output_filename, fallback)
+    conversation.add_exchange(question, answer)
+    lap(interaction, "tts")
+    record_interaction(interaction, question, answer)
+    return answer
+
+def use_canned_speech(voice, output_filename):
+    """Copy the cached "can't reach the server" reply into place; False if it was never synthesized."""
+    canned_path = tts_cache_path(CANNED_UNAVAILABLE, voice)
+    if not os.path.exists(canned_path):
+        return False
+    shutil.copyfile(canned_path, output_filename)
+    return True
+
+
+def prewarm_canned_speech(voice="Leda"):
+    """
+    Synthesize the canned reply while the network is up, so it can be played
+    when it is not. Runs at background priority: it only uses spare quota.
+    """
+    if os.path.exists(tts_cache_path(CANNED_UNAVAILABLE, voice)):
+        return
+    scratch = "data/prewarm.wav"
+    with scheduler.priority(BACKGROUND):
+        try:
+            generate_gemini_speech(CANNED_UNAVAILABLE, scratch, voice, fallback=False)
+        except (CircuitOpen, DeadlineExceeded, ModelUnavailable, requests.RequestException) as e:
+            print(f"Prewarm failed, will retry next start: {e}")
+    if os.path.exists(scratch):
+        os.remove(scratch)
+
+
+def generate_gemini_speech(text, output_filename="data/answer.wav", voice="Leda", fallback=True):
+    cache_path = tts_cache_path(text, voice)
+    if os.path.exists(cache_path):
+        TTS_CACHE_HITS.inc()
+        print(f"Using cached speech for: '{text}'")
+        shutil.copyfile(cache_path, output_filename)
+        return
+    TTS_CACHE_MISSES.inc()
 
-def generate_gemini_speech(text, output_filename="data/answer.wav", voice="Leda"):
-    url = f"https://generativelanguage.googleapis.com/v1beta/models/gemini-2.5-flash-preview-tts:generateContent?key={API_KEY}"
-    
     # 1. Prepare the Request Payload
     payload = {
         "contents": [{
@@ -135,43 +695,46 @@ def generate_gemini_speech(text, output_filename="data/answer.wav", voice="Leda"
         }
     }
 
-    headers = {"Content-Type": "application/json"}
-
     # 2. Call the API
     print(f"Requesting speech for: '{text}'...")
-    response = requests.post(url, headers=headers, json=payload)
+    try:
+        deadline = Deadline(STAGE_DEADLINES["tts"])
+        model, response = breakers["tts"].call(
+            lambda: router.call(TTS, lambda model: generate_content(model, payload, deadline, stream=True)))
+    except (CircuitOpen, DeadlineExceeded, ModelUnavailable, requests.RequestException) as e:
+        print(f"Speech failed: {e}")
+        if not fallback:
+            raise
+        # The fallback path runs inside other stages' error handlers: it must not raise
+        if not use_canned_speech(voice, output_filename):
+            print("No canned reply cached yet, nothing to play")
+        return
     
     if response.status_code != 200:
         print(f"Error: {response.status_code}")
         print(response.text)
+        if not fallback:
+            raise ModelUnavailable(f"TTS HTTP {response.status_code}")
+        use_canned_speech(voice, output_filename)
         return
 
-    # 3. Extract Base64 and Decode to PCM
-    response_data = response.json()
+    # 3. Stream-decode the base64 audio straight into the WAV file, so memory
+    # stays flat no matter how long the answer is
+    partial = output_filename + ".part"
     try:
-        audio_base64 = response_data['candidates'][0]['content']['parts'][0]['inlineData']['data']
-        pcm_data = base64.b64decode(audio_base64)
-        
-        # Save temporary PCM file
-        temp_pcm = "temp_output.pcm"
-        with open(temp_pcm, "wb") as f:
-            f.write(pcm_data)
-            
-        # 4. Convert PCM to WAV using FFmpeg via subprocess
-        # This mimics your: ffmpeg -f s16le -ar 24000 -ac 1 -i out.pcm out.wav
-        print("Converting PCM to WAV...")
-        subprocess.run([
-            'ffmpeg', '-y', 
-            '-f', 's16le', 
-            '-ar', '16000', 
-            '-ac', '2', 
-            '-i', temp_pcm, 
-            output_filename
-        ], check=True, capture_output=True)
-        
-        os.remove(temp_pcm)
-        print(f"Success! Saved to {output_filename}")
-
-    except (KeyError, IndexError) as e:
+        with profiler.stage("gemini.tts_decode"), wave.open(partial, "wb") as wav:
+            wav.setnchannels(2)
+            wav.setsampwidth(2)
+            wav.setframerate(16000)
+            num_bytes = stream_inline_data(response, wav.writeframesraw)
+        scheduler.record_usage(model, response.usage_metadata, response.estimated_tokens)
+        os.replace(partial, output_filename)
+        store_tts_cache(cache_path, output_filename)
+        print(f"Success! Saved {num_bytes} bytes of audio to {output_filename}")
+    except (InlineDataNotFound, requests.RequestException) as e:
         print(f"Failed to parse response: {e}")
-        print(json.dumps(response_data, indent=2))
+        if os.path.exists(partial):
+            os.remove(partial)
+        if not fallback:
+            raise ModelUnavailable(f"TTS response unusable: {e}")
+        use_canned_speech(voice, output_filename)
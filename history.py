@@ -0,0 +1,223 @@
+"""
+Local history of every interaction: transcript, answer, models and stage latencies.
+
+Stored in SQLite (data/history.db) with an FTS5 index over questions and
+answers, so searching thousands of entries takes milliseconds on a Pi Zero.
+When FTS5 is missing from the SQLite build, search falls back to LIKE scans.
+
+Retention is size-bounded: once the file grows past max_bytes the oldest
+entries are deleted and freed pages are returned with an incremental vacuum.
+
+recall() finds a previous answer to the same question (same words, ignoring
+case and punctuation), so it can be replayed on-device without another model
+call:
+
+    python history.py search "deauth"
+    python history.py recent 10
+"""
+import json
+import re
+import sqlite3
+import sys
+import threading
+import time
+
+HISTORY_FILE = "data/history.db"
+PRUNE_FRACTION = 0.2  # share of entries dropped when over the size limit
+CHECK_EVERY = 20  # inserts between size checks
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS interactions (
+    id INTEGER PRIMARY KEY,
+    created_at REAL NOT NULL,
+    kind TEXT NOT NULL,
+    question TEXT NOT NULL,
+    question_key TEXT NOT NULL,
+    answer TEXT NOT NULL,
+    model TEXT,
+    transcription_model TEXT,
+    latencies TEXT
+);
+CREATE INDEX IF NOT EXISTS interactions_question_key ON interactions (question_key, created_at);
+"""
+
+FTS_SCHEMA = """
+CREATE VIRTUAL TABLE IF NOT EXISTS interactions_fts USING fts5(
+    question, answer, content='interactions', content_rowid='id');
+CREATE TRIGGER IF NOT EXISTS interactions_ai AFTER INSERT ON interactions BEGIN
+    INSERT INTO interactions_fts (rowid, question, answer) VALUES (new.id, new.question, new.answer);
+END;
+CREATE TRIGGER IF NOT EXISTS interactions_ad AFTER DELETE ON interactions BEGIN
+    INSERT INTO interactions_fts (interactions_fts, rowid, question, answer)
+    VALUES ('delete', old.id, old.question, old.answer);
+END;
+"""
+
+WORD = re.compile(r"\w+", re.UNICODE)
+
+
+def question_words(text):
+    return WORD.findall(text.lower())
+
+
+def question_key(text):
+    """Case, punctuation and spacing don't make a different question."""
+    return " ".join(question_words(text))
+
+
+class HistoryStore:
+    def __init__(self, path=HISTORY_FILE, max_bytes=16 * 1024 * 1024):
+        self.path = path
+        self.max_bytes = max_bytes
+        self._lock = threading.Lock()
+        self._inserts = 0
+        self.db = sqlite3.connect(path, check_same_thread=False)
+        self.db.row_factory = sqlite3.Row
+        # Must be set before the first table exists for incremental vacuum to work
+        self.db.execute("PRAGMA auto_vacuum = INCREMENTAL")
+        self.db.execute("PRAGMA journal_mode = WAL")
+        self.db.execute("PRAGMA synchronous = NORMAL")
+        self.db.executescript(SCHEMA)
+        try:
+            self.db.executescript(FTS_SCHEMA)
+            self.fts = True
+        except sqlite3.OperationalError as e:
+            print(f"History: full-text index unavailable ({e}), searching without it")
+            self.fts = False
+        self.db.commit()
+
+    def record(self, kind, question, answer, model=None, transcription_model=None, latencies=None):
+        """Append one interaction; returns its id."""
+        with self._lock:
+            cursor = self.db.execute(
+                "INSERT INTO interactions (created_at, kind, question, question_key, answer, model, "
+                "transcription_model, latencies) VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                (time.time(), kind, question, question_key(question), answer, model, transcription_model,
+                 json.dumps(latencies or {})))
+            self.db.commit()
+            self._inserts += 1
+            if self._inserts % CHECK_EVERY == 0:
+                self._enforce_size()
+            return cursor.lastrowid
+
+    def size_bytes(self):
+        page_size = self.db.execute("PRAGMA page_size").fetchone()[0]
+        pages = self.db.execute("PRAGMA page_count").fetchone()[0]
+        free = self.db.execute("PRAGMA freelist_count").fetchone()[0]
+        return (pages - free) * page_size
+
+    def _enforce_size(self):
+        """Drop the oldest entries until the live data fits max_bytes, then give the pages back."""
+        pruned = 0
+        while self.size_bytes() > self.max_bytes:
+            count = self.db.execute("SELECT COUNT(*) FROM interactions").fetchone()[0]
+            if count <= 1:
+                break
+            drop = max(1, int(count * PRUNE_FRACTION))
+            self.db.execute("DELETE FROM interactions WHERE id IN "
+                            "(SELECT id FROM interactions ORDER BY id LIMIT ?)", (drop,))
+            if self.fts:
+                self.db.execute("INSERT INTO interactions_fts (interactions_fts) VALUES ('optimize')")
+            self.db.commit()
+            pruned += drop
+        if pruned:
+            self.db.execute("PRAGMA incremental_vacuum")
+            self.db.execute("PRAGMA wal_checkpoint(TRUNCATE)")
+            self.db.commit()
+            print(f"History: pruned {pruned} old entries")
+        return pruned
+
+    def compact(self):
+        with self._lock:
+            pruned = self._enforce_size()
+            self.db.execute("PRAGMA incremental_vacuum")
+            self.db.commit()
+            return pruned
+
+    def search(self, query, limit=10, any_word=False):
+        """
+        Entries containing every word of `query` (any of them with any_word=True),
+        best matches first when indexed, newest first otherwise.
+        """
+        words = question_words(query)
+        if not words:
+            return []
+        with self._lock:
+            if self.fts:
+                match = (" OR " if any_word else " ").join(f'"{word}"' for word in words)
+                rows = self.db.execute(
+                    "SELECT interactions.*, snippet(interactions_fts, 1, '[', ']', '...', 12) AS snippet "
+                    "FROM interactions_fts JOIN interactions ON interactions.id = interactions_fts.rowid "
+                    "WHERE interactions_fts MATCH ? ORDER BY bm25(interactions_fts), interactions.id DESC LIMIT ?",
+                    (match, limit)).fetchall()
+            else:
+                where = (" OR " if any_word else " AND ").join("(question_key LIKE ? OR lower(answer) LIKE ?)" for _ in words)
+                args = [value for word in words for value in (f"%{word}%", f"%{word}%")]
+                rows = self.db.execute(f"SELECT *, substr(answer, 1, 80) AS snippet FROM interactions "
+                                       f"WHERE {where} ORDER BY id DESC LIMIT ?", args + [limit]).fetchall()
+        return [self._row(row) for row in rows]
+
+    def recall(self, question, max_age=None, exclude_kinds=("image",)):
+        """
+        The newest earlier answer to the same question, None if there is none.
+        Only an exact match of the normalized question counts: questions that
+        share most of their words ("... on Linux" / "... on Windows") can need
+        different answers. Answers about an image are skipped by default, they
+        don't carry over.
+        """
+        key = question_key(question)
+        if not key:
+            return None
+        oldest = time.time() - max_age if max_age else 0
+        placeholders = ",".join("?" * len(exclude_kinds)) or "NULL"
+        with self._lock:
+            row = self.db.execute(
+                f"SELECT * FROM interactions WHERE question_key = ? AND created_at >= ? "
+                f"AND kind NOT IN ({placeholders}) ORDER BY created_at DESC LIMIT 1",
+                (key, oldest, *exclude_kinds)).fetchone()
+        return self._row(row) if row is not None else None
+
+    def recent(self, limit=10):
+        with self._lock:
+            rows = self.db.execute("SELECT * FROM interactions ORDER BY id DESC LIMIT ?", (limit,)).fetchall()
+        return [self._row(row) for row in rows]
+
+    def stats(self):
+        with self._lock:
+            count = self.db.execute("SELECT COUNT(*) FROM interactions").fetchone()[0]
+            return {"entries": count, "bytes": self.size_bytes(), "max_bytes": self.max_bytes, "fts": self.fts}
+
+    @staticmethod
+    def _row(row):
+        entry = dict(row)
+        entry.pop("question_key", None)
+        entry["latencies"] = json.loads(entry["latencies"] or "{}")
+        return entry
+
+    def close(self):
+        with self._lock:
+            self.db.close()
+
+
+def main():
+    if len(sys.argv) < 2 or sys.argv[1] not in ("search", "recent", "stats", "compact"):
+        sys.exit("usage: history.py search WORDS... | recent [N] | stats | compact")
+    store = HistoryStore()
+    command = sys.argv[1]
+    if command == "search":
+        started = time.perf_counter()
+        entries = store.search(" ".join(sys.argv[2:]))
+        for entry in entries:
+            print(f"#{entry['id']} {time.strftime('%Y-%m-%d %H:%M', time.localtime(entry['created_at']))} "
+                  f"Q: {entry['question']}\n    {entry['snippet']}")
+        print(f"{len(entries)} matches in {(time.perf_counter() - started) * 1000:.1f} ms")
+    elif command == "recent":
+        for entry in store.recent(int(sys.argv[2]) if len(sys.argv) > 2 else 10):
+            print(f"#{entry['id']} [{entry['model']}] Q: {entry['question']}\n    A: {entry['answer'][:120]}")
+    elif command == "compact":
+        print(f"Pruned {store.compact()} entries")
+    print(json.dumps(store.stats()))
+
+
+if __name__ == "__main__":
+    main()
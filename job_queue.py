@@ -0,0 +1,247 @@
+import os
+import json
+import shutil
+import socket
+import threading
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+
+QUEUE_DIR = "data/queue"
+
+QUEUED = "queued"
+IN_FLIGHT = "in_flight"
+DONE = "done"
+DELIVERED = "delivered"
+FAILED = "failed"
+
+
+def is_online(host, port=443, timeout=3):
+    """Cheap connectivity probe: can we open a TCP connection to the API host?"""
+    try:
+        with socket.create_connection((host, port), timeout=timeout):
+            return True
+    except OSError:
+        return False
+
+
+class JobQueue:
+    """
+    Durable queue of captured utterances.
+
+    Every state change is appended as one JSON line to jobs.log; index.json is a
+    periodic snapshot of all jobs plus the log offset it covers, so startup only
+    replays the tail of the log. A worker thread flushes due jobs with bounded
+    concurrency while the upstream is reachable, retrying with exponential
+    backoff, and a delivery thread hands results over strictly in capture order,
+    so a slow deliver() (playing an answer) never holds up the workers.
+    """
+
+    def __init__(self, process, deliver, directory=QUEUE_DIR, concurrency=2, max_attempts=5,
+                 base_backoff=5, max_backoff=300, probe=None, compact_every=50):
+        self.process = process  # process(job) -> result path, raises on failure
+        self.deliver = deliver  # deliver(job) for DONE or FAILED jobs, in seq order, on one thread
+        self.directory = directory
+        self.concurrency = concurrency
+        self.max_attempts = max_attempts
+        self.base_backoff = base_backoff
+        self.max_backoff = max_backoff
+        self.probe = probe or (lambda: True)
+        self.compact_every = compact_every
+        self.log_path = os.path.join(directory, "jobs.log")
+        self.index_path = os.path.join(directory, "index.json")
+        self.jobs = {}
+        self.next_seq = 0
+        self.next_delivery = 0
+        self._records_since_compact = 0
+        self._lock = threading.Lock()
+        self._wakeup = threading.Event()
+        self._deliveries = threading.Event()
+        self._running = False
+        self._thread = None
+        self._delivery_thread = None
+        self._pool = ThreadPoolExecutor(max_workers=concurrency, thread_name_prefix="queue")
+        os.makedirs(directory, exist_ok=True)
+        self._recover()
+
+    # ========== Persistence ==========
+    def _recover(self):
+        offset = 0
+        try:
+            with open(self.index_path, "r") as f:
+                index = json.load(f)
+            self.jobs = {job["id"]: job for job in index["jobs"]}
+            self.next_delivery = index.get("next_delivery", 0)
+            offset = index["offset"]
+        except (OSError, ValueError, KeyError):
+            self.jobs = {}
+        try:
+            with open(self.log_path, "rb") as f:
+                f.seek(offset)
+                for line in f:
+                    try:
+                        record = json.loads(line)
+                    except ValueError:
+                        break  # torn write at the tail
+                    if "next_delivery" in record:
+                        self.next_delivery = record["next_delivery"]
+                    else:
+                        self.jobs[record["id"]] = record
+        except OSError:
+            pass
+        for job in self.jobs.values():
+            if job["state"] == IN_FLIGHT:
+                # interrupted mid-request: safe to redo
+                job["state"] = QUEUED
+            self.next_seq = max(self.next_seq, job["seq"] + 1)
+        self._compact()
+
+    def _append(self, record):
+        with open(self.log_path, "a") as f:
+            f.write(json.dumps(record) + "\n")
+            f.flush()
+            os.fsync(f.fileno())
+        self._records_since_compact += 1
+        if self._records_since_compact >= self.compact_every:
+            self._compact()
+
+    def _compact(self):
+        """Drop delivered jobs and rewrite the log so it only holds live state."""
+        for job_id in [j["id"] for j in self.jobs.values() if j["state"] == DELIVERED]:
+            del self.jobs[job_id]
+        live = sorted(self.jobs.values(), key=lambda j: j["seq"])
+        tmp_log = self.log_path + ".tmp"
+        with open(tmp_log, "w") as f:
+            for job in live:
+                f.write(json.dumps(job) + "\n")
+        os.replace(tmp_log, self.log_path)
+        tmp_index = self.index_path + ".tmp"
+        with open(tmp_index, "w") as f:
+            json.dump({"offset": os.path.getsize(self.log_path), "jobs": live,
+                       "next_delivery": self.next_delivery}, f)
+        os.replace(tmp_index, self.index_path)
+        self._records_since_compact = 0
+
+    # ========== API ==========
+    def enqueue(self, audio_path, image_path=None, **extra):
+        """Copy the recording (and photo) into the queue so the next capture cannot overwrite it."""
+        job_id = uuid.uuid4().hex[:12]
+        stored = os.path.join(self.directory, f"{job_id}.wav")
+        shutil.copyfile(audio_path, stored)
+        stored_image = None
+        if image_path:
+            stored_image = os.path.join(self.directory, f"{job_id}{os.path.splitext(image_path)[1]}")
+            shutil.copyfile(image_path, stored_image)
+        with self._lock:
+            job = dict(extra, id=job_id, seq=self.next_seq, state=QUEUED, attempts=0,
+                       next_attempt_at=0, audio=stored, image=stored_image, result=None, error=None,
+                       created_at=time.time())
+            self.next_seq += 1
+            self.jobs[job_id] = job
+            self._append(job)
+        self._wakeup.set()
+        return job
+
+    def pending(self):
+        with self._lock:
+            return sum(1 for j in self.jobs.values() if j["state"] in (QUEUED, IN_FLIGHT, DONE))
+
+    def start(self):
+        self._running = True
+        self._thread = threading.Thread(target=self._run, name="job-queue", daemon=True)
+        self._thread.start()
+        self._delivery_thread = threading.Thread(target=self._deliver_loop, name="job-delivery", daemon=True)
+        self._delivery_thread.start()
+        return self
+
+    def stop(self):
+        self._running = False
+        self._wakeup.set()
+        self._deliveries.set()
+        for thread in (self._thread, self._delivery_thread):
+            if thread:
+                thread.join(timeout=2)
+        self._pool.shutdown(wait=False)
+
+    # ========== Worker ==========
+    def _due_jobs(self, now, limit):
+        due = [j for j in self.jobs.values() if j["state"] == QUEUED and j["next_attempt_at"] <= now]
+        return sorted(due, key=lambda j: j["seq"])[:limit]
+
+    def _run(self):
+        while self._running:
+            self._wakeup.clear()
+            with self._lock:
+                in_flight = sum(1 for j in self.jobs.values() if j["state"] == IN_FLIGHT)
+                now = time.time()
+                due = self._due_jobs(now, self.concurrency - in_flight)
+                waiting = [j["next_attempt_at"] for j in self.jobs.values() if j["state"] == QUEUED]
+            if due and not self.probe():
+                print("Offline, holding queued jobs...")
+                self._wakeup.wait(10)
+                continue
+            for job in due:
+                with self._lock:
+                    job["state"] = IN_FLIGHT
+                    job["attempts"] += 1
+                    self._append(job)
+                self._pool.submit(self._execute, job)
+            timeout = None
+            if waiting and not due:
+                timeout = max(0.5, min(waiting) - now)
+            self._wakeup.wait(timeout)
+
+    def _execute(self, job):
+        try:
+            result = self.process(job)
+        except Exception as e:
+            with self._lock:
+                job["error"] = str(e)
+                if job["attempts"] >= self.max_attempts:
+                    job["state"] = FAILED
+                else:
+                    job["state"] = QUEUED
+                    backoff = min(self.max_backoff, self.base_backoff * 2 ** (job["attempts"] - 1))
+                    job["next_attempt_at"] = time.time() + backoff
+                self._append(job)
+            print(f"Job {job['id']} attempt {job['attempts']} failed: {e}")
+        else:
+            with self._lock:
+                job["state"] = DONE
+                job["result"] = result
+                job["error"] = None
+                self._append(job)
+        self._deliveries.set()
+        self._wakeup.set()
+
+    # ========== Delivery ==========
+    def _deliver_loop(self):
+        while self._running:
+            self._deliveries.clear()
+            self._deliver_ready()
+            self._deliveries.wait()
+
+    def _deliver_ready(self):
+        """Hand finished jobs to deliver() in capture order; a pending job blocks later ones."""
+        while self._running:
+            with self._lock:
+                job = next((j for j in self.jobs.values() if j["seq"] == self.next_delivery), None)
+                if job is None:
+                    if any(j["seq"] > self.next_delivery for j in self.jobs.values()):
+                        self.next_delivery += 1  # gap left by a compacted job
+                        continue
+                    return
+                if job["state"] not in (DONE, FAILED):
+                    return
+            try:
+                self.deliver(job)
+            except Exception as e:
+                print(f"Delivering job {job['id']} failed: {e}")
+            with self._lock:
+                job["state"] = DELIVERED
+                self.next_delivery += 1
+                self._append(job)
+                self._append({"next_delivery": self.next_delivery})
+            for path in (job["audio"], job.get("image"), job["result"]):
+                if path and os.path.exists(path):
+                    os.remove(path)
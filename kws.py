@@ -0,0 +1,316 @@
+"""
+Hands-free trigger: a small NumPy keyword spotter on the capture stream.
+
+Audio is downmixed to mono and turned into log-mel frames (25 ms window,
+20 ms hop, 24 bands). The most recent template-length window of frames is
+mean-normalized per band and compared by cosine similarity with templates
+enrolled from a few recordings of the keyword, resampled to the same length.
+Scoring is one small matrix-vector product per hop, and quiet windows are not
+scored at all.
+
+CPU use is held under a budget (fraction of one core): the time spent per
+second of audio is tracked, and when it goes over, only every 2nd, 3rd or 4th
+hop is scored until it drops again. Features are still computed every hop, so
+a slow period only costs detection latency, never a missed window's audio.
+
+Detections run `on_detect(start)` on the spotter's own thread, where `start`
+is the stream time (seconds since the first byte fed, counting dropped and
+muted audio) at which the keyword began, so a recording can be cut before it.
+Audio that arrives while the callback runs is discarded, so whatever it plays
+back through the speaker can't trigger it again; muted() does the same for
+playback started elsewhere. The callback should hand anything slow to another
+thread.
+
+    python kws.py enroll data/kws_templates.npz keyword1.wav keyword2.wav ...
+    python kws.py score data/kws_templates.npz clip.wav
+"""
+import queue
+import sys
+import threading
+import time
+import wave
+from contextlib import contextmanager
+
+import numpy as np
+
+from metrics import counter, gauge
+
+RATE = 16000
+WINDOW = 400  # 25 ms
+HOP = 320  # 20 ms
+SAMPLE_BYTES = 2
+FFT_SIZE = 512
+MEL_BANDS = 24
+MEL_LOW_HZ = 60
+MEL_HIGH_HZ = 7600
+TEMPLATES_FILE = "data/kws_templates.npz"
+THRESHOLD = 0.8
+CPU_BUDGET = 0.05  # share of one core
+MAX_STRIDE = 4
+REFRACTORY_SECONDS = 1.5
+SILENCE_FLOOR = -9.0  # mean log-mel energy below which a window isn't scored
+QUEUE_CHUNKS = 50  # ~2 s of 40 ms chunks
+
+DETECTIONS = counter("odin_kws_detections_total", "Keyword detections that triggered a transition")
+STRIDE = gauge("odin_kws_stride", "Hops per scored window; above 1 while over the CPU budget")
+
+
+def mel_filterbank(rate=RATE, fft_size=FFT_SIZE, bands=MEL_BANDS, low=MEL_LOW_HZ, high=MEL_HIGH_HZ):
+    """(fft_size // 2 + 1, bands) triangular filters, equally spaced on the mel scale."""
+    def to_mel(hz):
+        return 2595 * np.log10(1 + hz / 700)
+
+    def to_hz(mel):
+        return 700 * (10 ** (mel / 2595) - 1)
+
+    edges = to_hz(np.linspace(to_mel(low), to_mel(high), bands + 2))
+    bins = np.fft.rfftfreq(fft_size, 1 / rate)
+    weights = np.zeros((bins.size, bands), dtype=np.float32)
+    for i in range(bands):
+        left, center, right = edges[i:i + 3]
+        rising = (bins - left) / (center - left)
+        falling = (right - bins) / (right - center)
+        weights[:, i] = np.maximum(0, np.minimum(rising, falling))
+    return weights
+
+
+class LogMel:
+    """Streaming log-mel frontend: feed mono float samples, get whole frames back."""
+
+    def __init__(self):
+        self.window = np.hanning(WINDOW).astype(np.float32)
+        self.filters = mel_filterbank()
+        self.pending = np.zeros(0, dtype=np.float32)
+
+    def frames(self, samples):
+        """(n, MEL_BANDS) features for every complete frame now available."""
+        self.pending = np.concatenate((self.pending, samples))
+        count = (self.pending.size - WINDOW) // HOP + 1 if self.pending.size >= WINDOW else 0
+        if count <= 0:
+            return np.zeros((0, MEL_BANDS), dtype=np.float32)
+        strided = np.lib.stride_tricks.sliding_window_view(self.pending, WINDOW)[::HOP][:count]
+        spectrum = np.fft.rfft(strided * self.window, FFT_SIZE)
+        power = spectrum.real ** 2 + spectrum.imag ** 2
+        self.pending = self.pending[count * HOP:]
+        return np.log(power.astype(np.float32) @ self.filters + 1e-6)
+
+
+def pcm_to_mono(data, channels=2):
+    """S16_LE interleaved bytes to mono float32 in [-1, 1)."""
+    samples = np.frombuffer(data, dtype="<i2").astype(np.float32)
+    if channels > 1:
+        samples = samples.reshape(-1, channels).mean(axis=1)
+    return samples / 32768
+
+
+def read_wav(path):
+    """Mono float32 samples of a 16 kHz S16_LE WAV."""
+    with wave.open(path, "rb") as wav:
+        if wav.getframerate() != RATE or wav.getsampwidth() != 2:
+            raise ValueError(f"{path}: expected 16-bit {RATE} Hz audio")
+        return pcm_to_mono(wav.readframes(wav.getnframes()), wav.getnchannels())
+
+
+def features(samples):
+    return LogMel().frames(samples)
+
+
+def normalize(window):
+    """Per-band mean removal (cancels channel and gain), then unit length."""
+    centered = window - window.mean(axis=0)
+    vector = centered.ravel()
+    norm = np.linalg.norm(vector)
+    return vector / norm if norm else vector
+
+
+def trim_silence(frames, margin=3):
+    """Drop leading and trailing frames well below the clip's loudest ones."""
+    energy = frames.mean(axis=1)
+    loud = np.flatnonzero(energy > energy.max() - 4.0)
+    if loud.size == 0:
+        return frames
+    return frames[max(0, loud[0] - margin):loud[-1] + 1 + margin]
+
+
+def resample_frames(frames, length):
+    positions = np.linspace(0, len(frames) - 1, length)
+    return np.stack([np.interp(positions, np.arange(len(frames)), band) for band in frames.T], axis=1)
+
+
+def enroll(paths):
+    """Templates from keyword recordings: ((n, frames * bands) matrix, frames per template)."""
+    return enroll_samples([read_wav(path) for path in paths])
+
+
+def enroll_samples(recordings):
+    clips = [trim_silence(features(samples)) for samples in recordings]
+    length = int(np.median([len(clip) for clip in clips]))
+    templates = np.stack([normalize(resample_frames(clip, length)) for clip in clips]).astype(np.float32)
+    return templates, length
+
+
+def save_templates(path, templates, length):
+    np.savez(path, templates=templates, length=length)
+
+
+def load_templates(path=TEMPLATES_FILE):
+    with np.load(path) as stored:
+        return stored["templates"], int(stored["length"])
+
+
+class KeywordSpotter:
+    def __init__(self, templates, length, on_detect, threshold=THRESHOLD, cpu_budget=CPU_BUDGET,
+                 channels=2, refractory=REFRACTORY_SECONDS):
+        self.templates = templates
+        self.length = length
+        self.on_detect = on_detect
+        self.threshold = threshold
+        self.cpu_budget = cpu_budget
+        self.channels = channels
+        self.refractory_hops = int(refractory * RATE / HOP)
+        self.frontend = LogMel()
+        self.history = np.full((length, MEL_BANDS), np.log(1e-6), dtype=np.float32)
+        self.stride = 1
+        self.hops = 0
+        self.samples = 0  # mono samples through the frontend
+        self.position = 0  # bytes offered to feed(), including dropped ones
+        self.detected_at = 0  # frontend sample where the last detected keyword began
+        self.audio_seconds = 0.0
+        self.cpu_seconds = 0.0
+        self.load = 0.0  # recent CPU seconds per audio second
+        self.detections = 0
+        self.last_score = 0.0
+        self._last_detection = -self.refractory_hops
+        self._muted = 0
+        self._queue = queue.Queue(QUEUE_CHUNKS)
+        self._running = False
+        self._thread = None
+        STRIDE.set(self.stride)
+
+    # ========== Stream ==========
+    def feed(self, chunk):
+        """Capture listener: copy the chunk and hand it to the spotter thread."""
+        self.position += len(chunk)
+        if self._muted:
+            return
+        try:
+            self._queue.put_nowait((bytes(chunk), self.position))
+        except queue.Full:
+            pass  # the spotter fell behind; drop audio rather than block capture
+
+    @contextmanager
+    def muted(self):
+        """Ignore the microphone inside the block (e.g. while the speaker plays an answer)."""
+        self._muted += 1
+        try:
+            yield
+        finally:
+            self._muted -= 1
+            self._drain()
+
+    def start(self):
+        self._running = True
+        self._thread = threading.Thread(target=self._run, name="kws", daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._running = False
+        if self._thread:
+            self._thread.join(timeout=2)
+
+    def _drain(self):
+        while True:
+            try:
+                self._queue.get_nowait()
+            except queue.Empty:
+                return
+
+    def _run(self):
+        while self._running:
+            try:
+                chunk, end = self._queue.get(timeout=0.5)
+            except queue.Empty:
+                continue
+            if self.process(pcm_to_mono(chunk, self.channels)):
+                DETECTIONS.inc()
+                # The chunk ends at stream sample `end`; walk back to where the keyword began
+                end //= SAMPLE_BYTES * self.channels
+                start = end - (self.samples - self.detected_at)
+                try:
+                    self.on_detect(max(0, start) / RATE)
+                except Exception as e:
+                    print(f"Keyword callback failed: {e}")
+                # Whatever was heard while the callback ran (its own beeps, playback) is stale
+                self._drain()
+                self.history[:] = np.log(1e-6)
+
+    # ========== Detection ==========
+    def process(self, samples):
+        """Run the spotter over mono samples; True if the keyword ended in them."""
+        started = time.thread_time()
+        detected = False
+        self.samples += samples.size
+        for frame in self.frontend.frames(samples):
+            self.history[:-1] = self.history[1:]
+            self.history[-1] = frame
+            self.hops += 1
+            if self.hops % self.stride or self.hops - self._last_detection < self.refractory_hops:
+                continue
+            if self.history.mean() < SILENCE_FLOOR:
+                continue
+            self.last_score = float((self.templates @ normalize(self.history)).max())
+            if self.last_score >= self.threshold:
+                self._last_detection = self.hops
+                # Frame k starts at sample (k - 1) * HOP; the window holds the last `length` frames
+                self.detected_at = (self.hops - self.length) * HOP
+                self.detections += 1
+                detected = True
+        elapsed = time.thread_time() - started
+        self._account(elapsed, samples.size / RATE)
+        return detected
+
+    def _account(self, cpu, audio):
+        self.cpu_seconds += cpu
+        self.audio_seconds += audio
+        if audio:
+            self.load += 0.1 * (cpu / audio - self.load)
+        if self.load > self.cpu_budget and self.stride < MAX_STRIDE:
+            self.stride += 1
+            STRIDE.set(self.stride)
+        elif self.load < self.cpu_budget / 2 and self.stride > 1:
+            self.stride -= 1
+            STRIDE.set(self.stride)
+
+    def stats(self):
+        return {
+            "audio_seconds": round(self.audio_seconds, 1),
+            "cpu_ms_per_audio_second": round(self.cpu_seconds / self.audio_seconds * 1000, 2)
+            if self.audio_seconds else None,
+            "stride": self.stride,
+            "detections": self.detections,
+        }
+
+
+def main():
+    if len(sys.argv) < 4 or sys.argv[1] not in ("enroll", "score"):
+        sys.exit("usage: kws.py enroll TEMPLATES.npz KEYWORD.wav... | score TEMPLATES.npz CLIP.wav...")
+    command, path = sys.argv[1], sys.argv[2]
+    if command == "enroll":
+        templates, length = enroll(sys.argv[3:])
+        save_templates(path, templates, length)
+        print(f"Saved {len(templates)} templates of {length} frames ({length * HOP / RATE:.2f}s) to {path}")
+        return
+    templates, length = load_templates(path)
+    for clip in sys.argv[3:]:
+        spotter = KeywordSpotter(templates, length, on_detect=None, cpu_budget=1.0)
+        samples = read_wav(clip)
+        best = 0.0
+        for start in range(0, samples.size, HOP * 2):
+            spotter.process(samples[start:start + HOP * 2])
+            best = max(best, spotter.last_score)
+        print(f"{clip}: best score {best:.3f} (threshold {THRESHOLD}), {spotter.detections} detections")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,290 @@
+"""
+Tiny Prometheus-style metrics registry and /metrics exporter.
+
+Counters and histograms are updated without locks: an increment is a couple of
+attribute operations under the GIL, so under heavy contention a rare update can
+be lost, which is fine for monitoring and keeps hot paths (SPI writes, frame
+draws) cheap. Histogram buckets are fixed at creation, so observe() is a bisect
+plus two additions.
+
+    from metrics import counter, histogram
+    UPLOAD_BYTES = counter("odin_upload_bytes_total", "Audio bytes uploaded")
+    UPLOAD_BYTES.inc(len(data))
+"""
+import bisect
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+DEFAULT_BUCKETS = (0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 20, 40)
+
+
+def _format_labels(names, values, extra=()):
+    pairs = list(zip(names, values)) + list(extra)
+    if not pairs:
+        return ""
+    escaped = (str(v).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n") for _, v in pairs)
+    return "{" + ",".join(f'{k}="{v}"' for (k, _), v in zip(pairs, escaped)) + "}"
+
+
+def _format_value(value):
+    if value == float("inf"):
+        return "+Inf"
+    if isinstance(value, float) and value.is_integer():
+        return str(int(value))
+    return repr(value)
+
+
+class _Metric:
+    kind = "untyped"
+
+    def __init__(self, name, help, labels=()):
+        self.name = name
+        self.help = help
+        self.label_names = tuple(labels)
+        self._children = {}
+        self._lock = threading.Lock()  # only taken when a new label set first appears
+
+    def labels(self, **values):
+        key = tuple(str(values[name]) for name in self.label_names)
+        child = self._children.get(key)
+        if child is None:
+            with self._lock:
+                child = self._children.setdefault(key, self._new_child())
+        return child
+
+    def _samples(self):
+        if not self.label_names:
+            yield (), self._default
+        else:
+            yield from list(self._children.items())
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} {self.kind}"]
+        for key, child in self._samples():
+            lines.extend(self._render_child(key, child))
+        return lines
+
+
+class _CounterValue:
+    __slots__ = ("value",)
+
+    def __init__(self):
+        self.value = 0
+
+    def inc(self, amount=1):
+        self.value += amount
+
+
+class Counter(_Metric):
+    kind = "counter"
+
+    def __init__(self, name, help, labels=()):
+        super().__init__(name, help, labels)
+        self._default = _CounterValue()
+
+    def _new_child(self):
+        return _CounterValue()
+
+    def inc(self, amount=1):
+        self._default.value += amount
+
+    @property
+    def value(self):
+        return self._default.value
+
+    def _render_child(self, key, child):
+        yield f"{self.name}{_format_labels(self.label_names, key)} {_format_value(child.value)}"
+
+
+class _GaugeValue:
+    __slots__ = ("value", "function")
+
+    def __init__(self):
+        self.value = 0
+        self.function = None
+
+    def set(self, value):
+        self.value = value
+
+    def inc(self, amount=1):
+        self.value += amount
+
+    def dec(self, amount=1):
+        self.value -= amount
+
+    def set_function(self, function):
+        """Sample `function()` at scrape time instead of storing a value."""
+        self.function = function
+
+    def get(self):
+        if self.function is None:
+            return self.value
+        try:
+            return self.function()
+        except Exception:
+            return float("nan")
+
+
+class Gauge(_Metric):
+    kind = "gauge"
+
+    def __init__(self, name, help, labels=()):
+        super().__init__(name, help, labels)
+        self._default = _GaugeValue()
+
+    def _new_child(self):
+        return _GaugeValue()
+
+    def set(self, value):
+        self._default.set(value)
+
+    def inc(self, amount=1):
+        self._default.inc(amount)
+
+    def dec(self, amount=1):
+        self._default.dec(amount)
+
+    def set_function(self, function):
+        self._default.set_function(function)
+
+    def _render_child(self, key, child):
+        yield f"{self.name}{_format_labels(self.label_names, key)} {_format_value(child.get())}"
+
+
+class _Timer:
+    __slots__ = ("histogram", "started")
+
+    def __init__(self, histogram):
+        self.histogram = histogram
+
+    def __enter__(self):
+        self.started = time.monotonic()
+        return self
+
+    def __exit__(self, *exc):
+        self.histogram.observe(time.monotonic() - self.started)
+        return False
+
+
+class _HistogramValue:
+    __slots__ = ("bounds", "counts", "sum", "count")
+
+    def __init__(self, bounds):
+        self.bounds = bounds
+        self.counts = [0] * (len(bounds) + 1)  # last slot is +Inf
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.bounds, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def time(self):
+        return _Timer(self)
+
+
+class Histogram(_Metric):
+    kind = "histogram"
+
+    def __init__(self, name, help, labels=(), buckets=DEFAULT_BUCKETS):
+        super().__init__(name, help, labels)
+        self.bounds = tuple(sorted(buckets))
+        self._default = _HistogramValue(self.bounds)
+
+    def _new_child(self):
+        return _HistogramValue(self.bounds)
+
+    def observe(self, value):
+        self._default.observe(value)
+
+    def time(self):
+        return _Timer(self._default)
+
+    def _render_child(self, key, child):
+        cumulative = 0
+        for bound, count in zip(self.bounds + (float("inf"),), child.counts):
+            cumulative += count
+            labels = _format_labels(self.label_names, key, [("le", _format_value(float(bound)))])
+            yield f"{self.name}_bucket{labels} {cumulative}"
+        labels = _format_labels(self.label_names, key)
+        yield f"{self.name}_sum{labels} {_format_value(child.sum)}"
+        yield f"{self.name}_count{labels} {child.count}"
+
+
+class Registry:
+    def __init__(self):
+        self.metrics = {}
+        self._lock = threading.Lock()
+
+    def register(self, metric):
+        """Add metric, or return the one already registered under its name (safe on re-import)."""
+        with self._lock:
+            existing = self.metrics.get(metric.name)
+            if existing is not None:
+                if type(existing) is not type(metric):
+                    raise ValueError(f"metric {metric.name} already registered as {existing.kind}")
+                return existing
+            self.metrics[metric.name] = metric
+            return metric
+
+    def render(self):
+        with self._lock:
+            metrics = list(self.metrics.values())
+        lines = []
+        for metric in metrics:
+            lines.extend(metric.render())
+        return "\n".join(lines) + "\n"
+
+
+registry = Registry()
+
+
+def counter(name, help, labels=()):
+    return registry.register(Counter(name, help, labels))
+
+
+def gauge(name, help, labels=()):
+    return registry.register(Gauge(name, help, labels))
+
+
+def histogram(name, help, labels=(), buckets=DEFAULT_BUCKETS):
+    return registry.register(Histogram(name, help, labels, buckets))
+
+
+class _MetricsHandler(BaseHTTPRequestHandler):
+    def log_message(self, format, *args):
+        pass
+
+    def do_GET(self):
+        if self.path.split("?")[0] != "/metrics":
+            self.send_error(404)
+            return
+        body = self.server.registry.render().encode("utf-8")
+        self.send_response(200)
+        self.send_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+
+class MetricsServer(ThreadingHTTPServer):
+    """Serves GET /metrics from a daemon thread."""
+
+    daemon_threads = True
+
+    def __init__(self, port=9108, host="0.0.0.0", registry=registry):
+        super().__init__((host, port), _MetricsHandler)
+        self.registry = registry
+        self._thread = None
+
+    def start(self):
+        self._thread = threading.Thread(target=self.serve_forever, name="metrics", daemon=True)
+        self._thread.start()
+        print(f"Metrics on http://{self.server_address[0]}:{self.server_address[1]}/metrics")
+        return self
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
@@ -0,0 +1,311 @@
+"""
+In-process audio mixer: every sound goes through one output stream.
+
+Sources (WAV files streamed from disk, or sample arrays such as the earcons
+below) are mixed in NumPy, 20 ms at a time, into a single S16_LE stream written
+to one long-lived `aplay` reading stdin. Nothing is spawned per sound, so
+sounds can overlap instead of queueing behind each other.
+
+Each source has a gain and a priority. While a source of higher priority is
+playing, lower ones are ducked (DUCK_DB, ramped over one period so it doesn't
+click): an error earcon can sound over an answer, and the answer plays over
+the echo of the user's recording. Sources at another rate or channel count
+are converted on the fly.
+
+Output is paced against the clock to stay at most LEAD_SECONDS ahead of the
+speaker, so a new sound is heard within about that long, rather than after
+whatever a pipe and ALSA buffer could hold. The output is closed after
+IDLE_CLOSE seconds of silence and reopened by the next sound.
+"""
+import subprocess
+import threading
+import time
+import wave
+
+import numpy as np
+
+from metrics import counter
+
+MIX_RATE = 16000  # what arecord and the TTS answers use
+CHANNELS = 2
+PERIOD_MS = 20
+LEAD_SECONDS = 0.08  # also aplay's buffer, so the two agree on latency
+DUCK_DB = -14
+IDLE_CLOSE = 10.0
+APLAY_DEVICE = "plughw:wm8960soundcard"
+
+BACKGROUND, SPEECH, ALERT = 0, 1, 2  # source priorities
+
+SOURCES = counter("odin_mixer_sources_total", "Sounds started through the mixer", ("priority",))
+SPAWNS = counter("odin_subprocess_spawns_total", "External tools started", ("command",))
+
+
+def tone(freqs, seconds, rate=MIX_RATE, volume=0.3, fade=0.01):
+    """A sine glide through `freqs`, faded in and out; (n, CHANNELS) float32."""
+    n = int(seconds * rate)
+    freq = np.interp(np.arange(n), np.linspace(0, n - 1, len(freqs)), freqs)
+    samples = np.sin(2 * np.pi * np.cumsum(freq) / rate) * volume
+    ramp = np.minimum(1, np.minimum(np.arange(n), n - 1 - np.arange(n)) / max(1, fade * rate))
+    return np.repeat((samples * ramp).astype(np.float32)[:, None], CHANNELS, axis=1)
+
+
+def silence(seconds, rate=MIX_RATE):
+    return np.zeros((int(seconds * rate), CHANNELS), dtype=np.float32)
+
+
+EARCONS = {
+    "processing": lambda: np.concatenate((tone((660,), 0.06), silence(0.04), tone((880,), 0.06))),
+    "error": lambda: np.concatenate((tone((330,), 0.15), silence(0.03), tone((220,), 0.25))),
+}
+
+
+class Resampler:
+    """Streaming linear interpolation from rate_in to rate_out, block by block."""
+
+    def __init__(self, rate_in, rate_out):
+        self.step = rate_in / rate_out
+        self.position = 0.0  # next output sample, in input samples from the start of `previous`
+        self.previous = None
+
+    def process(self, block):
+        if self.previous is not None:
+            block = np.concatenate((self.previous, block))
+        count = int(np.floor((len(block) - 1 - self.position) / self.step)) + 1 if len(block) > 1 else 0
+        if count <= 0:
+            self.previous = block
+            return np.zeros((0, block.shape[1]), dtype=np.float32)
+        positions = self.position + np.arange(count) * self.step
+        base = np.arange(len(block))
+        out = np.stack([np.interp(positions, base, block[:, c]) for c in range(block.shape[1])], axis=1)
+        next_position = self.position + count * self.step
+        keep = int(np.floor(next_position))
+        self.previous = block[keep:]
+        self.position = next_position - keep
+        return out.astype(np.float32)
+
+
+class Source:
+    def __init__(self, name, gain=1.0, priority=SPEECH):
+        self.name = name
+        self.gain = gain
+        self.priority = priority
+        self.duck = 1.0  # gain the mixer applied at the end of the last period
+        self.stopped = False
+        self.done = threading.Event()
+
+    def read(self, frames):
+        """Up to `frames` frames at the mixer's rate as (n, CHANNELS) float32; fewer means finished."""
+        raise NotImplementedError
+
+    def close(self):
+        pass
+
+    def stop(self):
+        self.stopped = True
+
+    def wait(self, timeout=None):
+        return self.done.wait(timeout)
+
+
+class ArraySource(Source):
+    def __init__(self, samples, name="array", **kwargs):
+        super().__init__(name, **kwargs)
+        self.samples = samples
+        self.position = 0
+
+    def read(self, frames):
+        block = self.samples[self.position:self.position + frames]
+        self.position += len(block)
+        return block
+
+
+class WavSource(Source):
+    """A 16-bit WAV read from disk as it plays, converted to the mixer's rate and channels."""
+
+    def __init__(self, path, rate=MIX_RATE, **kwargs):
+        super().__init__(path, **kwargs)
+        self.wav = wave.open(path, "rb")
+        if self.wav.getsampwidth() != 2:
+            self.wav.close()
+            raise ValueError(f"{path}: only 16-bit WAVs are supported")
+        self.channels = self.wav.getnchannels()
+        self.resampler = Resampler(self.wav.getframerate(), rate) if self.wav.getframerate() != rate else None
+        self.step = self.wav.getframerate() / rate
+        self.buffer = np.zeros((0, CHANNELS), dtype=np.float32)
+        self.eof = False
+
+    def _convert(self, data):
+        samples = np.frombuffer(data, dtype="<i2").astype(np.float32).reshape(-1, self.channels) / 32768
+        if self.channels == 1:
+            samples = np.repeat(samples, CHANNELS, axis=1)
+        elif self.channels > CHANNELS:
+            samples = samples[:, :CHANNELS]
+        return self.resampler.process(samples) if self.resampler else samples
+
+    def read(self, frames):
+        while len(self.buffer) < frames and not self.eof:
+            data = self.wav.readframes(int(frames * self.step) + 2)
+            if not data:
+                self.eof = True
+                break
+            self.buffer = np.concatenate((self.buffer, self._convert(data)))
+        block, self.buffer = self.buffer[:frames], self.buffer[frames:]
+        return block
+
+    def close(self):
+        self.wav.close()
+
+
+class AplayOutput:
+    """One aplay reading raw PCM from a pipe, started on the first write."""
+
+    def __init__(self, rate=MIX_RATE, channels=CHANNELS, device=APLAY_DEVICE, buffer_seconds=LEAD_SECONDS):
+        self.command = ['aplay', '-q', '-D', device, '-t', 'raw', '-f', 'S16_LE', '-r', str(rate),
+                        '-c', str(channels), f'--buffer-time={int(buffer_seconds * 1e6)}']
+        self.process = None
+
+    def write(self, data):
+        if self.process is None or self.process.poll() is not None:
+            SPAWNS.labels(command="aplay").inc()
+            self.process = subprocess.Popen(self.command, stdin=subprocess.PIPE, bufsize=0)
+        try:
+            self.process.stdin.write(data)
+        except BrokenPipeError:
+            print("Mixer: aplay went away, reopening on the next period")
+            self.process = None
+
+    def close(self):
+        if self.process is not None:
+            try:
+                self.process.stdin.close()
+            except BrokenPipeError:
+                pass
+            self.process.wait()
+            self.process = None
+
+
+class Mixer:
+    def __init__(self, output=None, rate=MIX_RATE, period_ms=PERIOD_MS, duck_db=DUCK_DB,
+                 lead=LEAD_SECONDS, idle_close=IDLE_CLOSE):
+        self.output = output or AplayOutput(rate, buffer_seconds=lead)
+        self.rate = rate
+        self.frames = rate * period_ms // 1000
+        self.duck_gain = 10 ** (duck_db / 20)
+        self.lead = lead
+        self.idle_close = idle_close
+        self.sources = []
+        self.periods = 0
+        self.clipped = 0
+        self._earcons = {}
+        self._cond = threading.Condition()
+        self._running = False
+        self._thread = None
+
+    # ========== Playing ==========
+    def play(self, sound, gain=1.0, priority=SPEECH, name=None):
+        """Start a WAV path or (n, CHANNELS) float32 array; returns its Source (wait()/stop())."""
+        if isinstance(sound, str):
+            source = WavSource(sound, self.rate, gain=gain, priority=priority)
+        else:
+            source = ArraySource(sound, name or "array", gain=gain, priority=priority)
+        # Sources that start under something more important begin ducked
+        with self._cond:
+            top = max((s.priority for s in self.sources), default=priority)
+            source.duck = 1.0 if priority >= top else self.duck_gain
+            self.sources.append(source)
+            self._cond.notify()
+        SOURCES.labels(priority=str(priority)).inc()
+        return source
+
+    def earcon(self, name, gain=1.0, priority=ALERT):
+        samples = self._earcons.get(name)
+        if samples is None:
+            samples = self._earcons[name] = EARCONS[name]()
+        return self.play(samples, gain=gain, priority=priority, name=name)
+
+    def stop_all(self):
+        with self._cond:
+            for source in self.sources:
+                source.stop()
+
+    # ========== Mixing thread ==========
+    def start(self):
+        self._running = True
+        self._thread = threading.Thread(target=self._run, name="mixer", daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self.stop_all()
+        with self._cond:
+            self._running = False
+            self._cond.notify()
+        if self._thread:
+            self._thread.join(timeout=2)
+        self.output.close()
+
+    def mix(self):
+        """Mix one period; returns S16_LE bytes, or None when nothing is playing."""
+        with self._cond:
+            sources = list(self.sources)
+        if not sources:
+            return None
+        out = np.zeros((self.frames, CHANNELS), dtype=np.float32)
+        top = max(source.priority for source in sources)
+        finished = []
+        for source in sources:
+            block = np.zeros((0, CHANNELS), dtype=np.float32) if source.stopped else source.read(self.frames)
+            target = 1.0 if source.priority >= top else self.duck_gain
+            n = len(block)
+            if n:
+                ramp = np.linspace(source.duck, target, self.frames, dtype=np.float32)[:n, None]
+                out[:n] += block * ramp * source.gain
+            source.duck = target
+            if n < self.frames:
+                finished.append(source)
+        with self._cond:
+            for source in finished:
+                self.sources.remove(source)
+        for source in finished:
+            source.close()
+            source.done.set()
+        # Always clip: a sample in (32767/32768, 1.0] would wrap to -32768 below
+        if out.max() > 32767 / 32768 or out.min() < -1.0:
+            self.clipped += 1
+        np.clip(out, -1.0, 32767 / 32768, out=out)
+        self.periods += 1
+        return (out * 32768).astype("<i2").tobytes()
+
+    def _run(self):
+        started, written = None, 0
+        idle_since = time.monotonic()
+        while True:
+            with self._cond:
+                if not self._running:
+                    return
+                if not self.sources:
+                    if self.idle_close and time.monotonic() - idle_since >= self.idle_close:
+                        self.output.close()
+                        self._cond.wait()
+                    else:
+                        self._cond.wait(self.idle_close or None)
+                    started = None
+                    continue
+            data = self.mix()
+            if data is None:
+                continue
+            now = time.monotonic()
+            if started is None or written / self.rate < now - started:
+                # Starting or fell behind (underrun): restart the clock from here
+                started, written = now, 0
+            self.output.write(data)
+            written += self.frames
+            ahead = written / self.rate - (time.monotonic() - started)
+            if ahead > self.lead:
+                time.sleep(ahead - self.lead)
+            idle_since = time.monotonic()
+
+    def stats(self):
+        with self._cond:
+            playing = [source.name for source in self.sources]
+        return {"playing": playing, "periods": self.periods, "clipped_periods": self.clipped}
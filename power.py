@@ -0,0 +1,188 @@
+"""
+Idle power governor for the panel and the main loop.
+
+The main thread blocks in PowerGovernor.run() until the next inactivity
+deadline instead of polling. After inactivity the panel steps down:
+
+  active  backlight at full brightness, 60 Hz refresh
+  dim     backlight dimmed, refresh lowered to 39 Hz
+  idle    backlight low, ST7789 idle mode (8 colours)
+  sleep   backlight off, display off, ST7789 sleep mode
+
+Any activity (a button edge, an answer arriving, a remote frame) brings the
+panel straight back to active from the calling thread. Waking from sleep is
+bounded by the controller's timing: at most 120 ms since the last SLPIN plus
+5 ms after SLPOUT. Frame memory survives sleep, so nothing has to be redrawn.
+
+Current can't be measured from software, so stats() reports proxies: time in
+each state, backlight duty-seconds and how often the governor thread woke up.
+"""
+import threading
+import time
+from collections import deque
+from contextlib import contextmanager
+
+from metrics import counter, gauge, histogram
+
+ACTIVE, DIM, IDLE, SLEEP = "active", "dim", "idle", "sleep"
+STATES = (ACTIVE, DIM, IDLE, SLEEP)
+
+STATE_SECONDS = counter("odin_power_state_seconds_total", "Time spent in each power state, counted on leaving it",
+                        ("state",))
+WAKE_LATENCY = histogram("odin_wake_latency_seconds", "Activity to panel restored, when it was not active",
+                         ("from_state",), buckets=(0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.15, 0.25, 0.5))
+GOVERNOR_WAKEUPS = counter("odin_governor_wakeups_total", "Times the governor thread woke up")
+BACKLIGHT_DUTY = counter("odin_backlight_duty_seconds_total", "Backlight brightness integrated over time (1.0 = full)")
+
+
+class PowerGovernor:
+    """
+    Steps the panel down after dim_after, idle_after and sleep_after seconds
+    without activity (0 or None skips that step). hold()/release() or awake()
+    keep it active while something long-running is going on, such as recording
+    or playing an answer; the timers restart when the last hold is released.
+    """
+
+    def __init__(self, board, brightness=50, dim_brightness=10, idle_brightness=3,
+                 dim_after=30, idle_after=120, sleep_after=600):
+        self.board = board
+        self.brightness = {ACTIVE: brightness, DIM: dim_brightness, IDLE: idle_brightness, SLEEP: 0}
+        self.after = {DIM: dim_after, IDLE: idle_after, SLEEP: sleep_after}
+        self.state = ACTIVE
+        self.last_activity = time.monotonic()
+        self.wake_latencies = deque(maxlen=500)
+        self.wakeups = 0
+        self.state_seconds = dict.fromkeys(STATES, 0.0)
+        self.backlight_duty_seconds = 0.0
+        self._state_since = self.last_activity
+        self._started_at = self.last_activity
+        self._holds = 0
+        self._listeners = []
+        self._running = False
+        self._cond = threading.Condition()
+        gauge("odin_power_state", "0 active, 1 dim, 2 idle, 3 sleep").set_function(lambda: STATES.index(self.state))
+
+    def on_change(self, callback):
+        """callback(old_state, new_state), called after the panel has been switched."""
+        self._listeners.append(callback)
+
+    def activity(self, at=None):
+        """
+        Note activity at monotonic time `at` (default now) and wake the panel if
+        needed. Returns the wake latency in seconds, 0 if it was already active.
+        """
+        at = time.monotonic() if at is None else at
+        with self._cond:
+            self.last_activity = max(self.last_activity, at)
+            previous = self.state
+            if previous != ACTIVE:
+                self._enter(ACTIVE)
+                self._cond.notify()
+            # Otherwise the governor finds the later deadline when it next wakes; no need to disturb it
+        if previous == ACTIVE:
+            return 0.0
+        latency = time.monotonic() - at
+        self.wake_latencies.append(latency)
+        WAKE_LATENCY.labels(from_state=previous).observe(latency)
+        return latency
+
+    def hold(self):
+        self.activity()
+        with self._cond:
+            self._holds += 1
+
+    def release(self):
+        with self._cond:
+            self._holds = max(0, self._holds - 1)
+            self.last_activity = time.monotonic()
+            self._cond.notify()
+
+    @contextmanager
+    def awake(self):
+        self.hold()
+        try:
+            yield
+        finally:
+            self.release()
+
+    def run(self):
+        """Block the calling thread, stepping the panel down on schedule, until stop()."""
+        with self._cond:
+            self._running = True
+            while self._running:
+                target, due = self._next_transition()
+                timeout = None if target is None else due - time.monotonic()
+                if timeout is not None and timeout <= 0:
+                    self._enter(target)
+                    continue
+                self._cond.wait(timeout)
+                self.wakeups += 1
+                GOVERNOR_WAKEUPS.inc()
+
+    def stop(self):
+        with self._cond:
+            self._running = False
+            self._cond.notify()
+
+    def _next_transition(self):
+        if self._holds:
+            return None, None
+        for state in STATES[STATES.index(self.state) + 1:]:
+            if self.after[state]:
+                return state, self.last_activity + self.after[state]
+        return None, None
+
+    def _account(self, now):
+        elapsed = now - self._state_since
+        self.state_seconds[self.state] += elapsed
+        STATE_SECONDS.labels(state=self.state).inc(elapsed)
+        duty = elapsed * self.brightness[self.state] / 100
+        self.backlight_duty_seconds += duty
+        BACKLIGHT_DUTY.inc(duty)
+        self._state_since = now
+
+    def _enter(self, state):
+        """Switch the panel to `state`; called with the condition held."""
+        old = self.state
+        self._account(time.monotonic())
+        board = self.board
+        if state == ACTIVE:
+            # Panel first, backlight last, so the wake never shows a blank or 8-colour frame
+            board.wake()
+            if old in (IDLE, SLEEP):
+                board.set_idle_mode(False)
+            board.set_frame_rate(board.FRAME_RATE_60HZ)
+        elif state == DIM:
+            board.set_frame_rate(board.FRAME_RATE_39HZ)
+        elif state == IDLE:
+            board.set_frame_rate(board.FRAME_RATE_39HZ)
+            board.set_idle_mode(True)
+        board.set_backlight(self.brightness[state])
+        if state == SLEEP:
+            board.sleep()
+        self.state = state
+        print(f"Power: {old} -> {state}")
+        for callback in self._listeners:
+            try:
+                callback(old, state)
+            except Exception as e:
+                print(f"Power listener failed: {e}")
+
+    def stats(self):
+        with self._cond:
+            now = time.monotonic()
+            state_seconds = dict(self.state_seconds)
+            state_seconds[self.state] += now - self._state_since
+            duty = self.backlight_duty_seconds + (now - self._state_since) * self.brightness[self.state] / 100
+            latencies = sorted(self.wake_latencies)
+        uptime = now - self._started_at
+        return {
+            "state": self.state,
+            "state_seconds": {state: round(seconds, 1) for state, seconds in state_seconds.items()},
+            "backlight_duty_seconds": round(duty, 1),
+            "mean_backlight": round(duty / uptime * 100, 1) if uptime else 0,
+            "governor_wakeups_per_min": round(self.wakeups / uptime * 60, 2) if uptime else 0,
+            "wakes": len(latencies),
+            "wake_latency_p50_ms": round(latencies[len(latencies) // 2] * 1000, 1) if latencies else None,
+            "wake_latency_max_ms": round(latencies[-1] * 1000, 1) if latencies else None,
+        }
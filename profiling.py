@@ -0,0 +1,276 @@
+"""
+Runtime memory profiling: allocations and GC pauses per pipeline stage.
+
+Wrap a hot path in a stage; while profiling is off this costs one attribute
+check, so the stages stay in production code:
+
+    from profiling import profiler
+    with profiler.stage("compositor.render"):
+        ...
+
+profiler.enable() starts tracemalloc and a gc callback. Each stage then records
+how many bytes it left allocated, its peak above the starting point, and the
+collector pauses that happened inside it. Budgets (PROFILE_BUDGETS in
+config.json, peak bytes per stage) are checked by check_budgets(), which
+tools/alloc_budget.py turns into a pass/fail exit code.
+
+tracemalloc is process-wide, so figures for a stage include whatever other
+threads allocated at the same time; measure budgets single-threaded.
+"""
+import gc
+import json
+import os
+import signal
+import threading
+import time
+import tracemalloc
+
+from metrics import counter, gauge, histogram
+
+PROFILE_FILE = "data/profile.json"
+TRACE_FRAMES = 5
+TOP_SITES = 5
+
+GC_PAUSE_SECONDS = histogram("odin_gc_pause_seconds", "Garbage collector pauses while profiling", ("generation",),
+                             buckets=(0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1))
+BUDGET_VIOLATIONS = counter("odin_alloc_budget_violations_total", "Stage runs whose peak exceeded the budget",
+                            ("stage",))
+gauge("odin_gc_frozen_objects", "Objects moved to the permanent generation by gc.freeze()").set_function(
+    gc.get_freeze_count)
+
+
+def load_budgets(path="config.json"):
+    try:
+        with open(path) as f:
+            return dict(json.load(f).get("PROFILE_BUDGETS", {}))
+    except (OSError, ValueError):
+        return {}
+
+
+class AllocationBudgetExceeded(Exception):
+    """A stage allocated more than its budget."""
+
+
+class StageStats:
+    __slots__ = ("calls", "net_bytes", "max_peak_bytes", "last_peak_bytes", "seconds",
+                 "gc_pauses", "gc_seconds", "max_gc_pause", "top_sites")
+
+    def __init__(self):
+        self.calls = 0
+        self.net_bytes = 0
+        self.max_peak_bytes = 0
+        self.last_peak_bytes = 0
+        self.seconds = 0.0
+        self.gc_pauses = 0
+        self.gc_seconds = 0.0
+        self.max_gc_pause = 0.0
+        self.top_sites = []
+
+    def as_dict(self):
+        return {
+            "calls": self.calls,
+            "net_bytes": self.net_bytes,
+            "max_peak_bytes": self.max_peak_bytes,
+            "mean_seconds": round(self.seconds / self.calls, 6) if self.calls else 0,
+            "gc_pauses": self.gc_pauses,
+            "gc_seconds": round(self.gc_seconds, 6),
+            "max_gc_pause": round(self.max_gc_pause, 6),
+            "top_sites": self.top_sites,
+        }
+
+
+def _own_traces(snapshot):
+    """Drop the profiler's and tracemalloc's own bookkeeping from a snapshot."""
+    return snapshot.filter_traces((tracemalloc.Filter(False, tracemalloc.__file__),
+                                   tracemalloc.Filter(False, __file__)))
+
+
+class _NullStage:
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+
+_NULL_STAGE = _NullStage()
+
+
+class _Stage:
+    __slots__ = ("profiler", "name", "start_bytes", "peak_seen", "started", "snapshot")
+
+    def __init__(self, profiler, name):
+        self.profiler = profiler
+        self.name = name
+
+    def __enter__(self):
+        stack = self.profiler._stack()
+        # Snapshot first so its own allocations are not charged to the stage
+        self.snapshot = tracemalloc.take_snapshot() if self.profiler.snapshots else None
+        current, peak = tracemalloc.get_traced_memory()
+        if stack:
+            # The enclosing stage's peak must survive the reset below
+            stack[-1].peak_seen = max(stack[-1].peak_seen, peak)
+        tracemalloc.reset_peak()
+        self.start_bytes = current
+        self.peak_seen = current
+        stack.append(self)
+        self.started = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        elapsed = time.perf_counter() - self.started
+        current, peak = tracemalloc.get_traced_memory()
+        stack = self.profiler._stack()
+        stack.pop()
+        peak = max(peak, self.peak_seen)
+        if stack:
+            stack[-1].peak_seen = max(stack[-1].peak_seen, peak)
+        top = None
+        if self.snapshot is not None:
+            diff = _own_traces(tracemalloc.take_snapshot()).compare_to(_own_traces(self.snapshot), "lineno")
+            top = [str(stat) for stat in diff[:TOP_SITES]]
+        self.profiler._finish(self.name, current - self.start_bytes, peak - self.start_bytes, elapsed, top)
+        return False
+
+
+class Profiler:
+    """
+    Per-stage allocation and GC pause accounting, off until enable() is called.
+    Budget violations are counted and reported; with strict=True they raise
+    AllocationBudgetExceeded from the offending stage instead.
+    """
+
+    def __init__(self, budgets=None, strict=False):
+        self.budgets = dict(budgets or {})
+        self.strict = strict
+        self.enabled = False
+        self.snapshots = False
+        self.stats = {}
+        self._lock = threading.Lock()
+        self._local = threading.local()
+        self._started_tracemalloc = False
+
+    def enable(self, snapshots=False):
+        """Start tracing. snapshots=True also keeps the top allocation sites per stage (much slower)."""
+        if self.enabled:
+            return self
+        if not tracemalloc.is_tracing():
+            tracemalloc.start(TRACE_FRAMES)
+            self._started_tracemalloc = True
+        self.snapshots = snapshots
+        gc.callbacks.append(self._on_gc)
+        self.enabled = True
+        return self
+
+    def disable(self):
+        if not self.enabled:
+            return
+        self.enabled = False
+        gc.callbacks.remove(self._on_gc)
+        if self._started_tracemalloc:
+            tracemalloc.stop()
+            self._started_tracemalloc = False
+
+    def toggle(self, path=PROFILE_FILE):
+        """Switch profiling on, or off and write the report to `path`."""
+        if not self.enabled:
+            self.reset()
+            self.enable()
+            print("Profiling enabled")
+        else:
+            self.disable()
+            self.dump(path)
+            print(f"Profiling disabled, report written to {path}")
+
+    def install_signal(self, signum=signal.SIGUSR1, path=PROFILE_FILE):
+        """`kill -USR1 <pid>` toggles profiling on a running unit."""
+        signal.signal(signum, lambda *_: self.toggle(path))
+
+    def stage(self, name):
+        if not self.enabled:
+            return _NULL_STAGE
+        return _Stage(self, name)
+
+    def _stack(self):
+        stack = getattr(self._local, "stack", None)
+        if stack is None:
+            stack = self._local.stack = []
+        return stack
+
+    def _stats(self, name):
+        stats = self.stats.get(name)
+        if stats is None:
+            with self._lock:
+                stats = self.stats.setdefault(name, StageStats())
+        return stats
+
+    def _finish(self, name, net, peak, elapsed, top):
+        stats = self._stats(name)
+        stats.calls += 1
+        stats.net_bytes += net
+        stats.last_peak_bytes = peak
+        stats.max_peak_bytes = max(stats.max_peak_bytes, peak)
+        stats.seconds += elapsed
+        if top is not None:
+            stats.top_sites = top
+        budget = self.budgets.get(name)
+        if budget is not None and peak > budget:
+            BUDGET_VIOLATIONS.labels(stage=name).inc()
+            if self.strict:
+                raise AllocationBudgetExceeded(f"{name} peaked at {peak} bytes, budget {budget}")
+
+    def _on_gc(self, phase, info):
+        if phase == "start":
+            self._local.gc_started = time.perf_counter()
+            return
+        started = getattr(self._local, "gc_started", None)
+        if started is None:
+            return
+        pause = time.perf_counter() - started
+        self._local.gc_started = None
+        GC_PAUSE_SECONDS.labels(generation=info["generation"]).observe(pause)
+        stack = self._stack()
+        stats = self._stats(stack[-1].name if stack else "(outside stages)")
+        stats.gc_pauses += 1
+        stats.gc_seconds += pause
+        stats.max_gc_pause = max(stats.max_gc_pause, pause)
+
+    def check_budgets(self):
+        """[(stage, max_peak_bytes, budget)] for every stage that went over."""
+        return [(name, self.stats[name].max_peak_bytes, budget)
+                for name, budget in sorted(self.budgets.items())
+                if name in self.stats and self.stats[name].max_peak_bytes > budget]
+
+    def reset(self):
+        with self._lock:
+            self.stats = {}
+
+    def report(self):
+        with self._lock:
+            stats = dict(self.stats)
+        return {
+            "stages": {name: dict(s.as_dict(), budget=self.budgets.get(name)) for name, s in sorted(stats.items())},
+            "over_budget": [name for name, _, _ in self.check_budgets()],
+            "gc": {"counts": gc.get_count(), "frozen": gc.get_freeze_count(), "stats": gc.get_stats()},
+        }
+
+    def dump(self, path=PROFILE_FILE):
+        tmp = path + ".tmp"
+        with open(tmp, "w") as f:
+            json.dump(self.report(), f, indent=2)
+        os.replace(tmp, path)
+
+
+def freeze_after_boot():
+    """
+    Collect once, then move every surviving object (fonts, cached backgrounds,
+    atlases, modules) to the permanent generation so later collections stop
+    rescanning them. Call after assets are loaded, before the main loop.
+    """
+    gc.collect()
+    gc.freeze()
+    return gc.get_freeze_count()
+
+
+profiler = Profiler(load_budgets())
@@ -0,0 +1,214 @@
+"""
+Quota- and rate-limit-aware admission for Gemini requests.
+
+Every generateContent request asks the scheduler for a slot first (once, however
+many hedged duplicates it later sends), and so does every recording upload, under
+the name "files". Per model it keeps two token buckets from MODEL_LIMITS in
+config.json, requests per minute and tokens per minute, and honours the back-off the server asked for on a 429
+(Retry-After header or RetryInfo.retryDelay in the error body). Token use is
+charged from an estimate at admission and corrected from usageMetadata once
+the response has been parsed.
+
+Requests are interactive (someone is waiting for the answer) or background
+(offline-queue retries, cache prewarming). Background requests wait while any
+interactive request is waiting and may only use the buckets above a reserve, so
+a queue flush never starves the next question of quota.
+
+If a model can't be admitted before the caller's deadline, acquire() raises
+ModelUnavailable straight away so the router fails over to the next model
+instead of sleeping.
+"""
+import threading
+import time
+from contextlib import contextmanager
+from email.utils import parsedate_to_datetime
+
+from metrics import counter, histogram
+from router import ModelUnavailable
+
+INTERACTIVE = "interactive"
+BACKGROUND = "background"
+BACKGROUND_RESERVE = 0.25  # share of each bucket background work must leave untouched
+DEFAULT_RETRY_AFTER = 10.0  # seconds to back off on a 429 that says nothing
+FILE_PART_TOKENS = 300  # rough cost of an uploaded recording or image, corrected from usageMetadata
+
+SCHEDULER_WAIT = histogram("odin_scheduler_wait_seconds", "Time requests waited for rate-limit headroom",
+                           ("priority",), buckets=(0.01, 0.1, 0.5, 1, 2.5, 5, 10, 30))
+RATE_LIMITED = counter("odin_rate_limited_total", "429 and quota responses from Gemini", ("model",))
+TOKENS_USED = counter("odin_gemini_tokens_total", "Tokens reported in usageMetadata", ("model", "kind"))
+
+
+def estimate_request_tokens(payload):
+    """Rough input size of a serialized generateContent body (~4 characters per token)."""
+    return len(payload) // 4 + payload.count('"file_uri"') * FILE_PART_TOKENS
+
+
+def retry_after_seconds(response, default=DEFAULT_RETRY_AFTER):
+    """Back-off requested by a 429/503: Retry-After (seconds or HTTP date), else RetryInfo in the body."""
+    header = response.headers.get("Retry-After")
+    if header:
+        try:
+            return max(0.0, float(header))
+        except ValueError:
+            try:
+                return max(0.0, parsedate_to_datetime(header).timestamp() - time.time())
+            except (TypeError, ValueError):
+                pass
+    try:
+        details = response.json()["error"].get("details", [])
+    except (ValueError, KeyError, AttributeError, TypeError):
+        return default
+    for detail in details:
+        delay = detail.get("retryDelay") if isinstance(detail, dict) else None
+        if isinstance(delay, str) and delay.endswith("s"):
+            try:
+                return max(0.0, float(delay[:-1]))
+            except ValueError:
+                pass
+    return default
+
+
+class Bucket:
+    """`per_minute` units per minute, holding at most a minute's worth."""
+
+    def __init__(self, per_minute):
+        self.capacity = float(per_minute)
+        self.rate = per_minute / 60.0
+        self.level = self.capacity
+        self.updated = time.monotonic()
+
+    def refill(self, now):
+        self.level = min(self.capacity, self.level + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def wait_for(self, amount, reserve=0.0):
+        """Seconds until `amount` can be taken while leaving `reserve` of the capacity."""
+        need = min(amount, self.capacity) + reserve * self.capacity - self.level
+        return max(0.0, need / self.rate) if self.rate else float("inf")
+
+
+class ModelQuota:
+    def __init__(self, rpm=None, tpm=None):
+        self.requests = Bucket(rpm) if rpm else None
+        self.tokens = Bucket(tpm) if tpm else None
+        self.blocked_until = 0.0
+        self.sent = 0
+        self.rate_limited = 0
+        self.usage = {"prompt": 0, "cached": 0, "output": 0, "total": 0}
+
+    def wait_for(self, now, tokens, reserve):
+        waits = [self.blocked_until - now]
+        for bucket, amount in ((self.requests, 1), (self.tokens, tokens)):
+            if bucket is not None:
+                bucket.refill(now)
+                waits.append(bucket.wait_for(amount, reserve))
+        return max(0.0, *waits)
+
+    def take(self, tokens):
+        self.sent += 1
+        if self.requests is not None:
+            self.requests.level -= 1
+        if self.tokens is not None:
+            self.tokens.level -= tokens
+
+    def snapshot(self, now):
+        return {
+            "sent": self.sent,
+            "rate_limited": self.rate_limited,
+            "blocked_for": round(max(0.0, self.blocked_until - now), 1),
+            "requests_available": round(self.requests.level, 1) if self.requests else None,
+            "tokens_available": int(self.tokens.level) if self.tokens else None,
+            "usage": dict(self.usage),
+        }
+
+
+class QuotaScheduler:
+    def __init__(self, limits=None):
+        """limits: {model: {"rpm": N, "tpm": N}}; models without an entry are only held back by 429s."""
+        self.limits = dict(limits or {})
+        self.models = {}
+        self.waiting = {INTERACTIVE: 0, BACKGROUND: 0}
+        self._cond = threading.Condition()
+        self._local = threading.local()
+
+    def _quota(self, model):
+        quota = self.models.get(model)
+        if quota is None:
+            limits = self.limits.get(model, {})
+            quota = self.models[model] = ModelQuota(limits.get("rpm"), limits.get("tpm"))
+        return quota
+
+    # ========== Priority ==========
+    def current_priority(self):
+        return getattr(self._local, "priority", INTERACTIVE)
+
+    @contextmanager
+    def priority(self, priority):
+        """Requests made by this thread inside the block are scheduled at `priority`."""
+        previous = self.current_priority()
+        self._local.priority = priority
+        try:
+            yield
+        finally:
+            self._local.priority = previous
+
+    # ========== Admission ==========
+    def acquire(self, model, tokens, deadline, priority=INTERACTIVE):
+        """Wait for room to send one request of about `tokens` to `model`, within `deadline`."""
+        started = time.monotonic()
+        reserve = BACKGROUND_RESERVE if priority == BACKGROUND else 0.0
+        with self._cond:
+            quota = self._quota(model)
+            self.waiting[priority] += 1
+            try:
+                while True:
+                    now = time.monotonic()
+                    wait = quota.wait_for(now, tokens, reserve)
+                    if priority == BACKGROUND and self.waiting[INTERACTIVE]:
+                        wait = max(wait, 0.5)  # re-check once the interactive requests are through
+                    if wait <= 0:
+                        quota.take(tokens)
+                        break
+                    if wait > deadline.remaining():
+                        raise ModelUnavailable(f"{model} rate limited for another {wait:.1f}s")
+                    self._cond.wait(wait)
+            finally:
+                self.waiting[priority] -= 1
+                self._cond.notify_all()
+        SCHEDULER_WAIT.labels(priority=priority).observe(time.monotonic() - started)
+
+    def rate_limited(self, model, retry_after):
+        """The server refused `model` with a 429; hold it back for `retry_after` seconds."""
+        RATE_LIMITED.labels(model=model).inc()
+        with self._cond:
+            quota = self._quota(model)
+            quota.rate_limited += 1
+            quota.blocked_until = max(quota.blocked_until, time.monotonic() + retry_after)
+            if quota.requests is not None:
+                quota.requests.level = min(quota.requests.level, 0)
+        print(f"{model} rate limited, backing off {retry_after:.1f}s")
+
+    def record_usage(self, model, usage, estimated):
+        """Correct the token bucket from a response's usageMetadata (estimated = what acquire() charged)."""
+        if not usage:
+            return
+        total = usage.get("totalTokenCount") or (
+            usage.get("promptTokenCount", 0) + usage.get("candidatesTokenCount", 0))
+        counts = {"prompt": usage.get("promptTokenCount", 0), "cached": usage.get("cachedContentTokenCount", 0),
+                  "output": usage.get("candidatesTokenCount", 0), "total": total}
+        for kind in ("prompt", "cached", "output"):
+            if counts[kind]:
+                TOKENS_USED.labels(model=model, kind=kind).inc(counts[kind])
+        with self._cond:
+            quota = self._quota(model)
+            for kind, count in counts.items():
+                quota.usage[kind] += count
+            if quota.tokens is not None:
+                quota.tokens.level -= total - estimated
+            self._cond.notify_all()
+
+    def snapshot(self):
+        with self._cond:
+            now = time.monotonic()
+            return {model: quota.snapshot(now) for model, quota in self.models.items()}
+
@@ -0,0 +1,484 @@
+"""
+Remote display/control protocol for the Whisplay screen.
+
+Every message is a 5-byte header (type: u8, length: u32 big-endian) followed by
+the payload:
+
+    HELLO   server -> client  JSON {width, height, tile, codecs, window}
+    UPDATE  client -> server  JSON with update_display_data fields; image_path
+                              names a PNG or JPEG in the server's image
+                              directory, anything else is dropped
+    FRAME   client -> server  seq u32, codec u8, flags u8, tile count u16, then the
+                              compressed tile list: per tile x u16, y u16 (tile
+                              indices) and its RGB565 big-endian pixels
+    ACK     server -> client  seq u32 of the newest frame that reached the panel
+    ERROR   server -> client  JSON {message}
+
+Frames only carry tiles that changed since the previous frame. Tiles are applied
+to a server-side framebuffer as soon as they arrive and the panel is redrawn
+from it, so frames and updates that arrive faster than the panel can draw are
+merged into one redraw. A client may have at most `window` frames beyond the
+last ACK in flight; past that the server stops reading its socket.
+
+When the server draws into a framebuffer that a presenter thread copies to the
+panel (OdinSpecter's SharedFramebuffer), it is given the presenter's flush and
+waits for it before sending the ACK, so an ACK still means the panel shows the
+frame and the window paces senders to the panel.
+"""
+import json
+import os
+import socket
+import struct
+import threading
+import time
+import zlib
+
+import numpy as np
+
+from metrics import counter
+
+try:
+    import lz4.frame as lz4
+except ImportError:
+    lz4 = None
+
+DEFAULT_PORT = 8770
+TILE_SIZE = 20
+WINDOW = 2
+MAX_MESSAGE = 4 * 1024 * 1024
+FLUSH_TIMEOUT = 2.0
+IMAGE_DIR = "data"
+IMAGE_EXTENSIONS = (".png", ".jpg", ".jpeg")
+
+MSG_HELLO = 1
+MSG_UPDATE = 2
+MSG_FRAME = 3
+MSG_ACK = 4
+MSG_ERROR = 5
+
+CODEC_RAW = 0
+CODEC_ZLIB = 1
+CODEC_LZ4 = 2
+
+FLAG_KEYFRAME = 0x01
+
+HEADER = struct.Struct(">BI")
+FRAME_HEADER = struct.Struct(">IBBH")
+TILE_HEADER = struct.Struct(">HH")
+ACK = struct.Struct(">I")
+
+REMOTE_DROPPED = counter("odin_frames_dropped_total", "Frames superseded before reaching the panel",
+                         ("source",)).labels(source="remote")
+
+UPDATE_FIELDS = ("status", "emoji", "text", "scroll_speed", "battery_level", "battery_color", "image_path")
+
+
+def available_codecs():
+    codecs = [CODEC_RAW, CODEC_ZLIB]
+    if lz4 is not None:
+        codecs.append(CODEC_LZ4)
+    return codecs
+
+
+def compress(codec, body):
+    if codec == CODEC_ZLIB:
+        return zlib.compress(body, 1)
+    if codec == CODEC_LZ4:
+        return lz4.compress(body)
+    return body
+
+
+def decompress(codec, body, max_length):
+    """Inflate a frame body; raises ValueError if it is truncated or would exceed max_length bytes."""
+    if codec == CODEC_ZLIB:
+        inflater = zlib.decompressobj()
+        # One byte over the limit is enough to tell (and a limit of 0 would mean "unlimited")
+        data = inflater.decompress(body, max_length + 1)
+    elif codec == CODEC_LZ4:
+        if lz4 is None:
+            raise ValueError("lz4 frames need the lz4 package")
+        inflater = lz4.LZ4FrameDecompressor()
+        data = inflater.decompress(body, max_length=max_length + 1)
+    elif codec == CODEC_RAW:
+        return body
+    else:
+        raise ValueError(f"unknown codec {codec}")
+    if len(data) > max_length:
+        raise ValueError(f"frame body inflates past {max_length} bytes")
+    if not inflater.eof:
+        raise ValueError("frame body is truncated")
+    return data
+
+
+def recv_exact(sock, size):
+    buffer = bytearray(size)
+    view = memoryview(buffer)
+    received = 0
+    while received < size:
+        n = sock.recv_into(view[received:])
+        if n == 0:
+            raise ConnectionError("connection closed")
+        received += n
+    return bytes(buffer)
+
+
+def recv_message(sock):
+    msg_type, length = HEADER.unpack(recv_exact(sock, HEADER.size))
+    if length > MAX_MESSAGE:
+        raise ValueError(f"message of {length} bytes exceeds limit")
+    return msg_type, recv_exact(sock, length) if length else b""
+
+
+def send_message(sock, msg_type, payload=b""):
+    sock.sendall(HEADER.pack(msg_type, len(payload)) + payload)
+
+
+def tile_grid(width, height, tile=TILE_SIZE):
+    """(columns, rows) of tiles covering the screen; edge tiles may be smaller."""
+    return -(-width // tile), -(-height // tile)
+
+
+def changed_tiles(previous, current, tile=TILE_SIZE):
+    """Boolean (rows, columns) mask of tiles whose pixels differ."""
+    height, width = current.shape
+    columns, rows = tile_grid(width, height, tile)
+    diff = previous != current
+    diff = np.pad(diff, ((0, rows * tile - height), (0, columns * tile - width)))
+    return diff.reshape(rows, tile, columns, tile).any(axis=(1, 3))
+
+
+def encode_tiles(frame, mask, tile=TILE_SIZE):
+    """Serialize the tiles selected by mask: index header + big-endian RGB565 pixels."""
+    parts = []
+    for ty, tx in zip(*np.nonzero(mask)):
+        y, x = int(ty) * tile, int(tx) * tile
+        parts.append(TILE_HEADER.pack(int(tx), int(ty)))
+        parts.append(frame[y:y + tile, x:x + tile].astype(">u2").tobytes())
+    return b"".join(parts)
+
+
+class _Client:
+    def __init__(self, sock, address):
+        self.sock = sock
+        self.address = address
+        self.applied_seq = 0
+        self.acked_seq = 0
+        self.send_lock = threading.Lock()
+
+    def send(self, msg_type, payload=b""):
+        with self.send_lock:
+            send_message(self.sock, msg_type, payload)
+
+
+class DisplayServer:
+    """
+    Serves the protocol above for one board. `on_update(**fields)` receives merged
+    UPDATE messages (OdinSpecter passes update_display_data); `on_frame()` is called
+    before raw pixels go to the panel so a compositor can mark its frame stale.
+    If `board` is a framebuffer drained by another thread, `flush(timeout)` must
+    return once what was drawn has reached the panel (FramePresenter.flush).
+    """
+
+    def __init__(self, board, on_update=None, on_frame=None, flush=None, host="0.0.0.0", port=DEFAULT_PORT,
+                 tile=TILE_SIZE, window=WINDOW, image_dir=IMAGE_DIR):
+        self.board = board
+        self.on_update = on_update
+        self.on_frame = on_frame
+        self.flush = flush
+        self.image_dir = os.path.realpath(image_dir)
+        self.host = host
+        self.port = port
+        self.tile = tile
+        self.window = window
+        self.width = board.LCD_WIDTH
+        self.height = board.LCD_HEIGHT
+        self.columns, self.rows = tile_grid(self.width, self.height, tile)
+        self.framebuffer = np.zeros((self.height, self.width), dtype=np.uint16)
+        self.dirty = np.zeros((self.rows, self.columns), dtype=bool)
+        self.pending_update = {}
+        self.frames_pending = 0  # frames applied since the last redraw
+        self.clients = {}
+        self.stats = {"frames_received": 0, "tiles_received": 0, "bytes_received": 0,
+                      "updates_received": 0, "redraws": 0, "bytes_drawn": 0}
+        self._cond = threading.Condition()
+        self._running = False
+        self._sock = None
+        self._threads = []
+
+    def start(self):
+        self._sock = socket.create_server((self.host, self.port))
+        self.port = self._sock.getsockname()[1]
+        self._running = True
+        for target, name in ((self._accept_loop, "remote-accept"), (self._draw_loop, "remote-draw")):
+            thread = threading.Thread(target=target, name=name, daemon=True)
+            thread.start()
+            self._threads.append(thread)
+        print(f"Remote display listening on {self.host}:{self.port}")
+        return self
+
+    def stop(self):
+        self._running = False
+        with self._cond:
+            self._cond.notify_all()
+        if self._sock:
+            self._sock.close()
+        for client in list(self.clients.values()):
+            client.sock.close()
+        for thread in self._threads:
+            thread.join(timeout=2)
+
+    # ========== Receiving ==========
+    def _accept_loop(self):
+        while self._running:
+            try:
+                sock, address = self._sock.accept()
+            except OSError:
+                return
+            sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+            client = _Client(sock, address)
+            with self._cond:
+                self.clients[address] = client
+            threading.Thread(target=self._client_loop, args=(client,), name="remote-client", daemon=True).start()
+
+    def _client_loop(self, client):
+        hello = {"width": self.width, "height": self.height, "tile": self.tile,
+                 "codecs": available_codecs(), "window": self.window}
+        try:
+            client.send(MSG_HELLO, json.dumps(hello).encode("utf-8"))
+            while self._running:
+                msg_type, payload = recv_message(client.sock)
+                if msg_type == MSG_FRAME:
+                    self._apply_frame(client, payload)
+                elif msg_type == MSG_UPDATE:
+                    self._apply_update(json.loads(payload))
+                else:
+                    client.send(MSG_ERROR, json.dumps({"message": f"unexpected message {msg_type}"}).encode())
+        except (ConnectionError, OSError):
+            pass
+        except (ValueError, struct.error, zlib.error) as e:
+            print(f"Remote display client {client.address} sent a bad message: {e}")
+            try:
+                client.send(MSG_ERROR, json.dumps({"message": str(e)}).encode())
+            except OSError:
+                pass
+        finally:
+            with self._cond:
+                self.clients.pop(client.address, None)
+                self._cond.notify_all()
+            client.sock.close()
+
+    def _apply_frame(self, client, payload):
+        seq, codec, flags, count = FRAME_HEADER.unpack_from(payload)
+        # A frame can't legitimately inflate past `count` full tiles; don't let one exhaust memory
+        max_length = count * (TILE_HEADER.size + self.tile * self.tile * 2)
+        body = decompress(codec, payload[FRAME_HEADER.size:], max_length)
+        tile = self.tile
+        offset = 0
+        with self._cond:
+            if flags & FLAG_KEYFRAME:
+                self.framebuffer[:] = 0
+                self.dirty[:] = True
+            for _ in range(count):
+                tx, ty = TILE_HEADER.unpack_from(body, offset)
+                offset += TILE_HEADER.size
+                if tx >= self.columns or ty >= self.rows:
+                    raise ValueError(f"tile ({tx}, {ty}) is off screen")
+                y, x = ty * tile, tx * tile
+                h, w = min(tile, self.height - y), min(tile, self.width - x)
+                pixels = np.frombuffer(body, dtype=">u2", count=w * h, offset=offset)
+                self.framebuffer[y:y + h, x:x + w] = pixels.reshape(h, w)
+                self.dirty[ty, tx] = True
+                offset += w * h * 2
+            client.applied_seq = seq
+            self.frames_pending += 1
+            self.stats["frames_received"] += 1
+            self.stats["tiles_received"] += count
+            self.stats["bytes_received"] += len(payload)
+            self._cond.notify_all()
+            # Backpressure: stop reading this socket until the panel catches up
+            while self._running and client.applied_seq - client.acked_seq >= self.window:
+                self._cond.wait()
+
+    def _image_path(self, name):
+        """A client's image_path as a file in image_dir, or None if it names anything else."""
+        if not isinstance(name, str) or not name.lower().endswith(IMAGE_EXTENSIONS):
+            return None
+        path = os.path.realpath(os.path.join(self.image_dir, os.path.basename(name)))
+        if os.path.dirname(path) != self.image_dir or not os.path.isfile(path):
+            return None
+        return path
+
+    def _apply_update(self, fields):
+        fields = {k: v for k, v in fields.items() if k in UPDATE_FIELDS}
+        if "image_path" in fields:
+            path = self._image_path(fields.pop("image_path"))
+            if path is None:
+                print("Remote display: ignoring an image_path outside the image directory")
+            else:
+                fields["image_path"] = path
+        with self._cond:
+            # Later values replace earlier ones until the draw thread picks them up
+            self.pending_update.update(fields)
+            self.stats["updates_received"] += 1
+            self._cond.notify_all()
+
+    # ========== Drawing ==========
+    def _draw_loop(self):
+        while self._running:
+            with self._cond:
+                while self._running and not self.pending_update and not self.dirty.any():
+                    self._cond.wait()
+                if not self._running:
+                    return
+                update, self.pending_update = self.pending_update, {}
+                dirty = self.dirty.copy()
+                self.dirty[:] = False
+                if self.frames_pending > 1:
+                    # Several frames merged into this redraw; all but the newest never showed
+                    REMOTE_DROPPED.inc(self.frames_pending - 1)
+                self.frames_pending = 0
+                rects = self._dirty_rects(dirty)
+                # Copy now so tiles arriving during the SPI transfer are not torn
+                regions = [(rect, self.framebuffer[rect[1]:rect[1] + rect[3], rect[0]:rect[0] + rect[2]]
+                            .astype(">u2").tobytes()) for rect in rects]
+                acks = {client: client.applied_seq for client in self.clients.values()}
+            try:
+                if update and self.on_update:
+                    self.on_update(**update)
+                if regions and self.on_frame:
+                    self.on_frame()
+                for (x, y, w, h), data in regions:
+                    self.board.draw_image(x, y, w, h, data)
+                    self.stats["bytes_drawn"] += len(data)
+                # ACK only what the panel shows, or the window stops pacing senders to it
+                if regions and self.flush and not self.flush(timeout=FLUSH_TIMEOUT):
+                    print("Remote display: panel did not catch up, acknowledging anyway")
+            except Exception as e:
+                print(f"Remote display draw failed: {e}")
+            self.stats["redraws"] += 1
+            with self._cond:
+                acks = {client: seq for client, seq in acks.items() if seq > client.acked_seq}
+                for client, seq in acks.items():
+                    client.acked_seq = seq
+                self._cond.notify_all()
+            for client, seq in acks.items():
+                try:
+                    client.send(MSG_ACK, ACK.pack(seq))
+                except OSError:
+                    pass
+
+    def _dirty_rects(self, dirty):
+        """Screen rectangles covering the dirty tiles: one per run of tiles in a row, or the bounding box."""
+        tile = self.tile
+        ys, xs = np.nonzero(dirty)
+        if ys.size == 0:
+            return []
+        if ys.size * 2 > dirty.size:
+            # Mostly dirty: one SPI transfer is cheaper than many window setups
+            x0, y0 = int(xs.min()) * tile, int(ys.min()) * tile
+            x1 = min(self.width, (int(xs.max()) + 1) * tile)
+            y1 = min(self.height, (int(ys.max()) + 1) * tile)
+            return [(x0, y0, x1 - x0, y1 - y0)]
+        rects = []
+        for ty in np.unique(ys):
+            row = dirty[ty]
+            start = None
+            for tx in range(self.columns + 1):
+                if tx < self.columns and row[tx]:
+                    if start is None:
+                        start = tx
+                elif start is not None:
+                    x0, y0 = start * tile, int(ty) * tile
+                    x1 = min(self.width, tx * tile)
+                    y1 = min(self.height, y0 + tile)
+                    rects.append((x0, y0, x1 - x0, y1 - y0))
+                    start = None
+        return rects
+
+
+class DisplayClient:
+    """
+    Host-side sender. send_frame() diffs against the previous frame, ships only the
+    changed tiles and blocks while `window` frames are still waiting for an ACK.
+    """
+
+    def __init__(self, host, port=DEFAULT_PORT, codec=None, keyframe_interval=0):
+        self.sock = socket.create_connection((host, port))
+        self.sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        msg_type, payload = recv_message(self.sock)
+        if msg_type != MSG_HELLO:
+            raise ConnectionError(f"expected HELLO, got message {msg_type}")
+        hello = json.loads(payload)
+        self.width = hello["width"]
+        self.height = hello["height"]
+        self.tile = hello["tile"]
+        self.window = hello["window"]
+        usable = [c for c in hello["codecs"] if c in available_codecs()]
+        self.codec = codec if codec is not None else max(usable)
+        self.keyframe_interval = keyframe_interval
+        self.previous = None
+        self.seq = 0
+        self.acked_seq = 0
+        self.bytes_sent = 0
+        self.error = None
+        self._cond = threading.Condition()
+        self._reader = threading.Thread(target=self._read_loop, name="remote-acks", daemon=True)
+        self._reader.start()
+
+    def _read_loop(self):
+        try:
+            while True:
+                msg_type, payload = recv_message(self.sock)
+                with self._cond:
+                    if msg_type == MSG_ACK:
+                        self.acked_seq = ACK.unpack(payload)[0]
+                    elif msg_type == MSG_ERROR:
+                        self.error = json.loads(payload)["message"]
+                    self._cond.notify_all()
+        except (ConnectionError, OSError, ValueError) as e:
+            with self._cond:
+                self.error = self.error or str(e)
+                self._cond.notify_all()
+
+    def update(self, **fields):
+        send_message(self.sock, MSG_UPDATE, json.dumps(fields).encode("utf-8"))
+
+    def send_frame(self, frame):
+        """frame: (height, width) uint16 RGB565 array. Returns the payload size sent."""
+        frame = np.asarray(frame, dtype=np.uint16)
+        if frame.shape != (self.height, self.width):
+            raise ValueError(f"frame must be {self.height}x{self.width}")
+        with self._cond:
+            while self.error is None and self.seq - self.acked_seq >= self.window:
+                self._cond.wait()
+            if self.error is not None:
+                raise ConnectionError(self.error)
+        self.seq += 1
+        keyframe = self.previous is None or (
+            self.keyframe_interval and self.seq % self.keyframe_interval == 0)
+        if keyframe:
+            columns, rows = tile_grid(self.width, self.height, self.tile)
+            mask = np.ones((rows, columns), dtype=bool)
+        else:
+            mask = changed_tiles(self.previous, frame, self.tile)
+        body = compress(self.codec, encode_tiles(frame, mask, self.tile))
+        flags = FLAG_KEYFRAME if keyframe else 0
+        payload = FRAME_HEADER.pack(self.seq, self.codec, flags, int(mask.sum())) + body
+        send_message(self.sock, MSG_FRAME, payload)
+        self.previous = frame.copy()
+        self.bytes_sent += len(payload)
+        return len(payload)
+
+    def wait_idle(self, timeout=None):
+        """Block until every frame sent so far has been drawn."""
+        deadline = None if timeout is None else time.monotonic() + timeout
+        with self._cond:
+            while self.error is None and self.acked_seq < self.seq:
+                remaining = None if deadline is None else deadline - time.monotonic()
+                if remaining is not None and remaining <= 0:
+                    return False
+                self._cond.wait(remaining)
+        return self.acked_seq >= self.seq
+
+    def close(self):
+        self.sock.close()
@@ -0,0 +1,123 @@
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, wait
+
+
+class DeadlineExceeded(Exception):
+    """The stage ran out of time; not worth failing over to another model."""
+
+
+class CircuitOpen(Exception):
+    """The upstream is marked degraded; callers should use a cached or canned response."""
+
+
+class Deadline:
+    def __init__(self, seconds):
+        self.seconds = seconds
+        self.expires_at = time.monotonic() + seconds
+
+    def remaining(self):
+        return max(0.0, self.expires_at - time.monotonic())
+
+    @property
+    def expired(self):
+        return self.remaining() <= 0
+
+    def timeout(self, connect=5.0):
+        """(connect, read) timeout for requests, bounded by what is left of the deadline."""
+        remaining = self.remaining()
+        if remaining <= 0:
+            raise DeadlineExceeded(f"deadline of {self.seconds:.1f}s exceeded")
+        return (min(connect, remaining), remaining)
+
+
+_hedge_pool = ThreadPoolExecutor(max_workers=8, thread_name_prefix="hedge")
+
+
+def hedged(fn, hedge_after, deadline, hedges=1, discard=None):
+    """
+    Run fn() and, if it has not answered after `hedge_after` seconds, start up to
+    `hedges` duplicate attempts. The first successful result wins; the losers are
+    left to finish in the background and their results passed to `discard`
+    (e.g. to close a streamed response). Only use for idempotent requests.
+    """
+    pending = {_hedge_pool.submit(fn)}
+    launched = 1
+    last_error = None
+    while pending:
+        can_hedge = launched <= hedges and hedge_after is not None
+        timeout = deadline.remaining()
+        if can_hedge:
+            timeout = min(timeout, hedge_after)
+        done, pending = wait(pending, timeout=timeout, return_when=FIRST_COMPLETED)
+        winners = [future for future in done if future.exception() is None]
+        if winners:
+            if discard is not None:
+                for loser in winners[1:]:
+                    discard(loser.result())
+                for loser in pending:
+                    loser.add_done_callback(lambda f: f.exception() is None and discard(f.result()))
+            return winners[0].result()
+        for future in done:
+            last_error = future.exception()
+        if deadline.expired:
+            raise DeadlineExceeded(f"deadline of {deadline.seconds:.1f}s exceeded")
+        if not done and can_hedge:
+            print(f"Hedging after {hedge_after:.2f}s")
+            pending.add(_hedge_pool.submit(fn))
+            launched += 1
+    raise last_error
+
+
+class CircuitBreaker:
+    """
+    closed -> open after `failure_threshold` consecutive failures; while open,
+    calls fail fast with CircuitOpen. After `reset_timeout` one trial call is let
+    through (half-open): success closes the circuit, failure re-opens it.
+    """
+
+    CLOSED = "closed"
+    OPEN = "open"
+    HALF_OPEN = "half_open"
+
+    def __init__(self, name, failure_threshold=3, reset_timeout=30):
+        self.name = name
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.state = self.CLOSED
+        self.failures = 0
+        self.opened_at = 0
+        self._lock = threading.Lock()
+
+    def _before(self):
+        with self._lock:
+            if self.state == self.OPEN:
+                if time.monotonic() - self.opened_at < self.reset_timeout:
+                    raise CircuitOpen(f"{self.name} circuit open")
+                self.state = self.HALF_OPEN
+            elif self.state == self.HALF_OPEN:
+                # A trial call is already in flight
+                raise CircuitOpen(f"{self.name} circuit half-open")
+
+    def _after(self, ok):
+        with self._lock:
+            if ok:
+                self.state = self.CLOSED
+                self.failures = 0
+                return
+            self.failures += 1
+            if self.state == self.HALF_OPEN or self.failures >= self.failure_threshold:
+                if self.state != self.OPEN:
+                    print(f"Circuit {self.name} opened")
+                self.state = self.OPEN
+                self.opened_at = time.monotonic()
+
+    def call(self, fn):
+        self._before()
+        try:
+            result = fn()
+        except Exception:
+            self._after(False)
+            raise
+        self._after(True)
+        return result
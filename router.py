@@ -0,0 +1,159 @@
+import re
+import threading
+import time
+from collections import deque
+
+TRANSCRIPTION = "transcription"
+SHORT_ANSWER = "short_answer"
+CODE = "code"
+TTS = "tts"
+
+DEFAULT_ROUTES = {
+    TRANSCRIPTION: ["gemini-3-flash-preview", "gemini-2.5-flash"],
+    SHORT_ANSWER: ["gemini-3-flash-preview", "gemini-2.5-flash"],
+    CODE: ["gemini-3-flash-preview", "gemini-2.5-pro"],
+    TTS: ["gemini-2.5-flash-preview-tts", "gemini-2.5-pro-preview-tts"],
+}
+
+# Seconds; p95 above the budget pushes a model behind the alternates
+DEFAULT_LATENCY_BUDGET = {
+    TRANSCRIPTION: 4.0,
+    SHORT_ANSWER: 6.0,
+    CODE: 20.0,
+    TTS: 8.0,
+}
+
+CODE_REQUEST_PATTERN = re.compile(
+    r"\b(script|code|payload|ducky|program|exploit|function|write|generate|flipper)\b", re.IGNORECASE)
+
+
+class ModelUnavailable(Exception):
+    """Raised by a routed call when the model failed in a way worth failing over for."""
+
+
+def classify_question(text):
+    """Guess whether a question will produce a code answer (the ```text branch) or a short answer."""
+    return CODE if CODE_REQUEST_PATTERN.search(text or "") else SHORT_ANSWER
+
+
+class ModelStats:
+    """Latency and outcome samples from the last `horizon` seconds, so a demoted model gets retried later."""
+
+    def __init__(self, window=50, horizon=300):
+        self.horizon = horizon
+        self.latencies = deque(maxlen=window)  # (timestamp, seconds)
+        self.outcomes = deque(maxlen=window)  # (timestamp, ok)
+        self.cooldown_until = 0
+
+    def _prune(self):
+        cutoff = time.monotonic() - self.horizon
+        for samples in (self.latencies, self.outcomes):
+            while samples and samples[0][0] < cutoff:
+                samples.popleft()
+
+    def record(self, latency, ok):
+        now = time.monotonic()
+        self.outcomes.append((now, ok))
+        if ok:
+            self.latencies.append((now, latency))
+
+    def percentile(self, q):
+        self._prune()
+        if not self.latencies:
+            return None
+        ordered = sorted(latency for _, latency in self.latencies)
+        return ordered[min(len(ordered) - 1, int(q * len(ordered)))]
+
+    @property
+    def error_rate(self):
+        self._prune()
+        if not self.outcomes:
+            return 0.0
+        return 1 - sum(ok for _, ok in self.outcomes) / len(self.outcomes)
+
+    def snapshot(self):
+        return {
+            "p50": self.percentile(0.5),
+            "p95": self.percentile(0.95),
+            "error_rate": round(self.error_rate, 3),
+            "samples": len(self.outcomes),
+        }
+
+
+class ModelRouter:
+    """
+    Picks a model per request type from observed latency and error rates.
+    Models are tried in configured preference order, except that models whose
+    recent p95 exceeds the latency budget or whose error rate is too high are
+    moved behind the healthy alternates, and a model that just failed or blew
+    the budget sits out a cooldown. Stats age out, so demoted models recover.
+    """
+
+    def __init__(self, routes=None, latency_budget=None, max_error_rate=0.3, cooldown=30):
+        self.routes = dict(DEFAULT_ROUTES, **(routes or {}))
+        self.latency_budget = dict(DEFAULT_LATENCY_BUDGET, **(latency_budget or {}))
+        self.max_error_rate = max_error_rate
+        self.cooldown = cooldown
+        self.stats = {}
+        self._lock = threading.Lock()
+
+    def _stats(self, model):
+        stats = self.stats.get(model)
+        if stats is None:
+            stats = self.stats[model] = ModelStats()
+        return stats
+
+    def candidates(self, request_type):
+        """Models for request_type, best first."""
+        models = self.routes[request_type]
+        budget = self.latency_budget.get(request_type)
+        now = time.monotonic()
+        with self._lock:
+            def rank(item):
+                preference, model = item
+                stats = self._stats(model)
+                p95 = stats.percentile(0.95)
+                cooling_down = stats.cooldown_until > now
+                degraded = stats.error_rate > self.max_error_rate or (
+                    budget is not None and p95 is not None and p95 > budget)
+                return (cooling_down, degraded, preference)
+            return [model for _, model in sorted(enumerate(models), key=rank)]
+
+    def record(self, model, latency, ok, request_type=None):
+        with self._lock:
+            stats = self._stats(model)
+            stats.record(latency, ok)
+            budget = self.latency_budget.get(request_type)
+            if not ok or (budget is not None and latency > budget):
+                stats.cooldown_until = time.monotonic() + self.cooldown
+
+    def call(self, request_type, fn):
+        """
+        Run fn(model) on the best candidate, failing over to the next model when
+        it raises ModelUnavailable or a network error. Returns (model, result).
+        """
+        last_error = None
+        for model in self.candidates(request_type):
+            started = time.monotonic()
+            try:
+                result = fn(model)
+            except (ModelUnavailable, OSError) as e:
+                self.record(model, time.monotonic() - started, False, request_type)
+                print(f"Model {model} failed for {request_type}: {e}")
+                last_error = e
+                continue
+            self.record(model, time.monotonic() - started, True, request_type)
+            return model, result
+        raise last_error or ModelUnavailable(f"No model available for {request_type}")
+
+    def hedge_delay(self, model, q=0.95, min_samples=5):
+        """Seconds after which a duplicate request is worth sending, or None without enough samples."""
+        with self._lock:
+            stats = self._stats(model)
+            if len(stats.latencies) < min_samples:
+                return None
+            return stats.percentile(q)
+
+    def snapshot(self):
+        with self._lock:
+            return {model: stats.snapshot() for model, stats in self.stats.items()}
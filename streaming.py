@@ -0,0 +1,148 @@
+import binascii
+import json
+
+INLINE_DATA_KEY = b'"inlineData"'
+DATA_KEY = b'"data"'
+USAGE_KEY = b'"usageMetadata"'
+CHUNK_SIZE = 64 * 1024
+MAX_TAIL = 16 * 1024  # what follows the audio: finishReason, usageMetadata, modelVersion
+
+
+class InlineDataNotFound(KeyError):
+    """The response finished without an inlineData.data string."""
+
+
+class InlineDataDecoder:
+    """
+    Incremental scanner for a generateContent response body. It finds the first
+    "inlineData": {... "data": "<base64>" ...} string and base64-decodes it as it
+    streams past, handing decoded bytes to `sink(bytes)`. Only a few bytes of
+    carry-over are buffered, so memory use does not depend on the audio length.
+    The small remainder of the body after the audio is kept for usage().
+    """
+
+    SEEK_INLINE, SEEK_DATA, SEEK_QUOTE, IN_DATA, DONE = range(5)
+
+    def __init__(self, sink):
+        self.sink = sink
+        self.state = self.SEEK_INLINE
+        self.pending = b""  # undecoded base64 tail (< 4 chars) or unmatched key prefix
+        self.escape = False
+        self.decoded_bytes = 0
+        self.head = bytearray()  # first bytes of the body, kept for error reports
+        self.tail = bytearray()  # body after the audio string
+
+    def feed(self, chunk):
+        if len(self.head) < 2048:
+            self.head += chunk[:2048 - len(self.head)]
+        if self.state == self.DONE:
+            self._keep_tail(chunk)
+            return
+        data = self.pending + chunk
+        self.pending = b""
+        while data and self.state != self.DONE:
+            if self.state == self.SEEK_INLINE:
+                data = self._seek(data, INLINE_DATA_KEY, self.SEEK_DATA)
+            elif self.state == self.SEEK_DATA:
+                data = self._seek(data, DATA_KEY, self.SEEK_QUOTE)
+            elif self.state == self.SEEK_QUOTE:
+                # skip `: "` between the key and the string
+                stripped = data.lstrip(b' \t\r\n:')
+                if not stripped:
+                    return
+                if stripped[:1] != b'"':
+                    raise InlineDataNotFound("inlineData.data is not a string")
+                data = stripped[1:]
+                self.state = self.IN_DATA
+            else:
+                data = self._decode(data)
+        if data:
+            self._keep_tail(data)
+
+    def _keep_tail(self, data):
+        self.tail += data[:MAX_TAIL - len(self.tail)]
+
+    def _seek(self, data, key, next_state):
+        index = data.find(key)
+        if index < 0:
+            # keep enough to match a key split across chunks
+            self.pending = data[-(len(key) - 1):]
+            return b""
+        self.state = next_state
+        return data[index + len(key):]
+
+    def _decode(self, data):
+        end = data.find(b'"')
+        body = data if end < 0 else data[:end]
+        if b"\\" in body or self.escape:
+            body = self._unescape(body)
+        if end >= 0:
+            self._emit(body, final=True)
+            self.state = self.DONE
+            return data[end + 1:]
+        self._emit(body, final=False)
+        return b""
+
+    def _unescape(self, body):
+        # base64 only ever needs the JSON escape for '/'
+        out = bytearray()
+        for byte in body:
+            if self.escape:
+                out.append(byte)
+                self.escape = False
+            elif byte == 0x5C:
+                self.escape = True
+            else:
+                out.append(byte)
+        return bytes(out)
+
+    def _emit(self, body, final):
+        body = self.pending + body
+        usable = len(body) if final else len(body) - len(body) % 4
+        self.pending = body[usable:]
+        if usable:
+            decoded = binascii.a2b_base64(body[:usable])
+            self.decoded_bytes += len(decoded)
+            self.sink(decoded)
+
+    def close(self):
+        if self.state != self.DONE:
+            raise InlineDataNotFound("inlineData.data not found in response")
+
+    def usage(self):
+        """usageMetadata from the end of the body, or None if it wasn't there."""
+        tail = bytes(self.tail)
+        start = tail.find(USAGE_KEY)
+        start = tail.find(b"{", start) if start >= 0 else -1
+        if start < 0:
+            return None
+        depth = 0
+        for end in range(start, len(tail)):
+            depth += {0x7B: 1, 0x7D: -1}.get(tail[end], 0)
+            if depth == 0:
+                try:
+                    return json.loads(tail[start:end + 1])
+                except ValueError:
+                    return None
+        return None
+
+
+def stream_inline_data(response, sink, chunk_size=CHUNK_SIZE):
+    """
+    Decode inlineData.data from a streamed requests response into sink; returns
+    bytes decoded. The response's usageMetadata, if any, is left on
+    response.usage_metadata.
+    """
+    decoder = InlineDataDecoder(sink)
+    try:
+        for chunk in response.iter_content(chunk_size=chunk_size):
+            decoder.feed(chunk)
+            if len(decoder.tail) >= MAX_TAIL:
+                break
+        decoder.close()
+        response.usage_metadata = decoder.usage()
+    except InlineDataNotFound as e:
+        raise InlineDataNotFound(f"{e}: {bytes(decoder.head).decode('utf-8', 'replace')}")
+    finally:
+        response.close()
+    return decoder.decoded_bytes
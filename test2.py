@@ -139,8 +139,10 @@ def play_video(video_path):
 
     process = start_process()
 
+    # The loop reuses one buffer, so the collector has little to do once the
+    # boot-time objects are out of its way; no need to switch it off
     gc.collect()
-    gc.disable()
+    gc.freeze()
 
     print(f"Playing (loop): {video_path}. Press Ctrl+C to exit.")
     try:
@@ -171,7 +173,7 @@ def play_video(video_path):
             process.wait(timeout=1)
         except Exception:
             pass
-        gc.enable()
+        gc.unfreeze()
         board.cleanup()
         print("Exit.")
 
@@ -183,7 +185,6 @@ def update_display_data(status=None, emoji=None, text=None,
     # If text is not continuation of previous, reset scroll position
     if text is not None and not text.startswith(current_text):
         current_scroll_top = 0
-        TextUtils.clean_line_image_cache()
     if scroll_speed is not None:
         current_scroll_speed = scroll_speed
     current_status = status if status is not None else current_status
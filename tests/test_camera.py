@@ -0,0 +1,71 @@
+import time
+
+import numpy as np
+
+from camera import CameraPipeline, RGB565Converter, SyntheticSource
+
+
+class SlowBoard:
+    LCD_WIDTH = 24
+    LCD_HEIGHT = 28
+
+    def __init__(self, draw_seconds=0.02):
+        self.draw_seconds = draw_seconds
+        self.frames = []
+
+    def draw_image(self, x, y, width, height, pixel_data):
+        time.sleep(self.draw_seconds)
+        self.frames.append(bytes(pixel_data))
+
+
+def test_converter_packs_rgb565_big_endian():
+    frame = np.zeros((4, 4, 3), dtype=np.uint8)
+    frame[:, :] = (255, 0, 0)
+    data = RGB565Converter(4, 4, 2, 2).convert(frame)
+    assert bytes(data) == b"\xf8\x00" * 4
+
+
+def test_converter_swaps_bgr():
+    frame = np.zeros((4, 4, 3), dtype=np.uint8)
+    frame[:, :] = (255, 0, 0)  # blue in BGR order
+    data = RGB565Converter(4, 4, 2, 2, channel_order="BGR").convert(frame)
+    assert bytes(data) == b"\x00\x1f" * 4
+
+
+def test_converter_covers_and_crops_centre():
+    frame = np.zeros((2, 4, 3), dtype=np.uint8)
+    frame[:, 1:3] = 255  # white centre columns, black edges
+    data = RGB565Converter(4, 2, 2, 2).convert(frame)
+    assert bytes(data) == b"\xff\xff" * 4
+
+
+def test_converter_reuses_output_buffer():
+    converter = RGB565Converter(8, 8, 4, 4)
+    frame = np.zeros((8, 8, 3), dtype=np.uint8)
+    assert converter.convert(frame).base is converter.convert(frame).base
+
+
+def test_pipeline_drops_frames_the_panel_cannot_keep_up_with():
+    source = SyntheticSource(64, 48, fps=0)  # as fast as it can go
+    board = SlowBoard()
+    pipeline = CameraPipeline(source, board).start()
+    time.sleep(0.3)
+    pipeline.stop()
+    stats = pipeline.stats()
+    assert stats["displayed"] >= 2
+    assert stats["dropped"] > 0
+    assert stats["captured"] >= stats["displayed"] + stats["dropped"] - 1
+    assert all(len(frame) == 24 * 28 * 2 for frame in board.frames)
+    # Every buffer is back in the pool or the slot once both threads are gone
+    assert len(pipeline._free) + (pipeline._slot is not None) == CameraPipeline.POOL_SIZE
+
+
+def test_snapshot_is_full_resolution_rgb():
+    source = SyntheticSource(64, 48, fps=100)
+    pipeline = CameraPipeline(source, SlowBoard(draw_seconds=0.05)).start()
+    try:
+        image = pipeline.snapshot(timeout=1.0)
+    finally:
+        pipeline.stop()
+    assert image.size == (64, 48)
+    assert image.mode == "RGB"
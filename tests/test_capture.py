@@ -0,0 +1,97 @@
+import wave
+
+import numpy as np
+import pytest
+
+from capture import PrerollCapture
+
+RATE = 1000
+FRAME = 4  # 2 channels of 16-bit samples
+
+
+def stream(start, count):
+    """`count` bytes of the stream from byte offset `start`: byte i of the stream is i % 256."""
+    return (np.arange(start, start + count) % 256).astype(np.uint8).tobytes()
+
+
+def make_capture(preroll=0.1):
+    return PrerollCapture(preroll=preroll, rate=RATE, channels=2)
+
+
+def feed(capture, count):
+    """What the capture thread does with the next `count` bytes from arecord."""
+    capture._append(stream(capture.total, count))
+
+
+def read_clip(path):
+    with wave.open(path, "rb") as clip:
+        return clip.readframes(clip.getnframes())
+
+
+def test_clip_has_whole_ring_then_live_audio(tmp_path):
+    capture = make_capture()
+    feed(capture, 2000)
+    preroll = capture.start_clip(str(tmp_path / "clip.wav"))
+    feed(capture, 400)
+    path, seconds = capture.stop_clip()
+    assert preroll == pytest.approx(0.1)
+    assert seconds == pytest.approx(0.2)
+    assert read_clip(path) == stream(2000 - capture.ring_size, capture.ring_size + 400)
+
+
+def test_preroll_is_limited_to_what_was_captured(tmp_path):
+    capture = make_capture()
+    feed(capture, 40)
+    assert capture.start_clip(str(tmp_path / "clip.wav")) == pytest.approx(0.01)
+    capture.stop_clip()
+    assert read_clip(str(tmp_path / "clip.wav")) == stream(0, 40)
+
+
+@pytest.mark.parametrize("total", [1001, 1002, 1003])
+def test_clip_starting_mid_frame_rounds_down(tmp_path, total):
+    capture = make_capture()
+    feed(capture, total)
+    preroll = capture.start_clip(str(tmp_path / "clip.wav"), preroll=0)
+    assert capture.clip_start == total - total % FRAME
+    assert 0 <= preroll < FRAME / capture.bytes_per_second
+    feed(capture, -total % FRAME + 8)
+    capture.stop_clip()
+    assert read_clip(str(tmp_path / "clip.wav")) == stream(capture.clip_start, 12)
+
+
+def test_clip_never_starts_before_the_ring(tmp_path):
+    capture = make_capture()
+    feed(capture, capture.ring_size * 3 + 2)
+    capture.start_clip(str(tmp_path / "clip.wav"), preroll=10)
+    oldest = capture.total - capture.ring_size
+    assert capture.clip_start >= oldest
+    assert capture.clip_start % FRAME == 0
+    capture.stop_clip()
+    # The stream stopped mid-frame; the WAV only holds whole frames
+    whole = (capture.total - capture.clip_start) // FRAME * FRAME
+    assert read_clip(str(tmp_path / "clip.wav")) == stream(capture.clip_start, whole)
+
+
+def test_stop_without_clip():
+    assert make_capture().stop_clip() == (None, 0.0)
+
+
+def test_stop_clip_drops_audio_after_end(tmp_path):
+    capture = make_capture()
+    feed(capture, 400)
+    capture.start_clip(str(tmp_path / "clip.wav"), preroll=0)
+    feed(capture, 800)
+    # A stop keyword that began 0.15 s into the stream, 50 ms into the clip
+    path, seconds = capture.stop_clip(end=0.15)
+    assert seconds == pytest.approx(0.05)
+    assert read_clip(path) == stream(400, 200)
+
+
+def test_stop_clip_end_before_clip_keeps_nothing(tmp_path):
+    capture = make_capture()
+    feed(capture, 400)
+    capture.start_clip(str(tmp_path / "clip.wav"), preroll=0)
+    feed(capture, 80)
+    path, seconds = capture.stop_clip(end=0.05)
+    assert seconds == 0
+    assert read_clip(path) == b""
@@ -0,0 +1,66 @@
+import time
+
+import pytest
+
+from conversation import is_follow_up
+from history import HistoryStore, question_key
+
+
+@pytest.fixture
+def store(tmp_path):
+    store = HistoryStore(str(tmp_path / "history.db"))
+    yield store
+    store.close()
+
+
+def test_question_key_ignores_case_punctuation_and_spacing():
+    assert question_key("What's  a DEAUTH attack?") == question_key("what s a deauth attack")
+
+
+def test_recall_matches_the_same_question(store):
+    store.record("voice", "What is a deauth attack?", "It kicks clients off a network.")
+    entry = store.recall("what is a DEAUTH attack")
+    assert entry["answer"] == "It kicks clients off a network."
+
+
+def test_recall_ignores_questions_that_only_share_words(store):
+    store.record("voice", "How do I list open ports on Linux?", "Use ss -tulpn.")
+    assert store.recall("How do I list open ports on Windows?") is None
+    assert store.recall("How do I list open ports?") is None
+
+
+def test_recall_returns_the_newest_answer(store):
+    store.record("voice", "What time is it?", "Noon.")
+    store.record("voice", "What time is it?", "One o'clock.")
+    assert store.recall("What time is it?")["answer"] == "One o'clock."
+
+
+def test_recall_skips_image_answers_and_old_entries(store):
+    store.record("image", "What is this?", "A Flipper Zero.")
+    assert store.recall("What is this?") is None
+    store.record("voice", "Ping?", "Pong.")
+    store.db.execute("UPDATE interactions SET created_at = ?", (time.time() - 3600,))
+    assert store.recall("Ping?", max_age=60) is None
+    assert store.recall("Ping?", max_age=7200)["answer"] == "Pong."
+
+
+def test_recall_without_words(store):
+    store.record("voice", "?", "Nothing to answer.")
+    assert store.recall("?!") is None
+
+
+def test_search_finds_every_word(store):
+    store.record("voice", "What is a deauth attack?", "It kicks clients off a network.")
+    store.record("voice", "What is an evil twin?", "A fake access point.")
+    assert [entry["question"] for entry in store.search("deauth network")] == ["What is a deauth attack?"]
+    assert len(store.search("deauth twin", any_word=True)) == 2
+
+
+@pytest.mark.parametrize("question", ["And on Windows?", "Why is that?", "Tell me more", "How does it work?"])
+def test_follow_ups_are_recognized(question):
+    assert is_follow_up(question)
+
+
+@pytest.mark.parametrize("question", ["What is a deauth attack?", "How do I list open ports on Linux?"])
+def test_standalone_questions_are_not_follow_ups(question):
+    assert not is_follow_up(question)
@@ -0,0 +1,72 @@
+import numpy as np
+import pytest
+
+from mixer import ALERT, CHANNELS, SPEECH, Mixer
+
+
+class NullOutput:
+    def write(self, data):
+        pass
+
+    def close(self):
+        pass
+
+
+def constant(value, frames):
+    return np.full((frames, CHANNELS), value, dtype=np.float32)
+
+
+def samples(data):
+    return np.frombuffer(data, dtype="<i2").reshape(-1, CHANNELS)[:, 0]
+
+
+@pytest.fixture
+def mixer():
+    return Mixer(output=NullOutput())
+
+
+def test_nothing_playing(mixer):
+    assert mixer.mix() is None
+
+
+def test_lower_priority_is_ducked_with_a_ramp(mixer):
+    mixer.play(constant(0.5, mixer.frames * 10), priority=SPEECH)
+    assert (samples(mixer.mix()) == 16384).all()
+    mixer.play(constant(0.0, mixer.frames * 2), priority=ALERT)
+    ramp = samples(mixer.mix())
+    assert ramp[0] == 16384
+    assert (np.diff(ramp) <= 0).all()
+    ducked = int(0.5 * mixer.duck_gain * 32768)
+    assert abs(int(ramp[-1]) - ducked) <= 1
+    assert (np.abs(samples(mixer.mix()).astype(int) - ducked) <= 1).all()
+    # The alert is over: the speech ramps back up
+    mixer.mix()
+    restored = samples(mixer.mix())
+    assert restored[-1] == 16384
+
+
+def test_sources_started_under_a_higher_priority_begin_ducked(mixer):
+    mixer.play(constant(0.0, mixer.frames * 4), priority=ALERT)
+    speech = mixer.play(constant(0.5, mixer.frames * 4), priority=SPEECH)
+    assert speech.duck == mixer.duck_gain
+    assert samples(mixer.mix())[0] == int(0.5 * mixer.duck_gain * 32768)
+
+
+def test_finished_sources_are_removed_and_signalled(mixer):
+    source = mixer.play(constant(0.1, mixer.frames // 2))
+    mixer.mix()
+    assert source.wait(0)
+    assert mixer.mix() is None
+
+
+@pytest.mark.parametrize("value, clipped, expected", [
+    (0.5, 0, 16384),
+    (0.99999, 1, 32767),
+    (1.0, 1, 32767),  # 32768 would wrap to -32768
+    (1.5, 1, 32767),
+    (-1.5, 1, -32768),
+])
+def test_output_is_clipped_to_16_bit(mixer, value, clipped, expected):
+    mixer.play(constant(value, mixer.frames))
+    assert (samples(mixer.mix()) == expected).all()
+    assert mixer.clipped == clipped
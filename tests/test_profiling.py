@@ -0,0 +1,49 @@
+import pytest
+
+from profiling import AllocationBudgetExceeded, Profiler
+
+
+@pytest.fixture
+def profiler():
+    profiler = Profiler(budgets={"small": 64 * 1024, "big": 64 * 1024}).enable()
+    yield profiler
+    profiler.disable()
+
+
+def test_disabled_profiler_records_nothing():
+    profiler = Profiler(budgets={"stage": 1})
+    with profiler.stage("stage"):
+        bytearray(1024 * 1024)
+    assert profiler.stats == {}
+
+
+def test_peak_counts_freed_allocations(profiler):
+    with profiler.stage("big"):
+        del bytearray(1024 * 1024)[:]
+    stats = profiler.stats["big"]
+    assert stats.calls == 1
+    assert stats.max_peak_bytes >= 1024 * 1024
+    assert stats.net_bytes < 64 * 1024
+
+
+def test_budget_violations_are_reported(profiler):
+    with profiler.stage("small"):
+        bytearray(1024)
+    with profiler.stage("big"):
+        bytearray(1024 * 1024)
+    assert [name for name, _, _ in profiler.check_budgets()] == ["big"]
+    assert profiler.report()["over_budget"] == ["big"]
+
+
+def test_strict_profiler_raises_from_the_stage(profiler):
+    profiler.strict = True
+    with pytest.raises(AllocationBudgetExceeded):
+        with profiler.stage("big"):
+            bytearray(1024 * 1024)
+
+
+def test_nested_stage_peak_is_charged_to_the_outer_stage(profiler):
+    with profiler.stage("small"):
+        with profiler.stage("big"):
+            bytearray(1024 * 1024)
+    assert profiler.stats["small"].max_peak_bytes >= 1024 * 1024
@@ -0,0 +1,85 @@
+import threading
+import time
+
+import pytest
+
+from resilience import CircuitBreaker, CircuitOpen, Deadline, DeadlineExceeded, hedged
+
+
+def fail():
+    raise OSError("down")
+
+
+def test_breaker_opens_after_consecutive_failures():
+    breaker = CircuitBreaker("test", failure_threshold=2, reset_timeout=60)
+    for _ in range(2):
+        with pytest.raises(OSError):
+            breaker.call(fail)
+    assert breaker.state == CircuitBreaker.OPEN
+    with pytest.raises(CircuitOpen):
+        breaker.call(lambda: "never called")
+
+
+def test_success_resets_failure_count():
+    breaker = CircuitBreaker("test", failure_threshold=2)
+    with pytest.raises(OSError):
+        breaker.call(fail)
+    assert breaker.call(lambda: "ok") == "ok"
+    with pytest.raises(OSError):
+        breaker.call(fail)
+    assert breaker.state == CircuitBreaker.CLOSED
+
+
+def test_half_open_trial_closes_or_reopens():
+    breaker = CircuitBreaker("test", failure_threshold=1, reset_timeout=0.05)
+    with pytest.raises(OSError):
+        breaker.call(fail)
+    time.sleep(0.06)
+    with pytest.raises(OSError):
+        breaker.call(fail)  # the trial call fails: open again, timer restarted
+    assert breaker.state == CircuitBreaker.OPEN
+    with pytest.raises(CircuitOpen):
+        breaker.call(lambda: "ok")
+    time.sleep(0.06)
+    assert breaker.call(lambda: "ok") == "ok"
+    assert breaker.state == CircuitBreaker.CLOSED
+
+
+def test_half_open_lets_one_trial_through():
+    breaker = CircuitBreaker("test", failure_threshold=1, reset_timeout=0)
+    with pytest.raises(OSError):
+        breaker.call(fail)
+    release = threading.Event()
+    trial = threading.Thread(target=breaker.call, args=(release.wait,))
+    trial.start()
+    time.sleep(0.05)
+    assert breaker.state == CircuitBreaker.HALF_OPEN
+    with pytest.raises(CircuitOpen):
+        breaker.call(lambda: "second trial")
+    release.set()
+    trial.join()
+    assert breaker.state == CircuitBreaker.CLOSED
+
+
+def test_deadline_timeout_is_bounded():
+    connect, read = Deadline(1.0).timeout(connect=5.0)
+    assert connect <= 1.0 and read <= 1.0
+    with pytest.raises(DeadlineExceeded):
+        Deadline(0).timeout()
+
+
+def test_hedged_duplicate_wins_and_loser_is_discarded():
+    calls = []
+    discarded = []
+
+    def fn():
+        calls.append(None)
+        if len(calls) == 1:
+            time.sleep(0.3)
+            return "slow"
+        return "fast"
+
+    assert hedged(fn, 0.05, Deadline(2), discard=discarded.append) == "fast"
+    time.sleep(0.35)
+    assert len(calls) == 2
+    assert discarded == ["slow"]
@@ -0,0 +1,73 @@
+import time
+
+import pytest
+
+from router import CODE, SHORT_ANSWER, ModelRouter, ModelUnavailable, classify_question
+
+
+def make_router(**kwargs):
+    return ModelRouter(routes={SHORT_ANSWER: ["fast", "backup"]}, latency_budget={SHORT_ANSWER: 1.0}, **kwargs)
+
+
+def test_classify_question():
+    assert classify_question("Write a ducky script that opens a shell") == CODE
+    assert classify_question("What is a deauth attack?") == SHORT_ANSWER
+    assert classify_question(None) == SHORT_ANSWER
+
+
+def test_prefers_configured_order_without_samples():
+    assert make_router().candidates(SHORT_ANSWER) == ["fast", "backup"]
+
+
+def test_failure_puts_model_behind_alternate_until_cooldown_ends():
+    router = make_router(cooldown=0.05)
+    router.record("fast", 0.1, False, SHORT_ANSWER)
+    assert router.candidates(SHORT_ANSWER) == ["backup", "fast"]
+    time.sleep(0.06)
+    # Still demoted by its error rate once the cooldown is over
+    assert router.candidates(SHORT_ANSWER) == ["backup", "fast"]
+    for _ in range(5):
+        router.record("fast", 0.1, True, SHORT_ANSWER)
+    assert router.candidates(SHORT_ANSWER) == ["fast", "backup"]
+
+
+def test_p95_over_budget_demotes_model():
+    router = make_router(cooldown=0)
+    for _ in range(10):
+        router.record("fast", 2.0, True, SHORT_ANSWER)
+    assert router.candidates(SHORT_ANSWER) == ["backup", "fast"]
+
+
+def test_call_fails_over_and_records_outcomes():
+    router = make_router()
+    tried = []
+
+    def fn(model):
+        tried.append(model)
+        if model == "fast":
+            raise ModelUnavailable("overloaded")
+        return "answer"
+
+    assert router.call(SHORT_ANSWER, fn) == ("backup", "answer")
+    assert tried == ["fast", "backup"]
+    snapshot = router.snapshot()
+    assert snapshot["fast"]["error_rate"] == 1.0
+    assert snapshot["backup"]["error_rate"] == 0.0
+
+
+def test_call_raises_last_error_when_every_model_fails():
+    router = make_router()
+
+    def fn(model):
+        raise ModelUnavailable(model)
+
+    with pytest.raises(ModelUnavailable, match="backup"):
+        router.call(SHORT_ANSWER, fn)
+
+
+def test_hedge_delay_needs_samples():
+    router = make_router()
+    assert router.hedge_delay("fast") is None
+    for latency in (0.1, 0.2, 0.3, 0.4, 0.5):
+        router.record("fast", latency, True)
+    assert router.hedge_delay("fast", q=0.5) == 0.3
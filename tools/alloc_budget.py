@@ -0,0 +1,114 @@
+"""
+Allocation budget check for the profiled pipeline stages.
+
+Drives each stage with a representative workload, single-threaded, and compares
+its peak allocation with PROFILE_BUDGETS:
+
+  compositor.render   full frame, text updates and scrolling into a null panel
+  gemini.*            voice and image questions against tools/stub_gemini.py
+
+    python tools/alloc_budget.py --rounds 20 --report budget.json
+
+Exits 1 if any stage went over, so it can gate a release. Budgets are read from
+config.json, or config.json.template when there is none.
+"""
+import argparse
+import json
+import os
+import sys
+import tempfile
+
+TOOLS_DIR = os.path.dirname(os.path.abspath(__file__))
+REPO_DIR = os.path.dirname(TOOLS_DIR)
+sys.path[:0] = [REPO_DIR, TOOLS_DIR]
+
+from profiling import load_budgets, profiler  # noqa: E402
+from soak import prepare_workdir, synthesize_corpus  # noqa: E402
+from stub_gemini import StubGemini  # noqa: E402
+
+LOREM = ("The quick brown fox jumps over the lazy dog while the ST7789 keeps scrolling "
+         "through another long answer with an emoji or two 🦊🐶 and some more words. ")
+
+
+class _RecordingBoard:
+    LCD_WIDTH = 240
+    LCD_HEIGHT = 280
+
+    def __init__(self):
+        self.bytes_drawn = 0
+
+    def draw_image(self, x, y, width, height, pixel_data):
+        self.bytes_drawn += len(pixel_data)
+
+
+def run_compositor(rounds):
+    from ui import Compositor
+    ui = Compositor(_RecordingBoard())
+    background = os.path.join("data", "OdinSpecter_2.png")
+    for i in range(rounds):
+        text = LOREM * (1 + i % 4)
+        ui.update(status="Listening", emoji="🙂", text=text, battery_level=80, image_path=background)
+        ui.render()
+        for scroll_top in range(0, 60, 20):
+            ui.update(status="Answering", emoji="😀", text=text, scroll_top=scroll_top,
+                      battery_level=80, image_path=background)
+            ui.render()
+        ui.invalidate()
+
+
+def run_gemini(rounds, workdir):
+    from PIL import Image
+    stub = StubGemini(port=0)
+    stub.config.default_latency = 0
+    stub.config.jitter = 0
+    stub.config.audio_seconds = 3.0
+    stub.start()
+    try:
+        prepare_workdir(workdir, stub.url)
+        corpus = synthesize_corpus("corpus", count=2)
+        import gemini
+        image = Image.new("RGB", (1280, 960), (40, 90, 160))
+        for i in range(rounds):
+            gemini.upload_and_generate(audio_path=corpus[i % 2], output_filename="answer.wav", fallback=False)
+            gemini.ask_about_image(image, audio_path=corpus[i % 2], output_filename="answer.wav", fallback=False)
+    finally:
+        stub.stop()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--rounds", type=int, default=10)
+    parser.add_argument("--config", help="config.json with PROFILE_BUDGETS")
+    parser.add_argument("--snapshots", action="store_true", help="Report the top allocation sites per stage")
+    parser.add_argument("--report", help="Write the report as JSON to this path")
+    args = parser.parse_args()
+
+    config = args.config or os.path.join(REPO_DIR, "config.json")
+    if not os.path.exists(config):
+        config = os.path.join(REPO_DIR, "config.json.template")
+    report_path = os.path.abspath(args.report) if args.report else None
+
+    # The instrumented modules report to the shared profiler
+    profiler.budgets = load_budgets(config)
+    profiler.enable(snapshots=args.snapshots)
+    os.chdir(REPO_DIR)
+    run_compositor(args.rounds)
+    run_gemini(args.rounds, tempfile.mkdtemp(prefix="odin-budget-"))
+    profiler.disable()
+
+    report = profiler.report()
+    print(json.dumps(report["stages"], indent=2, ensure_ascii=False))
+    if report_path:
+        with open(report_path, "w") as f:
+            json.dump(report, f, indent=2)
+    over = profiler.check_budgets()
+    for name, peak, budget in over:
+        print(f"OVER BUDGET: {name} peaked at {peak} bytes (budget {budget})")
+    missing = sorted(set(profiler.budgets) - set(profiler.stats))
+    if missing:
+        print(f"Not exercised: {', '.join(missing)}")
+    sys.exit(1 if over else 0)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,168 @@
+"""
+Benchmark for the hands-free keyword spotter (kws.py).
+
+Enrolls templates from some keyword recordings, then streams a long fixture
+through KeywordSpotter in 40 ms capture-sized chunks. The fixture is background
+noise with the held-out keyword recordings and the negative clips spliced in
+at known times. Reports:
+
+  cpu_ms_per_audio_second   spotter thread CPU per second of audio
+  real_time_factor          the same as a fraction of one core
+  latency_ms                keyword end in the stream -> detection
+  hits / misses / false_alarms
+
+    python tools/kws_bench.py --keywords fixtures/odin --negatives fixtures/speech
+    python tools/kws_bench.py --synthetic
+
+Recordings are 16 kHz 16-bit WAVs. --synthetic generates formant-synthesized
+keyword and distractor "words" instead, for runs without recorded fixtures.
+Exits 1 if the spotter used more CPU than --budget (default kws.CPU_BUDGET).
+Numbers from a desktop are far below a Pi Zero 2's; run it on the device.
+"""
+import argparse
+import glob
+import json
+import os
+import sys
+import time
+
+import numpy as np
+
+TOOLS_DIR = os.path.dirname(os.path.abspath(__file__))
+REPO_DIR = os.path.dirname(TOOLS_DIR)
+sys.path[:0] = [REPO_DIR, TOOLS_DIR]
+
+import kws  # noqa: E402
+
+CHUNK = kws.RATE * 40 // 1000
+MATCH_BEFORE = 0.3  # a detection this long before a keyword's end still counts
+MATCH_AFTER = 1.0
+
+# (F1, F2) of a few vowels; a synthetic word is a sequence of them
+VOWELS = {"o": (500, 900), "i": (300, 2300), "e": (450, 1900), "a": (750, 1200), "u": (320, 800)}
+KEYWORD = "oie"
+DISTRACTORS = ("aua", "iea", "uoa", "eio", "ai", "ouu")
+
+
+def synth_word(vowels, rng):
+    """A word of voiced syllables with jittered pitch, length and loudness."""
+    f0 = 140 * rng.uniform(0.92, 1.08)
+    out = []
+    for vowel in vowels:
+        seconds = 0.2 * rng.uniform(0.9, 1.1)
+        t = np.arange(int(seconds * kws.RATE)) / kws.RATE
+        f1, f2 = VOWELS[vowel]
+        wave = np.zeros_like(t)
+        for harmonic in range(1, 40):
+            freq = f0 * harmonic
+            if freq > 7000:
+                break
+            gain = np.exp(-((freq - f1) / 120) ** 2) + 0.6 * np.exp(-((freq - f2) / 180) ** 2) + 0.02
+            wave += gain * np.sin(2 * np.pi * freq * t)
+        envelope = np.minimum(1, np.minimum(t, seconds - t) / 0.03)
+        out += [wave * envelope, np.zeros(int(0.05 * kws.RATE))]
+    word = np.concatenate(out)
+    return (word / np.abs(word).max() * 0.5 * 10 ** (rng.uniform(-6, 0) / 20)).astype(np.float32)
+
+
+def synthetic_fixtures(rng, keywords=12, negatives=12):
+    return ([synth_word(KEYWORD, rng) for _ in range(keywords)],
+            [synth_word(DISTRACTORS[i % len(DISTRACTORS)], rng) for i in range(negatives)])
+
+
+def load_dir(directory):
+    return [kws.read_wav(path) for path in sorted(glob.glob(os.path.join(directory, "*.wav")))]
+
+
+def build_stream(keywords, negatives, rng, gap=(2.0, 4.0), noise_db=-50):
+    """Concatenate clips shuffled with noise gaps; returns samples and keyword end times."""
+    clips = [(clip, True) for clip in keywords] + [(clip, False) for clip in negatives]
+    order = rng.permutation(len(clips))
+    parts, ends, position = [], [], 0
+    noise = 10 ** (noise_db / 20)
+    for i in order:
+        pad = int(rng.uniform(*gap) * kws.RATE)
+        parts.append(rng.normal(0, noise, pad).astype(np.float32))
+        position += pad
+        clip, is_keyword = clips[i]
+        parts.append(clip + rng.normal(0, noise, clip.size).astype(np.float32))
+        position += clip.size
+        if is_keyword:
+            ends.append(position / kws.RATE)
+    parts.append(rng.normal(0, noise, 2 * kws.RATE).astype(np.float32))
+    return np.concatenate(parts), ends
+
+
+def run(templates, length, stream, threshold, budget):
+    detections = []
+    spotter = kws.KeywordSpotter(templates, length, on_detect=None, threshold=threshold, cpu_budget=budget)
+    started = time.process_time()
+    for offset in range(0, stream.size, CHUNK):
+        if spotter.process(stream[offset:offset + CHUNK]):
+            detections.append(min(offset + CHUNK, stream.size) / kws.RATE)
+    return detections, spotter, time.process_time() - started
+
+
+def score(detections, ends):
+    latencies, unmatched = [], list(detections)
+    for end in ends:
+        match = next((d for d in unmatched if end - MATCH_BEFORE <= d <= end + MATCH_AFTER), None)
+        if match is not None:
+            unmatched.remove(match)
+            latencies.append(match - end)
+    return latencies, len(ends) - len(latencies), len(unmatched)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--keywords", help="Directory of keyword recordings (a third are enrolled, the rest detected)")
+    parser.add_argument("--negatives", help="Directory of recordings that must not trigger")
+    parser.add_argument("--synthetic", action="store_true")
+    parser.add_argument("--threshold", type=float, default=kws.THRESHOLD)
+    parser.add_argument("--budget", type=float, default=kws.CPU_BUDGET)
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--report", help="Write the results as JSON to this path")
+    args = parser.parse_args()
+
+    rng = np.random.default_rng(args.seed)
+    if args.synthetic:
+        keywords, negatives = synthetic_fixtures(rng)
+    elif args.keywords:
+        keywords = load_dir(args.keywords)
+        negatives = load_dir(args.negatives) if args.negatives else []
+    else:
+        parser.error("give --keywords DIR or --synthetic")
+    if len(keywords) < 2:
+        parser.error("need at least two keyword recordings")
+
+    enrolled, held_out = keywords[:max(1, len(keywords) // 3)], keywords[max(1, len(keywords) // 3):]
+    templates, length = kws.enroll_samples(enrolled)
+    stream, ends = build_stream(held_out, negatives, rng)
+    detections, spotter, cpu = run(templates, length, stream, args.threshold, args.budget)
+    latencies, misses, false_alarms = score(detections, ends)
+    audio_seconds = stream.size / kws.RATE
+    latencies_ms = sorted(round(latency * 1000) for latency in latencies)
+    report = {
+        "templates": len(templates),
+        "template_seconds": round(length * kws.HOP / kws.RATE, 2),
+        "audio_seconds": round(audio_seconds, 1),
+        "cpu_ms_per_audio_second": round(cpu / audio_seconds * 1000, 2),
+        "real_time_factor": round(cpu / audio_seconds, 4),
+        "final_stride": spotter.stride,
+        "hits": len(latencies),
+        "misses": misses,
+        "false_alarms": false_alarms,
+        "latency_ms": {"p50": latencies_ms[len(latencies_ms) // 2] if latencies_ms else None,
+                       "max": latencies_ms[-1] if latencies_ms else None},
+    }
+    print(json.dumps(report, indent=2))
+    if args.report:
+        with open(args.report, "w") as f:
+            json.dump(report, f, indent=2)
+    if cpu / audio_seconds > args.budget:
+        print(f"OVER BUDGET: {cpu / audio_seconds:.3f} of a core, budget {args.budget}")
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,279 @@
+"""
+Soak/load harness for the voice pipeline.
+
+Replays WAV utterances through the same path the button handler uses
+(recording -> JobQueue -> upload -> transcription -> answer -> TTS -> playback)
+against tools/stub_gemini.py, with N simulated devices asking questions
+concurrently. Every interval it prints throughput, latency percentiles, memory,
+open file descriptors and threads; at the end it reports growth since warm-up
+and any stray files (partial downloads, temp files, undelivered queue entries).
+
+    python tools/soak.py --devices 4 --duration 600 --default-latency 0.3 --default-error-rate 0.05
+
+Runs in a scratch working directory with its own config.json pointing API_BASE
+at the stub, so it never touches the real data/ directory or API key. The
+devices share one gemini module (one router, conversation and TTS cache), as
+they would behind a single gateway.
+"""
+import argparse
+import json
+import math
+import os
+import random
+import shutil
+import struct
+import sys
+import tempfile
+import threading
+import time
+import tracemalloc
+import wave
+
+TOOLS_DIR = os.path.dirname(os.path.abspath(__file__))
+REPO_DIR = os.path.dirname(TOOLS_DIR)
+sys.path[:0] = [REPO_DIR, TOOLS_DIR]
+
+from stub_gemini import StubGemini, parse_model_values  # noqa: E402
+
+STRAY_SUFFIXES = (".part", ".tmp", ".pcm")
+
+
+def prepare_workdir(workdir, api_base):
+    os.makedirs(os.path.join(workdir, "data"), exist_ok=True)
+    shutil.copyfile(os.path.join(REPO_DIR, "data", "guardrail.yaml"), os.path.join(workdir, "data", "guardrail.yaml"))
+    with open(os.path.join(workdir, "config.json"), "w") as f:
+        # Recall would answer repeated questions locally and take the model calls out of the load
+        json.dump({"GEMINI_API_KEY": "soak", "FILE": "data/recorded_voice.wav", "API_BASE": api_base,
+                   "HISTORY_RECALL": False}, f)
+    os.chdir(workdir)
+
+
+def synthesize_corpus(directory, count=6):
+    """Tone bursts of 1-5 s in the arecord format (16 kHz, stereo, S16_LE)."""
+    os.makedirs(directory, exist_ok=True)
+    paths = []
+    for i in range(count):
+        path = os.path.join(directory, f"utterance_{i}.wav")
+        seconds = 1 + i * 4 / max(1, count - 1)
+        frames = int(16000 * seconds)
+        samples = (int(8000 * math.sin(2 * math.pi * (220 + 40 * i) * n / 16000)) for n in range(frames))
+        with wave.open(path, "wb") as wav:
+            wav.setnchannels(2)
+            wav.setsampwidth(2)
+            wav.setframerate(16000)
+            wav.writeframes(b"".join(struct.pack("<hh", s, s) for s in samples))
+        paths.append(path)
+    return paths
+
+
+def percentile(values, q):
+    if not values:
+        return None
+    ordered = sorted(values)
+    return round(ordered[min(len(ordered) - 1, int(q * len(ordered)))], 3)
+
+
+def process_stats():
+    rss_kb = None
+    try:
+        with open("/proc/self/status") as f:
+            for line in f:
+                if line.startswith("VmRSS:"):
+                    rss_kb = int(line.split()[1])
+    except OSError:
+        import resource
+        rss_kb = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    try:
+        fds = len(os.listdir("/proc/self/fd"))
+    except OSError:
+        fds = None
+    return {"rss_mb": round(rss_kb / 1024, 1) if rss_kb else None, "fds": fds, "threads": threading.active_count()}
+
+
+def stray_files(workdir):
+    """Files that should not outlive a request: partial/temp outputs and leftovers in device queues."""
+    strays = []
+    for root, _, files in os.walk(workdir):
+        for name in files:
+            path = os.path.relpath(os.path.join(root, name), workdir)
+            in_queue = os.sep + "queue" in root and name not in ("jobs.log", "index.json")
+            if name.endswith(STRAY_SUFFIXES) or in_queue:
+                strays.append(path)
+    return strays
+
+
+def count_files(directory):
+    try:
+        return len(os.listdir(directory))
+    except OSError:
+        return 0
+
+
+class Device:
+    """One simulated unit: records (copies a corpus WAV), queues it, waits for the answer and plays it."""
+
+    def __init__(self, index, corpus, think_time, gemini, job_queue):
+        self.index = index
+        self.corpus = corpus
+        self.think_time = think_time
+        self.gemini = gemini
+        self.directory = os.path.join("devices", f"device_{index}")
+        self.rec_file = os.path.join(self.directory, "recorded_voice.wav")
+        os.makedirs(self.directory, exist_ok=True)
+        self.queue = job_queue.JobQueue(self._process, self._deliver, directory=os.path.join(self.directory, "queue"),
+                                        base_backoff=1, max_backoff=10)
+        self.done_state = job_queue.DONE
+        self.latencies = []
+        self.completed = 0
+        self.failed = 0
+        self.played_bytes = 0
+        self._delivered = threading.Event()
+
+    def _process(self, job):
+        answer_path = job["audio"][:-len(".wav")] + ".answer.wav"
+        self.gemini.upload_and_generate(audio_path=job["audio"], output_filename=answer_path, fallback=False)
+        return answer_path
+
+    def _deliver(self, job):
+        if job["state"] == self.done_state:
+            # Stand-in for aplay: read the whole file like a player would
+            with wave.open(job["result"], "rb") as wav:
+                self.played_bytes += len(wav.readframes(wav.getnframes()))
+            self.latencies.append(time.time() - job["created_at"])
+            self.completed += 1
+        else:
+            self.failed += 1
+        self._delivered.set()
+
+    def run(self, stop_at, request_timeout):
+        self.queue.start()
+        try:
+            while time.time() < stop_at:
+                shutil.copyfile(random.choice(self.corpus), self.rec_file)
+                self._delivered.clear()
+                self.queue.enqueue(self.rec_file)
+                if not self._delivered.wait(request_timeout):
+                    print(f"Device {self.index}: no answer after {request_timeout}s")
+                time.sleep(random.uniform(0, 2 * self.think_time))
+        finally:
+            self.queue.stop()
+
+
+def summarize(devices, started):
+    latencies = [latency for device in devices for latency in device.latencies]
+    completed = sum(device.completed for device in devices)
+    elapsed = time.time() - started
+    return {
+        "elapsed_s": round(elapsed, 1),
+        "completed": completed,
+        "failed": sum(device.failed for device in devices),
+        "throughput_per_min": round(completed / elapsed * 60, 2) if elapsed else 0,
+        "latency_p50_s": percentile(latencies, 0.5),
+        "latency_p95_s": percentile(latencies, 0.95),
+        "latency_p99_s": percentile(latencies, 0.99),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--devices", type=int, default=4)
+    parser.add_argument("--duration", type=float, default=300, help="Seconds to run")
+    parser.add_argument("--warmup", type=float, default=30, help="Seconds before the memory/fd baseline is taken")
+    parser.add_argument("--interval", type=float, default=30, help="Seconds between progress reports")
+    parser.add_argument("--think-time", type=float, default=1.0, help="Mean pause between questions per device")
+    parser.add_argument("--request-timeout", type=float, default=120)
+    parser.add_argument("--corpus", help="Directory of WAV utterances (synthesized if omitted)")
+    parser.add_argument("--workdir", help="Scratch directory (temporary if omitted)")
+    parser.add_argument("--latency", nargs="*", help="MODEL=SECONDS")
+    parser.add_argument("--default-latency", type=float, default=0.2)
+    parser.add_argument("--jitter", type=float, default=0.1)
+    parser.add_argument("--error-rate", nargs="*", help="MODEL=PROBABILITY")
+    parser.add_argument("--default-error-rate", type=float, default=0.0)
+    parser.add_argument("--audio-seconds", type=float, default=3.0, help="Length of each TTS answer")
+    parser.add_argument("--answer-chars", type=int, default=200)
+    parser.add_argument("--tracemalloc", action="store_true", help="Report the allocation sites that grew most")
+    parser.add_argument("--report", help="Write the final report as JSON to this path")
+    args = parser.parse_args()
+
+    corpus_dir = os.path.abspath(args.corpus) if args.corpus else None
+    report_path = os.path.abspath(args.report) if args.report else None
+    workdir = os.path.abspath(args.workdir or tempfile.mkdtemp(prefix="odin-soak-"))
+
+    stub = StubGemini(port=0)
+    stub.config.latency = parse_model_values(args.latency)
+    stub.config.default_latency = args.default_latency
+    stub.config.jitter = args.jitter
+    stub.config.error_rate = parse_model_values(args.error_rate)
+    stub.config.default_error_rate = args.default_error_rate
+    stub.config.audio_seconds = args.audio_seconds
+    stub.config.answer_chars = args.answer_chars
+    stub.config.unique_answers = True
+    stub.start()
+
+    prepare_workdir(workdir, stub.url)
+    corpus = ([os.path.join(corpus_dir, name) for name in sorted(os.listdir(corpus_dir)) if name.endswith(".wav")]
+              if corpus_dir else synthesize_corpus("corpus"))
+    if not corpus:
+        sys.exit(f"No .wav files in {corpus_dir}")
+
+    import gemini
+    import job_queue
+
+    print(f"Soak: {args.devices} devices for {args.duration:.0f}s against {stub.url}, workdir {workdir}")
+    if args.tracemalloc:
+        tracemalloc.start(10)
+    started = time.time()
+    stop_at = started + args.duration
+    devices = [Device(i, corpus, args.think_time, gemini, job_queue) for i in range(args.devices)]
+    threads = [threading.Thread(target=device.run, args=(stop_at, args.request_timeout),
+                                name=f"device-{device.index}", daemon=True) for device in devices]
+    for thread in threads:
+        thread.start()
+
+    baseline = None
+    baseline_snapshot = None
+    next_report = started + args.interval
+    while any(thread.is_alive() for thread in threads):
+        time.sleep(0.5)
+        now = time.time()
+        if baseline is None and now - started >= args.warmup:
+            baseline = process_stats()
+            if args.tracemalloc:
+                baseline_snapshot = tracemalloc.take_snapshot()
+        if now >= next_report:
+            next_report += args.interval
+            print(json.dumps(dict(summarize(devices, started), **process_stats())))
+    for thread in threads:
+        thread.join()
+
+    final = process_stats()
+    baseline = baseline or final
+    report = summarize(devices, started)
+    report.update({
+        "devices": args.devices,
+        "process": final,
+        "rss_growth_mb": round(final["rss_mb"] - baseline["rss_mb"], 1) if final["rss_mb"] else None,
+        "fd_growth": final["fds"] - baseline["fds"] if final["fds"] is not None else None,
+        "thread_growth": final["threads"] - baseline["threads"],
+        "tts_cache_files": count_files(gemini.TTS_CACHE_DIR),
+        "stray_files": stray_files(workdir),
+        "router": gemini.router.snapshot(),
+        "breakers": {name: breaker.state for name, breaker in gemini.breakers.items()},
+        "stub_counters": stub.counters,
+        "played_mb": round(sum(device.played_bytes for device in devices) / 1e6, 1),
+    })
+    if baseline_snapshot is not None:
+        growth = tracemalloc.take_snapshot().compare_to(baseline_snapshot, "lineno")
+        report["top_allocation_growth"] = [str(stat) for stat in growth[:10]]
+    stub.stop()
+
+    print(json.dumps(report, indent=2))
+    if report_path:
+        with open(report_path, "w") as f:
+            json.dump(report, f, indent=2)
+    leaks = report["stray_files"] or (report["fd_growth"] or 0) > 0
+    sys.exit(1 if leaks else 0)
+
+
+if __name__ == "__main__":
+    main()
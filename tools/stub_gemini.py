@@ -0,0 +1,238 @@
+"""
+Local stand-in for the Gemini REST endpoints used by gemini.py.
+
+Point the device at it with "API_BASE": "http://127.0.0.1:8765" in config.json.
+Latency and errors can be injected per model to exercise the model router, e.g.
+
+    python tools/stub_gemini.py --latency gemini-3-flash-preview=5 --error-rate gemini-2.5-flash=0.5
+
+--rpm MODEL=N enforces a per-model quota the way the real API does: requests
+beyond N in the last minute get HTTP 429 with Retry-After and a RetryInfo delay.
+"""
+import argparse
+import base64
+import json
+import random
+import threading
+import time
+import uuid
+from collections import deque
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+
+class StubConfig:
+    def __init__(self):
+        self.latency = {}  # model -> seconds
+        self.default_latency = 0.0
+        self.jitter = 0.0
+        self.error_rate = {}  # model -> probability of HTTP 503
+        self.default_error_rate = 0.0
+        self.rpm = {}  # model -> requests per minute before HTTP 429
+        self._requests = {}  # model -> deque of request times in the last minute
+        self.audio_seconds = 2.0
+        self.answer = "```answer\nStub answer from the local Gemini server.\n```"
+        self.answer_chars = 0  # pad answers to this length to vary response size
+        self.unique_answers = False  # make every answer distinct so TTS caching cannot hide work
+        self.transcript = "What is a deauthentication attack?"
+        self._answers = 0
+        self._lock = threading.Lock()
+
+    def delay_for(self, model):
+        base = self.latency.get(model, self.default_latency)
+        return max(0.0, base + random.uniform(-self.jitter, self.jitter))
+
+    def fails(self, model):
+        return random.random() < self.error_rate.get(model, self.default_error_rate)
+
+    def retry_after(self, model):
+        """Seconds until `model` is under its quota again, or 0 if this request is allowed."""
+        limit = self.rpm.get(model)
+        if not limit:
+            return 0
+        now = time.monotonic()
+        with self._lock:
+            recent = self._requests.setdefault(model, deque())
+            while recent and recent[0] <= now - 60:
+                recent.popleft()
+            if len(recent) >= limit:
+                return recent[0] + 60 - now
+            recent.append(now)
+            return 0
+
+    def next_answer(self):
+        body = self.answer[len("```answer\n"):-len("\n```")] if self.answer.startswith("```answer") else self.answer
+        if self.unique_answers:
+            with self._lock:
+                self._answers += 1
+                body = f"{body} ({self._answers})"
+        if len(body) < self.answer_chars:
+            body += " " + "lorem ipsum " * ((self.answer_chars - len(body)) // 12)
+        return f"```answer\n{body}\n```"
+
+
+class StubHandler(BaseHTTPRequestHandler):
+    server_version = "StubGemini/1.0"
+
+    def log_message(self, format, *args):
+        pass
+
+    def _read_body(self):
+        length = int(self.headers.get("Content-Length") or 0)
+        return self.rfile.read(length) if length else b""
+
+    def _send_json(self, status, body, headers=None):
+        payload = json.dumps(body).encode("utf-8")
+        try:
+            self.send_response(status)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(payload)))
+            for key, value in (headers or {}).items():
+                self.send_header(key, value)
+            self.end_headers()
+            self.wfile.write(payload)
+        except (BrokenPipeError, ConnectionResetError):
+            # Client gave up (deadline or lost hedge race)
+            self.server.count("client_aborted")
+
+    def do_PATCH(self):
+        self._read_body()
+        self.server.count("cache_refresh")
+        self._send_json(200, {"name": self.path.split("?")[0].split("/v1beta/")[-1]})
+
+    def do_POST(self):
+        body = self._read_body()
+        path = self.path.split("?")[0]
+        config = self.server.config
+        if path == "/upload/v1beta/files":
+            self.server.count("upload_start")
+            upload_id = uuid.uuid4().hex
+            host, port = self.server.server_address[:2]
+            self._send_json(200, {}, {"x-goog-upload-url": f"http://{host}:{port}/_upload/{upload_id}"})
+        elif path.startswith("/_upload/"):
+            self.server.count("upload_bytes", len(body))
+            file_id = path.rsplit("/", 1)[-1]
+            self._send_json(200, {"file": {"uri": f"stub://files/{file_id}", "sizeBytes": str(len(body))}})
+        elif path == "/v1beta/cachedContents":
+            self.server.count("cache_create")
+            self._send_json(200, {"name": f"cachedContents/{uuid.uuid4().hex[:12]}"})
+        elif path.startswith("/v1beta/models/") and path.endswith(":generateContent"):
+            model = path[len("/v1beta/models/"):-len(":generateContent")]
+            self.server.count(f"generate:{model}")
+            retry_after = config.retry_after(model)
+            if retry_after:
+                self.server.count(f"rate_limited:{model}")
+                self._send_json(429, {"error": {
+                    "code": 429, "status": "RESOURCE_EXHAUSTED", "message": "Quota exceeded (stub)",
+                    "details": [{"@type": "type.googleapis.com/google.rpc.RetryInfo",
+                                 "retryDelay": f"{retry_after:.0f}s"}]}},
+                    {"Retry-After": str(int(retry_after) + 1)})
+                return
+            time.sleep(config.delay_for(model))
+            if config.fails(model):
+                self._send_json(503, {"error": {"code": 503, "message": "injected failure"}})
+                return
+            self._send_json(200, self._generate(json.loads(body or b"{}")))
+        else:
+            self._send_json(404, {"error": {"code": 404, "message": path}})
+
+    def _generate(self, request):
+        config = self.server.config
+        modalities = request.get("generationConfig", {}).get("responseModalities", [])
+        if "AUDIO" in modalities:
+            # 16 kHz stereo s16le, matching what gemini.py converts
+            pcm = bytes(int(config.audio_seconds * 16000 * 2 * 2))
+            part = {"inlineData": {"mimeType": "audio/L16;rate=16000", "data": base64.b64encode(pcm).decode("ascii")}}
+        else:
+            parts = request.get("contents", [{}])[-1].get("parts", [])
+            has_audio = any("file_data" in p for p in parts)
+            has_image = any(p.get("inline_data", {}).get("mime_type", "").startswith("image/") for p in parts)
+            if has_image:
+                self.server.count("image_bytes", sum(len(p["inline_data"]["data"]) * 3 // 4
+                                                     for p in parts if "inline_data" in p))
+                part = {"text": f"Question: {config.transcript}\n{config.next_answer()}"}
+            else:
+                part = {"text": config.transcript if has_audio else config.next_answer()}
+        prompt_tokens = len(json.dumps(request)) // 4
+        return {
+            "candidates": [{"content": {"role": "model", "parts": [part]}}],
+            "usageMetadata": {
+                "promptTokenCount": prompt_tokens,
+                "cachedContentTokenCount": prompt_tokens // 2 if request.get("cachedContent") else 0,
+                "candidatesTokenCount": 20,
+            },
+        }
+
+
+class StubGemini(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(self, host="127.0.0.1", port=8765, config=None):
+        super().__init__((host, port), StubHandler)
+        self.config = config or StubConfig()
+        self.counters = {}
+        self._lock = threading.Lock()
+        self._thread = None
+
+    @property
+    def url(self):
+        host, port = self.server_address[:2]
+        return f"http://{host}:{port}"
+
+    def count(self, key, amount=1):
+        with self._lock:
+            self.counters[key] = self.counters.get(key, 0) + amount
+
+    def start(self):
+        self._thread = threading.Thread(target=self.serve_forever, name="stub-gemini", daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
+
+
+def parse_model_values(pairs):
+    values = {}
+    for pair in pairs or []:
+        model, _, value = pair.partition("=")
+        values[model] = float(value)
+    return values
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8765)
+    parser.add_argument("--latency", nargs="*", help="MODEL=SECONDS")
+    parser.add_argument("--default-latency", type=float, default=0.0)
+    parser.add_argument("--jitter", type=float, default=0.0)
+    parser.add_argument("--error-rate", nargs="*", help="MODEL=PROBABILITY")
+    parser.add_argument("--rpm", nargs="*", help="MODEL=REQUESTS_PER_MINUTE")
+    parser.add_argument("--audio-seconds", type=float, default=2.0)
+    parser.add_argument("--answer-chars", type=int, default=0)
+    parser.add_argument("--unique-answers", action="store_true")
+    args = parser.parse_args()
+
+    config = StubConfig()
+    config.latency = parse_model_values(args.latency)
+    config.default_latency = args.default_latency
+    config.jitter = args.jitter
+    config.error_rate = parse_model_values(args.error_rate)
+    config.rpm = parse_model_values(args.rpm)
+    config.audio_seconds = args.audio_seconds
+    config.answer_chars = args.answer_chars
+    config.unique_answers = args.unique_answers
+
+    server = StubGemini(args.host, args.port, config)
+    print(f"Stub Gemini listening on {server.url}")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+
+
+if __name__ == "__main__":
+    main()
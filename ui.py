@@ -0,0 +1,261 @@
+import threading
+import numpy as np
+from PIL import Image, ImageDraw, ImageFont
+
+from utils import ColorUtils, TextUtils, LRUCache
+from profiling import profiler
+
+FONT_PATH = "data/font.ttf"
+STATUS_FONT_SIZE = 24
+EMOJI_FONT_SIZE = 40
+BATTERY_FONT_SIZE = 13
+TEXT_FONT_SIZE = 20
+BACKGROUND_CACHE_BYTES = 4 * 1024 * 1024
+
+
+def load_font(size):
+    try:
+        return ImageFont.truetype(FONT_PATH, size)
+    except OSError:
+        return ImageFont.load_default()
+
+
+def rgba_to_rgb565(rgba):
+    """Split an HxWx4 uint8 array into an RGB565 plane and an alpha plane."""
+    r = (rgba[:, :, 0] >> 3).astype(np.uint16)
+    g = (rgba[:, :, 1] >> 2).astype(np.uint16)
+    b = (rgba[:, :, 2] >> 3).astype(np.uint16)
+    return (r << 11) | (g << 5) | b, rgba[:, :, 3]
+
+
+def blend_rgb565(dst, src, alpha):
+    """Alpha-blend src over dst in place; all three are arrays of the same shape."""
+    if not alpha.any():
+        return
+    if (alpha == 255).all():
+        dst[:] = src
+        return
+    # Only the covered pixels: text and icon layers are mostly transparent, and
+    # full-size uint32 temporaries would dominate the render's allocations
+    covered = alpha != 0
+    a = alpha[covered].astype(np.uint32)
+    inv = 255 - a
+    s = src[covered].astype(np.uint32)
+    d = dst[covered].astype(np.uint32)
+    r = (((s >> 11) & 0x1F) * a + ((d >> 11) & 0x1F) * inv) // 255
+    g = (((s >> 5) & 0x3F) * a + ((d >> 5) & 0x3F) * inv) // 255
+    b = ((s & 0x1F) * a + (d & 0x1F) * inv) // 255
+    dst[covered] = (r << 11) | (g << 5) | b
+
+
+class Layer:
+    """
+    A fixed screen rectangle whose pixels depend only on `inputs`.
+    The rendered result is kept as RGB565 + alpha and only rebuilt when the inputs change.
+    """
+
+    def __init__(self, name, bbox, render, z=0):
+        self.name = name
+        self.bbox = bbox  # (x, y, width, height)
+        self.render_fn = render
+        self.z = z
+        self.inputs = None
+        self.rgb565 = None
+        self.alpha = None
+        self.dirty = True
+
+    def set_inputs(self, inputs):
+        if inputs != self.inputs:
+            self.inputs = inputs
+            self.dirty = True
+
+    def render(self):
+        _, _, width, height = self.bbox
+        img = self.render_fn(width, height, *self.inputs)
+        if img is None:
+            img = Image.new("RGBA", (width, height), (0, 0, 0, 0))
+        self.rgb565, self.alpha = rgba_to_rgb565(np.asarray(img.convert("RGBA")))
+        self.dirty = False
+
+
+class Compositor:
+    """
+    Retained-mode screen: status bar, emoji, battery, background image and text viewport
+    are separate cached layers. render() rebuilds dirty layers, recomposites their
+    rectangles and sends only the pixels that actually changed to the panel.
+    """
+
+    def __init__(self, board):
+        self.board = board
+        self.width = board.LCD_WIDTH
+        self.height = board.LCD_HEIGHT
+        self.frame = np.zeros((self.height, self.width), dtype=np.uint16)
+        self.frame_valid = False
+        self.layers = {}
+        self.frames_sent = 0
+        self.bytes_sent = 0
+        self._lock = threading.Lock()
+        self.status_font = load_font(STATUS_FONT_SIZE)
+        self.emoji_font = load_font(EMOJI_FONT_SIZE)
+        self.battery_font = load_font(BATTERY_FONT_SIZE)
+        self.text_font = load_font(TEXT_FONT_SIZE)
+        self.background_cache = LRUCache(BACKGROUND_CACHE_BYTES, sizeof=lambda img: img.width * img.height * 3)
+
+        w, h = self.width, self.height
+        self.add_layer(Layer("background", (0, 0, w, h), self._render_background, z=0))
+        self.add_layer(Layer("status", (10, 4, w - 70, 32), self._render_status, z=1))
+        self.add_layer(Layer("battery", (w - 56, 10, 46, 20), self._render_battery, z=1))
+        self.add_layer(Layer("emoji", (0, 40, w, 52), self._render_emoji, z=1))
+        self.add_layer(Layer("text", (10, 96, w - 20, h - 116), self._render_text, z=1))
+
+    def add_layer(self, layer):
+        self.layers[layer.name] = layer
+
+    def update(self, status="", emoji="", text="", scroll_top=0, battery_level=None,
+               battery_color=None, image_path=""):
+        """Feed the current display state; layers whose inputs are unchanged stay cached."""
+        with self._lock:
+            self.layers["background"].set_inputs((image_path,))
+            self.layers["status"].set_inputs((status,))
+            self.layers["battery"].set_inputs((battery_level, battery_color))
+            self.layers["emoji"].set_inputs((emoji,))
+            self.layers["text"].set_inputs((text, scroll_top))
+
+    def text_overflow(self, text):
+        """Pixels the text layer can scroll before its last line reaches the bottom."""
+        if not text:
+            return 0
+        _, _, width, height = self.layers["text"].bbox
+        lines = TextUtils.wrap_text(None, text, self.text_font, width)
+        return max(0, sum(TextUtils.get_line_img(line, self.text_font).height for line in lines) - height)
+
+    def invalidate(self):
+        """Call after something else drew to the panel directly."""
+        with self._lock:
+            self.frame_valid = False
+
+    def preload_image(self, image_path):
+        try:
+            self._load_background(image_path)
+        except OSError as e:
+            print(f"Warning: Failed to load {image_path}: {e}")
+
+    def render(self):
+        """Recomposite dirty layers and push the changed pixels. Returns bytes sent."""
+        with self._lock, profiler.stage("compositor.render"):
+            dirty = [layer for layer in self.layers.values() if layer.dirty]
+            for layer in dirty:
+                layer.render()
+            if not self.frame_valid:
+                rects = [(0, 0, self.width, self.height)]
+            else:
+                rects = [layer.bbox for layer in dirty]
+            sent = 0
+            for rect in rects:
+                sent += self._flush_rect(rect, force=not self.frame_valid)
+            self.frame_valid = True
+            return sent
+
+    def _flush_rect(self, rect, force=False):
+        x, y, w, h = rect
+        region = np.zeros((h, w), dtype=np.uint16)
+        for layer in sorted(self.layers.values(), key=lambda l: l.z):
+            lx, ly, lw, lh = layer.bbox
+            x0, y0 = max(x, lx), max(y, ly)
+            x1, y1 = min(x + w, lx + lw), min(y + h, ly + lh)
+            if x0 >= x1 or y0 >= y1:
+                continue
+            blend_rgb565(
+                region[y0 - y:y1 - y, x0 - x:x1 - x],
+                layer.rgb565[y0 - ly:y1 - ly, x0 - lx:x1 - lx],
+                layer.alpha[y0 - ly:y1 - ly, x0 - lx:x1 - lx],
+            )
+        current = self.frame[y:y + h, x:x + w]
+        if force:
+            rows, cols = np.arange(h), np.arange(w)
+        else:
+            changed = region != current
+            rows = np.flatnonzero(changed.any(axis=1))
+            cols = np.flatnonzero(changed.any(axis=0))
+            if rows.size == 0:
+                return 0
+        r0, r1 = int(rows[0]), int(rows[-1]) + 1
+        c0, c1 = int(cols[0]), int(cols[-1]) + 1
+        current[:] = region
+        data = region[r0:r1, c0:c1].astype(">u2").tobytes()
+        self.board.draw_image(x + c0, y + r0, c1 - c0, r1 - r0, data)
+        self.frames_sent += 1
+        self.bytes_sent += len(data)
+        return len(data)
+
+    # ========== Layer renderers ==========
+    def _load_background(self, image_path):
+        img = self.background_cache.get(image_path)
+        if img is None:
+            img = Image.open(image_path).convert("RGB")
+            img = self._cover(img, self.width, self.height)
+            self.background_cache.put(image_path, img)
+        return img
+
+    @staticmethod
+    def _cover(img, width, height):
+        """Scale to fill the screen and crop the overflow, like load_jpg_as_rgb565."""
+        scale = max(width / img.width, height / img.height)
+        resized = img.resize((max(width, int(img.width * scale)), max(height, int(img.height * scale))))
+        left = (resized.width - width) // 2
+        top = (resized.height - height) // 2
+        return resized.crop((left, top, left + width, top + height))
+
+    def _render_background(self, width, height, image_path):
+        if not image_path:
+            return Image.new("RGBA", (width, height), (0, 0, 0, 255))
+        try:
+            return self._load_background(image_path)
+        except OSError as e:
+            print(f"Warning: Failed to load {image_path}: {e}")
+            return Image.new("RGBA", (width, height), (0, 0, 0, 255))
+
+    def _render_status(self, width, height, status):
+        if not status:
+            return None
+        img = Image.new("RGBA", (width, height), (0, 0, 0, 0))
+        TextUtils.draw_mixed_text(None, img, status, self.status_font, (0, 0))
+        return img
+
+    def _render_emoji(self, width, height, emoji):
+        if not emoji:
+            return None
+        img = Image.new("RGBA", (width, height), (0, 0, 0, 0))
+        line = TextUtils.get_line_img(emoji, self.emoji_font)
+        img.paste(line, ((width - line.width) // 2, (height - line.height) // 2), line)
+        return img
+
+    def _render_battery(self, width, height, level, color):
+        if level is None:
+            return None
+        img = Image.new("RGBA", (width, height), (0, 0, 0, 0))
+        draw = ImageDraw.Draw(img)
+        body_w = width - 4
+        draw.rounded_rectangle((0, 0, body_w - 1, height - 1), radius=4, outline=(255, 255, 255, 255))
+        draw.rectangle((body_w, height // 3, width - 1, height - height // 3), fill=(255, 255, 255, 255))
+        fill_w = int((body_w - 4) * max(0, min(100, level)) / 100)
+        fill = tuple(color) if color else (85, 255, 0)
+        if fill_w > 0:
+            draw.rectangle((2, 2, 2 + fill_w - 1, height - 3), fill=fill + (255,))
+        label_color = (0, 0, 0, 255) if ColorUtils.calculate_luminance(fill) > 128 else (255, 255, 255, 255)
+        draw.text((body_w // 2, height // 2), str(level), font=self.battery_font, fill=label_color, anchor="mm")
+        return img
+
+    def _render_text(self, width, height, text, scroll_top):
+        if not text:
+            return None
+        img = Image.new("RGBA", (width, height), (0, 0, 0, 0))
+        y = -scroll_top
+        for line in TextUtils.wrap_text(None, text, self.text_font, width):
+            line_img = TextUtils.get_line_img(line, self.text_font)
+            if y + line_img.height > 0:
+                img.paste(line_img, (0, y), line_img)
+            y += line_img.height
+            if y >= height:
+                break
+        return img
@@ -1,5 +1,10 @@
 import os
+import json
+import fcntl
+import mmap
+import threading
 import unicodedata
+from collections import OrderedDict
 from io import BytesIO
 import numpy as np
 from PIL import Image, ImageDraw, ImageFont
@@ -102,6 +107,44 @@ class ImageUtils:
     rgb565_data = (r << 11) | (g << 5) | b
     return rgb565_data.byteswap().tobytes()
   
+  @staticmethod
+  def encode_jpeg(image: Image.Image, max_bytes: int, max_side: int = 1024, min_side: int = 256,
+                  min_quality: int = 30, max_quality: int = 85):
+    """缩小并编码为 JPEG，使体积不超过 max_bytes。返回 (数据, 质量, (宽, 高))。"""
+    image = image.convert("RGB")
+    if max(image.size) > max_side:
+      image = image.copy()
+      image.thumbnail((max_side, max_side), Image.BILINEAR, reducing_gap=2.0)
+
+    def encode(img, quality):
+      buffer = BytesIO()
+      img.save(buffer, "JPEG", quality=quality)
+      return buffer.getvalue()
+
+    while True:
+      data = encode(image, max_quality)
+      if len(data) <= max_bytes:
+        return data, max_quality, image.size
+      smallest = encode(image, min_quality)
+      if len(smallest) <= max_bytes:
+        # 二分查找预算内的最高质量
+        lo, hi, best = min_quality, max_quality - 1, (smallest, min_quality)
+        while lo <= hi:
+          quality = (lo + hi) // 2
+          data = encode(image, quality)
+          if len(data) <= max_bytes:
+            best, lo = (data, quality), quality + 1
+          else:
+            hi = quality - 1
+        return best[0], best[1], image.size
+      if max(image.size) <= min_side:
+        # 已到最小尺寸，只能超出预算
+        return smallest, min_quality, image.size
+      # 最低质量仍超预算：按体积比例缩小后重试
+      scale = max(0.5, min(0.9, (max_bytes / len(smallest)) ** 0.5))
+      size = (max(1, int(image.width * scale)), max(1, int(image.height * scale)))
+      image = image.resize(size, Image.BILINEAR)
+
   @staticmethod
   def crop_center(image: Image.Image, target_width: int, target_height: int) -> Image.Image:
     width, height = image.size
@@ -112,52 +155,358 @@ class ImageUtils:
     return image.crop((left, top, right, bottom)).resize((target_width, target_height), Image.LANCZOS)
 
 
+class LRUCache:
+  """按字节计量的 LRU 缓存，超出预算时淘汰最久未使用的条目。"""
+
+  def __init__(self, max_bytes, sizeof=None):
+    self.max_bytes = max_bytes
+    self.sizeof = sizeof or (lambda value: 64)
+    self.current_bytes = 0
+    self.hits = 0
+    self.misses = 0
+    self.evictions = 0
+    self._entries = OrderedDict()
+    self._lock = threading.Lock()
+
+  def get(self, key, default=None):
+    with self._lock:
+      entry = self._entries.get(key)
+      if entry is None:
+        self.misses += 1
+        return default
+      self._entries.move_to_end(key)
+      self.hits += 1
+      return entry[0]
+
+  def put(self, key, value):
+    size = self.sizeof(value)
+    with self._lock:
+      old = self._entries.pop(key, None)
+      if old is not None:
+        self.current_bytes -= old[1]
+      if size > self.max_bytes:
+        # 单个条目超过预算，不缓存
+        return value
+      self._entries[key] = (value, size)
+      self.current_bytes += size
+      while self.current_bytes > self.max_bytes:
+        _, (_, evicted_size) = self._entries.popitem(last=False)
+        self.current_bytes -= evicted_size
+        self.evictions += 1
+    return value
+
+  def clear(self):
+    with self._lock:
+      self._entries.clear()
+      self.current_bytes = 0
+
+  def stats(self):
+    """返回命中、未命中、淘汰次数以及当前占用。"""
+    with self._lock:
+      return {
+        "entries": len(self._entries),
+        "bytes": self.current_bytes,
+        "max_bytes": self.max_bytes,
+        "hits": self.hits,
+        "misses": self.misses,
+        "evictions": self.evictions,
+      }
+
+  def __contains__(self, key):
+    with self._lock:
+      return key in self._entries
+
+  def __len__(self):
+    return len(self._entries)
+
+
+def image_nbytes(img):
+  """估算 PIL 图像占用的像素内存字节数。"""
+  return img.width * img.height * len(img.getbands())
+
+
+# 缓存预算（字节），Pi Zero 只有 512 MB 内存
+CHAR_SIZE_CACHE_BYTES = 256 * 1024
+LINE_IMAGE_CACHE_BYTES = 4 * 1024 * 1024
+EMOJI_IMAGE_CACHE_BYTES = 2 * 1024 * 1024
+
+char_size_cache = LRUCache(CHAR_SIZE_CACHE_BYTES, sizeof=lambda value: 128)
+line_image_cache = LRUCache(LINE_IMAGE_CACHE_BYTES, sizeof=image_nbytes)
+emoji_image_cache = LRUCache(EMOJI_IMAGE_CACHE_BYTES, sizeof=image_nbytes)
+
+
+EMOJI_SVG_DIR = "emoji_svg"
+EMOJI_ATLAS_DIR = os.path.join("data", "emoji_atlas")
+
+ZWJ = "\u200d"
+KEYCAP = "\u20e3"
+VARIATION_SELECTORS = ("\ufe0e", "\ufe0f")
+
+
+class EmojiAtlas:
+  """
+  按尺寸预光栅化的 emoji 图集。
+  每个 emoji 占用一个 size x size 的 RGBA 格子，第 n 个格子位于 atlas_<size>.rgba
+  的 n * cell_bytes 处，文件通过 mmap 常驻内存；索引按码位序列保存在 atlas_<size>.json。
+  写入时持有 atlas_<size>.lock 上的 flock，多个进程可以共用同一个图集。
+  """
+
+  def __init__(self, size, svg_dir=EMOJI_SVG_DIR, atlas_dir=EMOJI_ATLAS_DIR):
+    self.size = size
+    self.svg_dir = svg_dir
+    self.cell_bytes = size * size * 4
+    self.data_path = os.path.join(atlas_dir, f"atlas_{size}.rgba")
+    self.index_path = os.path.join(atlas_dir, f"atlas_{size}.json")
+    self.lock_path = os.path.join(atlas_dir, f"atlas_{size}.lock")
+    self.slots = {}
+    self.missing = set()
+    self._mm = None
+    self._lock = threading.Lock()
+    self._open()
+
+  def _source_mtime(self):
+    try:
+      return os.path.getmtime(self.svg_dir)
+    except OSError:
+      return 0
+
+  def _file_lock(self):
+    """跨进程的写锁；调用方负责关闭返回的文件以释放锁。"""
+    f = open(self.lock_path, "a")
+    fcntl.flock(f, fcntl.LOCK_EX)
+    return f
+
+  def _load_index(self):
+    try:
+      with open(self.index_path, "r") as f:
+        index = json.load(f)
+    except (OSError, ValueError):
+      return None
+    valid = (
+      index.get("size") == self.size
+      and index.get("source_mtime") == self._source_mtime()
+      and os.path.exists(self.data_path)
+      and os.path.getsize(self.data_path) >= len(index.get("slots", {})) * self.cell_bytes
+    )
+    return index["slots"] if valid else None
+
+  def _open(self):
+    os.makedirs(os.path.dirname(self.data_path), exist_ok=True)
+    with self._file_lock():
+      slots = self._load_index()
+      if slots is not None:
+        self.slots = slots
+        # 写完像素但没来得及保存索引就崩溃时，多出来的尾部不属于任何格子
+        with open(self.data_path, "r+b") as f:
+          f.truncate(len(self.slots) * self.cell_bytes)
+      else:
+        # emoji_svg 有变化或图集损坏，重新开始
+        self.slots = {}
+        open(self.data_path, "wb").close()
+        self._save_index()
+    self._remap()
+
+  def _remap(self):
+    if self._mm is not None:
+      self._mm.close()
+      self._mm = None
+    if os.path.getsize(self.data_path) > 0:
+      with open(self.data_path, "rb") as f:
+        self._mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+  def _save_index(self):
+    tmp_path = self.index_path + ".tmp"
+    with open(tmp_path, "w") as f:
+      json.dump({"size": self.size, "source_mtime": self._source_mtime(), "slots": self.slots}, f)
+    os.replace(tmp_path, self.index_path)
+
+  def _read_cell(self, slot):
+    offset = slot * self.cell_bytes
+    if self._mm is None or offset + self.cell_bytes > len(self._mm):
+      self._remap()
+    return Image.frombytes("RGBA", (self.size, self.size), self._mm[offset:offset + self.cell_bytes])
+
+  def _rasterize(self, name):
+    path = os.path.join(self.svg_dir, name + ".svg")
+    if not os.path.exists(path):
+      return None
+    try:
+      png_bytes = cairosvg.svg2png(url=path, output_width=self.size, output_height=self.size)
+      img = Image.open(BytesIO(png_bytes)).convert("RGBA")
+    except Exception as e:
+      print(f"[错误] 渲染 SVG 出错: {e}")
+      return None
+    if img.size != (self.size, self.size):
+      cell = Image.new("RGBA", (self.size, self.size), (0, 0, 0, 0))
+      cell.paste(img, ((self.size - img.width) // 2, (self.size - img.height) // 2))
+      img = cell
+    return img
+
+  def _append(self, name, img, save_index=True):
+    """写入新格子并返回格子号；调用方持有文件锁并已经用 _load_index 同步过索引。"""
+    slot = self.slots.get(name)
+    if slot is not None:
+      return slot  # 另一个进程刚刚加入了同一个 emoji
+    slot = len(self.slots)
+    with open(self.data_path, "r+b") as f:
+      f.seek(slot * self.cell_bytes)
+      f.write(img.tobytes())
+    self.slots[name] = slot
+    if save_index:
+      self._save_index()
+    return slot
+
+  def _sync_slots(self):
+    """持有文件锁时读取其他进程加入的格子。"""
+    slots = self._load_index()
+    if slots is not None:
+      self.slots = slots
+
+  def get(self, sequence):
+    """按码位序列取出 emoji 图像，找不到时返回 None。"""
+    with self._lock:
+      for name in EmojiUtils.emoji_filename_candidates(sequence):
+        slot = self.slots.get(name)
+        if slot is not None:
+          return self._read_cell(slot)
+        if name in self.missing:
+          continue
+        img = self._rasterize(name)
+        if img is None:
+          self.missing.add(name)
+          continue
+        with self._file_lock():
+          self._sync_slots()
+          self._append(name, img)
+        return img
+      return None
+
+  def build(self):
+    """把 emoji_svg 下所有尚未入库的 SVG 光栅化进图集。"""
+    with self._lock, self._file_lock():
+      self._sync_slots()
+      added = 0
+      for filename in sorted(os.listdir(self.svg_dir)):
+        name, ext = os.path.splitext(filename)
+        if ext != ".svg" or name in self.slots:
+          continue
+        img = self._rasterize(name)
+        if img is not None:
+          self._append(name, img, save_index=False)
+          added += 1
+      self._save_index()
+      self._remap()
+      return added
+
+  def close(self):
+    with self._lock:
+      if self._mm is not None:
+        self._mm.close()
+        self._mm = None
+
+
+emoji_atlases = {}
+emoji_atlases_lock = threading.Lock()
+
+
 class EmojiUtils:
   @staticmethod
   def emoji_to_filename(char):
     return '-'.join(f"{ord(c):x}" for c in char) + ".svg"
 
+  @staticmethod
+  def emoji_filename_candidates(sequence):
+    """按优先级返回可能的文件名（不含扩展名）：完整序列、去掉变体选择符、基础字符。"""
+    candidates = [EmojiUtils.emoji_to_filename(sequence)[:-4]]
+    stripped = "".join(c for c in sequence if c not in VARIATION_SELECTORS)
+    if stripped and stripped != sequence:
+      candidates.append(EmojiUtils.emoji_to_filename(stripped)[:-4])
+    if len(stripped) > 1:
+      candidates.append(EmojiUtils.emoji_to_filename(stripped[0])[:-4])
+    return candidates
+
+  @staticmethod
+  def get_atlas(size):
+    atlas = emoji_atlases.get(size)
+    if atlas is None:
+      with emoji_atlases_lock:
+        atlas = emoji_atlases.get(size)
+        if atlas is None:
+          atlas = emoji_atlases[size] = EmojiAtlas(size)
+    return atlas
+
+  @staticmethod
+  def build_atlas(size):
+    """预先构建指定尺寸的图集，返回新增的 emoji 数量。"""
+    return EmojiUtils.get_atlas(size).build()
+
   @staticmethod
   def get_local_emoji_svg_image(char, size):
-    filename = EmojiUtils.emoji_to_filename(char)
-    path = os.path.join("emoji_svg", filename)
-    if not os.path.exists(path):
-      # print(f"[警告] 找不到 SVG 图标: {path}")
-      return None
-    try:
-      png_bytes = cairosvg.svg2png(url=path, output_width=size, output_height=size)
-      img = Image.open(BytesIO(png_bytes)).convert("RGBA")
+    cache_key = (char, size)
+    img = emoji_image_cache.get(cache_key)
+    if img is not None:
       return img
-    except Exception as e:
-      print(f"[错误] 渲染 SVG 出错: {e}")
+    img = EmojiUtils.get_atlas(size).get(char)
+    if img is None:
+      # print(f"[警告] 找不到 SVG 图标: {char}")
       return None
+    return emoji_image_cache.put(cache_key, img)
 
   @staticmethod
   def is_emoji(char):
+    if len(char) > 1:
+      return KEYCAP in char or "\ufe0f" in char or any(EmojiUtils.is_emoji(c) for c in char)
     return unicodedata.category(char) in ('So', 'Sk') or ord(char) > 0x1F000
 
+  @staticmethod
+  def is_regional_indicator(char):
+    return 0x1F1E6 <= ord(char) <= 0x1F1FF
+
+  @staticmethod
+  def split_clusters(text):
+    """
+    把文本切分成字素簇：ZWJ 序列、肤色修饰、变体选择符、键帽、旗帜和标签序列
+    都会与前面的字符合并成一个簇。
+    """
+    clusters = []
+    for char in text:
+      code = ord(char)
+      if clusters:
+        prev = clusters[-1]
+        joins = (
+          char == ZWJ
+          or prev.endswith(ZWJ)
+          or char in VARIATION_SELECTORS
+          or char == KEYCAP
+          or 0x1F3FB <= code <= 0x1F3FF
+          or 0xE0020 <= code <= 0xE007F
+          or unicodedata.combining(char)
+          or (EmojiUtils.is_regional_indicator(char) and len(prev) == 1
+              and EmojiUtils.is_regional_indicator(prev))
+        )
+        if joins:
+          clusters[-1] = prev + char
+          continue
+      clusters.append(char)
+    return clusters
 
-char_size_cache = {}
-line_image_cache = {}
 
 class TextUtils:
   
   @staticmethod
   def get_char_size(font, char):
-    global char_size_cache
-    cache_key = (font.getname(), font.size, char)
-    if cache_key in char_size_cache:
-      return char_size_cache[cache_key]
     """获取字符的大小，返回宽度和高度。"""
+    cache_key = (font.getname(), font.size, char)
+    size = char_size_cache.get(cache_key)
+    if size is not None:
+      return size
     if EmojiUtils.is_emoji(char):
       emoji_img = EmojiUtils.get_local_emoji_svg_image(char, size=font.size)
       if emoji_img:
-        char_size_cache[cache_key] = (emoji_img.width, emoji_img.height)
-        return emoji_img.width, emoji_img.height
+        return char_size_cache.put(cache_key, (emoji_img.width, emoji_img.height))
     else:
       bbox = font.getbbox(char)
-      char_size_cache[cache_key] = (bbox[2] - bbox[0], bbox[3] - bbox[1])
-      return char_size_cache[cache_key]
+      return char_size_cache.put(cache_key, (bbox[2] - bbox[0], bbox[3] - bbox[1]))
     return 0, 0
   
   @staticmethod
@@ -169,18 +518,20 @@ class TextUtils:
   @staticmethod
   def get_line_img(text, font):
     cache_key = (font.getname(), font.size, text)
-    if cache_key in line_image_cache:
-      return line_image_cache[cache_key]
+    img = line_image_cache.get(cache_key)
+    if img is not None:
+      return img
     x, y = 0, 0
     ascent, descent = font.getmetrics()
     baseline = y + ascent
     line_height = ascent + descent
+    clusters = EmojiUtils.split_clusters(text)
     width = 0
-    for char in text:
+    for char in clusters:
       width += TextUtils.get_char_size(font, char)[0]
     img = Image.new("RGBA", (width, line_height), (0, 0, 0, 0))
     draw = ImageDraw.Draw(img)
-    for char in text:
+    for char in clusters:
       if EmojiUtils.is_emoji(char):
         emoji_img = EmojiUtils.get_local_emoji_svg_image(char, size=font.size)
         if emoji_img:
@@ -191,14 +542,21 @@ class TextUtils:
         draw.text((x, y), char, font=font, fill=(255, 255, 255))
         char_width = TextUtils.get_char_size(font, char)[0]
         x += char_width
-    line_image_cache[cache_key] = img
-    return line_image_cache[cache_key]
+    return line_image_cache.put(cache_key, img)
   
   @staticmethod
   def clean_line_image_cache():
     """清除行图像缓存。"""
-    global line_image_cache
-    line_image_cache = {}
+    line_image_cache.clear()
+
+  @staticmethod
+  def cache_stats():
+    """返回各缓存的统计信息。"""
+    return {
+      "char_size": char_size_cache.stats(),
+      "line_image": line_image_cache.stats(),
+      "emoji_image": emoji_image_cache.stats(),
+    }
 
   @staticmethod
   def get_text_size(text, font):
@@ -213,7 +571,7 @@ class TextUtils:
     lines = []
     current_line = ""
     current_width = 0
-    for char in text:
+    for char in EmojiUtils.split_clusters(text):
       test_line = current_line + char
       char_width = TextUtils.get_char_size(font, char)[0]
       current_width += char_width
@@ -0,0 +1,259 @@
+"""
+AI worker process: HTTP, JSON, base64 and audio work off the UI interpreter.
+
+gemini.py parses multi-megabyte responses and decodes speech on the thread
+that calls it, under the same GIL as rendering and GPIO callbacks. AIWorker
+runs it in a child process instead. The child is started as `python worker.py`
+(not forked, so it never imports OdinSpecter or touches the board) and talks to
+the UI process over a socketpair with multiprocessing.connection framing.
+Messages are small tuples; recordings, images and answers travel as file paths:
+
+    UI -> worker   (id, op, kwargs)       op: "answer", "prewarm", "quota", "stop"
+    worker -> UI   (id, ok, result)       result is the error text when not ok
+                   (0, True, {pid, api_base}) once, when the worker is ready
+
+Requests run concurrently in the worker and replies are matched by id. If the
+worker dies, pending requests fail with WorkerError, which the job queue
+retries like any other failure, and the next request starts a new worker.
+
+LocalAI has the same interface and runs everything in-process (--no_worker).
+"""
+import argparse
+import itertools
+import os
+import signal
+import subprocess
+import sys
+import threading
+from concurrent.futures import Future, ThreadPoolExecutor
+from multiprocessing.connection import Connection, Pipe
+
+from quota import INTERACTIVE
+
+WORKER_THREADS = 2  # matches the job queue's concurrency
+START_TIMEOUT = 30
+STOP_TIMEOUT = 5
+WORKER_PROFILE_FILE = "data/profile.worker.json"
+
+
+class WorkerError(Exception):
+    """A request failed in the worker, or the worker went away."""
+
+
+# ========== Operations (run in whichever process hosts gemini) ==========
+def answer(audio_path, output_filename, image_path=None, priority=INTERACTIVE):
+    """Answer one recorded question, about an image if given; returns the answer text."""
+    import gemini
+    with gemini.scheduler.priority(priority):
+        if image_path:
+            from PIL import Image
+            with Image.open(image_path) as image:
+                return gemini.ask_about_image(image, audio_path=audio_path, output_filename=output_filename,
+                                              fallback=False)
+        return gemini.upload_and_generate(audio_path=audio_path, output_filename=output_filename, fallback=False)
+
+
+def prewarm():
+    import gemini
+    gemini.prewarm_canned_speech()
+
+
+def quota():
+    import gemini
+    return gemini.scheduler.snapshot()
+
+
+OPS = {"answer": answer, "prewarm": prewarm, "quota": quota}
+
+
+class LocalAI:
+    """Runs the operations on the calling thread, in this process."""
+
+    def __init__(self):
+        self.api_base = None
+
+    def start(self):
+        import gemini
+        self.api_base = gemini.API_BASE
+        return self
+
+    def request(self, op, timeout=None, **kwargs):
+        return OPS[op](**kwargs)
+
+    def stop(self):
+        pass
+
+
+class AIWorker:
+    """Client side of the worker process; request() blocks the calling thread only."""
+
+    def __init__(self, metrics_port=None, profile=False, start_timeout=START_TIMEOUT):
+        self.metrics_port = metrics_port
+        self.profile = profile
+        self.start_timeout = start_timeout
+        self.api_base = None
+        self.pid = None
+        self.restarts = 0
+        self.process = None
+        self.conn = None
+        self._pending = {}
+        self._ids = itertools.count(1)
+        self._lock = threading.Lock()
+
+    def start(self):
+        with self._lock:
+            if self.conn is None:
+                self._spawn()
+        return self
+
+    def _spawn(self):
+        """Start the worker and wait for its hello; called with the lock held."""
+        conn, child = Pipe()
+        command = [sys.executable, os.path.abspath(__file__), "--fd", str(child.fileno())]
+        if self.metrics_port:
+            command += ["--metrics_port", str(self.metrics_port)]
+        if self.profile:
+            command.append("--profile")
+        self.process = subprocess.Popen(command, pass_fds=(child.fileno(),))
+        child.close()
+        try:
+            if not conn.poll(self.start_timeout):
+                raise WorkerError(f"worker did not start within {self.start_timeout}s")
+            _, _, hello = conn.recv()
+        except (WorkerError, EOFError, OSError) as e:
+            conn.close()
+            self.process.kill()
+            self.process.wait()
+            raise WorkerError(f"worker failed to start (exit {self.process.returncode}): {e}")
+        self.pid = hello["pid"]
+        self.api_base = hello["api_base"]
+        self.conn = conn
+        threading.Thread(target=self._receive, args=(conn,), name="ai-receive", daemon=True).start()
+        print(f"AI worker running as pid {self.pid}")
+
+    def request(self, op, timeout=None, **kwargs):
+        """Run `op` in the worker and return its result; raises WorkerError if it failed."""
+        future = Future()
+        with self._lock:
+            if self.conn is None:
+                self._spawn()
+                self.restarts += 1
+            msg_id = next(self._ids)
+            self._pending[msg_id] = future
+            try:
+                self.conn.send((msg_id, op, kwargs))
+            except OSError as e:
+                del self._pending[msg_id]
+                raise WorkerError(f"worker unreachable: {e}")
+        return future.result(timeout)
+
+    def _receive(self, conn):
+        while True:
+            try:
+                msg_id, ok, result = conn.recv()
+            except (EOFError, OSError):
+                break
+            with self._lock:
+                future = self._pending.pop(msg_id, None)
+            if future is None:
+                continue
+            if ok:
+                future.set_result(result)
+            else:
+                future.set_exception(WorkerError(result))
+        with self._lock:
+            if self.conn is not conn:
+                return  # stop() already took it down
+            self.conn = None
+            orphans, self._pending = self._pending, {}
+        conn.close()
+        code = self.process.wait()
+        print(f"AI worker exited with {code}, {len(orphans)} requests lost")
+        for future in orphans.values():
+            future.set_exception(WorkerError(f"worker exited with {code}"))
+
+    def stop(self):
+        with self._lock:
+            conn, self.conn = self.conn, None
+            orphans, self._pending = self._pending, {}
+        for future in orphans.values():
+            future.set_exception(WorkerError("worker stopped"))
+        if conn is None:
+            return
+        try:
+            conn.send((0, "stop", {}))
+        except OSError:
+            pass
+        try:
+            self.process.wait(STOP_TIMEOUT)
+        except subprocess.TimeoutExpired:
+            self.process.kill()
+            self.process.wait()
+        conn.close()
+
+
+# ========== Worker process ==========
+def serve(conn):
+    """Answer requests from `conn` until the UI says stop or goes away."""
+    import gemini
+    send_lock = threading.Lock()
+
+    def reply(message):
+        with send_lock:
+            conn.send(message)
+
+    def run(msg_id, op, kwargs):
+        try:
+            message = (msg_id, True, OPS[op](**kwargs))
+        except Exception as e:
+            message = (msg_id, False, f"{type(e).__name__}: {e}")
+        try:
+            reply(message)
+        except OSError:
+            pass  # the UI process is gone; nobody is waiting
+
+    reply((0, True, {"pid": os.getpid(), "api_base": gemini.API_BASE}))
+    pool = ThreadPoolExecutor(WORKER_THREADS, thread_name_prefix="ai")
+    while True:
+        try:
+            msg_id, op, kwargs = conn.recv()
+        except (EOFError, OSError):
+            break
+        if op == "stop":
+            break
+        pool.submit(run, msg_id, op, kwargs)
+    # Requests still running belong to jobs the queue will retry on the next start
+    pool.shutdown(wait=False, cancel_futures=True)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="OdinSpecter AI worker, started by AIWorker")
+    parser.add_argument("--fd", type=int, required=True, help="Inherited socket to the UI process")
+    parser.add_argument("--metrics_port", type=int, default=None)
+    parser.add_argument("--profile", action="store_true")
+    args = parser.parse_args()
+
+    # Ctrl+C reaches the whole process group; the UI process decides when we stop
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    from metrics import MetricsServer
+    from profiling import profiler, freeze_after_boot
+    profiler.install_signal(path=WORKER_PROFILE_FILE)
+    if args.profile:
+        profiler.enable()
+    conn = Connection(args.fd)
+    if args.metrics_port:
+        MetricsServer(args.metrics_port).start()
+    try:
+        import gemini  # noqa: F401  (config, caches and history are loaded before the hello)
+        freeze_after_boot()
+        serve(conn)
+    finally:
+        if profiler.enabled:
+            profiler.dump(WORKER_PROFILE_FILE)
+        conn.close()
+    # Don't wait for abandoned requests to finish
+    os._exit(0)
+
+
+if __name__ == "__main__":
+    main()